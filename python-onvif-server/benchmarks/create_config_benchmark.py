@@ -0,0 +1,66 @@
+"""Benchmark for --create-config against many cameras.
+
+Starts N bridge instances on 127.0.1.x as fake ONVIF cameras, then times
+create_batch_config with one worker (sequential probing) and with the given
+worker count, and checks the merged config has no port collisions.
+
+    python benchmarks/create_config_benchmark.py --cameras 16 --workers 8
+"""
+import argparse
+import asyncio
+import copy
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.unifi_requests import TEST_CONFIG
+from src.config_builder import create_batch_config
+from src.onvif_server import OnvifServerInstance, OnvifHTTPServer
+
+PORT = 8099
+
+
+def start_fake_cameras(count):
+    hosts = []
+    for i in range(count):
+        conf = copy.deepcopy(TEST_CONFIG)
+        conf['hostname'] = f'127.0.1.{i + 1}'
+        conf['ports']['server'] = PORT
+        httpd = OnvifHTTPServer((conf['hostname'], PORT), OnvifServerInstance(conf), threading.BoundedSemaphore(8))
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        hosts.append(f"{conf['hostname']}:{PORT}")
+    return hosts
+
+
+def check_ports(config):
+    # SOAP ports are per camera, RTSP and snapshot ports are per target host
+    seen = {}
+    for index, camera in enumerate(config['onvif']):
+        host = camera['target']['hostname']
+        for kind, owner in (('server', index), ('rtsp', host), ('snapshot', host)):
+            port = camera['ports'][kind]
+            if seen.setdefault(port, (kind, owner)) != (kind, owner):
+                raise AssertionError(f"port {port} assigned twice")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='create_config batch benchmark')
+    parser.add_argument('--cameras', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    hosts = start_fake_cameras(args.cameras)
+    print(f"{'workers':>7} {'seconds':>8} {'cameras':>8}")
+    for workers in (1, args.workers):
+        started = time.perf_counter()
+        config = asyncio.run(create_batch_config(hosts, 'admin', 'admin', workers=workers))
+        elapsed = time.perf_counter() - started
+        check_ports(config)
+        print(f"{workers:>7} {elapsed:>8.2f} {len(config['onvif']):>8}")
+
+
+if __name__ == '__main__':
+    main()
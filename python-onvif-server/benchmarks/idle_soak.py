@@ -0,0 +1,156 @@
+"""Idle connection soak test: memory per open but idle connection, exits 1 over budget.
+
+Starts main.py with one camera and opens --connections idle connections to
+one of its ports, then holds them for --hold seconds so slow leaks show up:
+
+    proxy  the RTSP port relayed byte for byte to a local sink (rtspMode: tcp)
+    mux    the RTSP port with rtspMode: mux, clients connected but not playing
+    soap   keep-alive connections to the ONVIF server port
+
+Reports the bridge's RSS before and after, the RSS per 1,000 connections
+and the KB per connection, which must stay within --max-kb (per kind).
+
+    python benchmarks/idle_soak.py --connections 1000 --kinds proxy,mux,soap
+"""
+import argparse
+import json
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.proxy_benchmark import wait_for_port
+from benchmarks.run import tree_stats, write_config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KINDS = ('proxy', 'mux', 'soap')
+# Per-connection budgets in KB, a Pi with 512 MB should hold thousands
+BUDGETS = {'proxy': 3, 'mux': 3, 'soap': 3}
+
+
+def start_sink():
+    # Accepts and holds connections on one thread, whatever their number
+    sink = socket.socket()
+    sink.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(1024)
+    sink.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sink, selectors.EVENT_READ)
+    held = []
+
+    def serve():
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is sink:
+                    try:
+                        conn, _ = sink.accept()
+                    except BlockingIOError:
+                        continue
+                    conn.setblocking(False)
+                    held.append(conn)
+                    selector.register(conn, selectors.EVENT_READ)
+                else:
+                    try:
+                        data = key.fileobj.recv(65536)
+                    except OSError:
+                        data = b''
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sink.getsockname()[1]
+
+
+def settle(pid, seconds=1.0):
+    # RSS once it stops moving
+    time.sleep(seconds)
+    return tree_stats(pid)[1]
+
+
+def soak(kind, connections, hold):
+    sink_port = start_sink()
+    config_path = os.path.join(tempfile.mkdtemp(), 'config.yaml')
+    config = write_config(config_path, 1, sink_port)
+    if kind == 'mux':
+        config['proxy'] = {'rtspMode': 'mux'}
+    # Neither limit nor time out the idle connections
+    config['http'] = {'maxConnections': connections + 1, 'idleTimeout': 0}
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    ports = config['onvif'][0]['ports']
+    port = ports['server'] if kind == 'soap' else ports['rtsp']
+
+    bridge = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py'), config_path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    socks = []
+    try:
+        wait_for_port(ports['server'], timeout=30)
+        wait_for_port(ports['rtsp'], timeout=30)
+        before = settle(bridge.pid)
+        for _ in range(connections):
+            sock = socket.create_connection(('127.0.0.1', port))
+            if kind == 'soap':
+                # One request, so the connection is an idle keep-alive one
+                sock.sendall(b'GET /health HTTP/1.1\r\nHost: bridge\r\n\r\n')
+                sock.recv(65536)
+            socks.append(sock)
+        after = settle(bridge.pid)
+        time.sleep(hold)
+        held = tree_stats(bridge.pid)[1]
+        if bridge.poll() is not None:
+            raise RuntimeError('bridge exited during the soak')
+    finally:
+        for sock in socks:
+            sock.close()
+        bridge.terminate()
+        bridge.wait()
+
+    per_connection = (max(after, held) - before) / connections
+    return {
+        'kind': kind,
+        'connections': connections,
+        'rss_before_mb': round(before / 1e6, 1),
+        'rss_after_mb': round(after / 1e6, 1),
+        'rss_held_mb': round(held / 1e6, 1),
+        'mb_per_1000': round(per_connection * 1000 / 1e6, 2),
+        'kb_per_connection': round(per_connection / 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Idle connection memory soak test')
+    parser.add_argument('--kinds', default=','.join(KINDS), help='comma separated, any of ' + ', '.join(KINDS))
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--hold', type=float, default=10, help='seconds to hold the connections open')
+    parser.add_argument('--max-kb', type=float, help='budget per connection for every kind, '
+                        'default ' + ', '.join(f'{k} {v} KB' for k, v in BUDGETS.items()))
+    args = parser.parse_args()
+
+    failures = []
+    for kind in args.kinds.split(','):
+        if kind not in KINDS:
+            parser.error(f"unknown kind {kind}")
+        result = soak(kind, args.connections, args.hold)
+        budget = args.max_kb if args.max_kb is not None else BUDGETS[kind]
+        result['budget_kb'] = budget
+        print(json.dumps(result))
+        if result['kb_per_connection'] > budget:
+            failures.append(f"{kind}: {result['kb_per_connection']} KB per connection, budget {budget:g} KB")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""Loopback throughput benchmark for the TCP proxy relay.
+
+Runs the relay in a child process, pushes data from N clients through it into
+a local sink and reports throughput, the relay's peak thread count and its CPU
+cost per Mbit/s. ``threaded`` is the thread-per-connection relay the bridge
+used before ProxyEngine, kept here as the baseline; ``copy`` and ``splice``
+are the two ProxyEngine relay modes.
+
+    python benchmarks/proxy_benchmark.py --clients 8 --megabytes 64
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+class ThreadedRelay(threading.Thread):
+    # Baseline: one accept thread plus three threads per client
+    def __init__(self, src_port, dst_host, dst_port):
+        super().__init__(daemon=True)
+        self.src_port = src_port
+        self.dst_host = dst_host
+        self.dst_port = dst_port
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    def run(self):
+        self.server_socket.bind(('127.0.0.1', self.src_port))
+        self.server_socket.listen(5)
+        while True:
+            client_sock, _ = self.server_socket.accept()
+            threading.Thread(target=self.handle_client, args=(client_sock,)).start()
+
+    def handle_client(self, client_sock):
+        remote_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            remote_sock.connect((self.dst_host, self.dst_port))
+            self.pipe_sockets(client_sock, remote_sock)
+        except Exception:
+            client_sock.close()
+
+    def pipe_sockets(self, sock1, sock2):
+        def forward(source, destination):
+            try:
+                while True:
+                    data = source.recv(4096)
+                    if not data: break
+                    destination.sendall(data)
+            except:
+                pass
+            finally:
+                try: destination.shutdown(socket.SHUT_RDWR)
+                except: pass
+                try: destination.close()
+                except: pass
+
+        t1 = threading.Thread(target=forward, args=(sock1, sock2))
+        t2 = threading.Thread(target=forward, args=(sock2, sock1))
+        t1.start()
+        t2.start()
+        t1.join()
+        t2.join()
+
+
+def serve(mode, src_port, dst_port):
+    if mode == 'threaded':
+        ThreadedRelay(src_port, '127.0.0.1', dst_port).start()
+    else:
+        from src.tcp_proxy import ProxyEngine
+        engine = ProxyEngine(relay_mode=mode)
+        engine.daemon = True
+        engine.add_proxy(src_port, '127.0.0.1', dst_port)
+        engine.start()
+    while True:
+        time.sleep(1)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_sink():
+    sink = socket.socket()
+    sink.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(128)
+
+    def drain(conn):
+        buf = bytearray(262144)
+        with conn:
+            while conn.recv_into(buf):
+                pass
+
+    def accept():
+        while True:
+            conn, _ = sink.accept()
+            threading.Thread(target=drain, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return sink.getsockname()[1]
+
+
+def proc_stats(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLK_TCK
+    with open(f'/proc/{pid}/status') as f:
+        threads = next(int(line.split()[1]) for line in f if line.startswith('Threads:'))
+    return cpu, threads
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'relay did not come up on port {port}')
+
+
+def run(mode, clients, megabytes):
+    sink_port = start_sink()
+    relay_port = free_port()
+    relay = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode,
+                              str(relay_port), str(sink_port)])
+    try:
+        wait_for_port(relay_port)
+        time.sleep(0.2)
+        cpu_before, _ = proc_stats(relay.pid)
+        peak_threads = 0
+        chunk = os.urandom(65536)
+        per_client = megabytes * 1024 * 1024 // clients
+
+        def push():
+            with socket.create_connection(('127.0.0.1', relay_port)) as s:
+                sent = 0
+                while sent < per_client:
+                    s.sendall(chunk)
+                    sent += len(chunk)
+                s.shutdown(socket.SHUT_WR)
+                s.recv(1)
+
+        workers = [threading.Thread(target=push) for _ in range(clients)]
+        started = time.perf_counter()
+        for w in workers:
+            w.start()
+        while any(w.is_alive() for w in workers):
+            peak_threads = max(peak_threads, proc_stats(relay.pid)[1])
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        cpu_after, _ = proc_stats(relay.pid)
+    finally:
+        relay.kill()
+        relay.wait()
+
+    mbit = per_client * clients * 8 / 1e6
+    cpu = cpu_after - cpu_before
+    return {
+        'mode': mode,
+        'clients': clients,
+        'mbit_per_s': round(mbit / elapsed, 1),
+        'peak_threads': peak_threads,
+        'cpu_percent': round(100 * cpu / elapsed, 1),
+        'cpu_percent_per_mbit_s': round(100 * cpu / mbit, 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TCP proxy relay benchmark')
+    parser.add_argument('--serve', nargs=3, metavar=('MODE', 'SRC_PORT', 'DST_PORT'), help=argparse.SUPPRESS)
+    parser.add_argument('--modes', default='threaded,copy,splice', help='comma separated relay modes')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--megabytes', type=int, default=64, help='total data pushed per mode')
+    args = parser.parse_args()
+
+    if args.serve:
+        mode, src_port, dst_port = args.serve
+        serve(mode, int(src_port), int(dst_port))
+        return
+
+    print(f"{'mode':<10} {'clients':>7} {'Mbit/s':>9} {'threads':>8} {'CPU%':>7} {'CPU%/Mbit/s':>12}")
+    for mode in args.modes.split(','):
+        r = run(mode, args.clients, args.megabytes)
+        print(f"{r['mode']:<10} {r['clients']:>7} {r['mbit_per_s']:>9} {r['peak_threads']:>8} "
+              f"{r['cpu_percent']:>7} {r['cpu_percent_per_mbit_s']:>12}")
+
+
+if __name__ == '__main__':
+    main()
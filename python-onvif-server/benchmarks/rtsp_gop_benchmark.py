@@ -0,0 +1,86 @@
+"""Time to first keyframe for clients joining a live RTSP stream.
+
+A stand-in RTSP server streams H.264 at a low framerate with a long GOP, like
+the Pi's configs. Clients join at random points and measure how long it takes
+until they receive an IDR/SPS, i.e. something decodable. Compared are the TCP
+relay, the RTSP mux and the RTSP mux with its GOP cache. In the mux modes an
+anchor client keeps the upstream session open, as an NVR recording would.
+
+Each client keeps reading for a second after its keyframe, through a small
+receive buffer so the GOP doesn't fit in the socket buffers; `gaps` counts the
+clients whose RTP sequence numbers skipped, e.g. because the cached GOP was cut
+short when the proxy's write buffer filled. Loopback buffers often take a
+whole GOP, --client-rate makes the replay wait on a rate limit instead.
+
+    python benchmarks/rtsp_gop_benchmark.py --fps 5 --gop 50 --joins 10
+    python benchmarks/rtsp_gop_benchmark.py --frame-size 100000 --client-rate 2000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.rtsp_mux_benchmark import free_port, wait_for_port
+from benchmarks.rtsp_standin import StandInServer, play
+from src.rtsp_proxy import RtspListener, configure_gop_cache
+from src.tcp_proxy import ProxyEngine
+
+
+async def run(mode, fps, gop, joins, frame_size, client_rate):
+    standin = StandInServer(fps=fps, gop=gop, frame_size=frame_size)
+    upstream_port = await standin.start()
+    configure_gop_cache(enabled=mode == 'mux+gop')
+    engine = ProxyEngine()
+    engine.daemon = True
+    engine.start()
+    # Anchor and joiners share the 127.0.0.1 client bucket
+    engine.configure(client_rate_limit=client_rate, rate_burst=0.25)
+    port = free_port()
+    engine.add_proxy(port, '127.0.0.1', upstream_port, None if mode == 'tcp' else RtspListener)
+    await asyncio.get_running_loop().run_in_executor(None, wait_for_port, port)
+
+    gop_seconds = gop / fps
+    anchor = None
+    if mode != 'tcp':
+        anchor = asyncio.create_task(play(port, duration=gop_seconds * (joins + 2)))
+        # Let the anchor see a full GOP so the cache is populated
+        await asyncio.sleep(gop_seconds)
+
+    times = []
+    gaps = 0
+    for _ in range(joins):
+        await asyncio.sleep(random.uniform(0, gop_seconds))
+        result = await play(port, duration=gop_seconds + 2, after_keyframe=1.0, rcvbuf=65536)
+        times.append(result.first_keyframe_at if result.first_keyframe_at is not None else float('inf'))
+        gaps += result.gaps > 0
+
+    if anchor is not None:
+        anchor.cancel()
+        await asyncio.gather(anchor, return_exceptions=True)
+    engine.stop()
+    await standin.stop()
+    return times, gaps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RTSP time-to-first-frame benchmark')
+    parser.add_argument('--fps', type=int, default=5)
+    parser.add_argument('--gop', type=int, default=50, help='frames per GOP')
+    parser.add_argument('--joins', type=int, default=10, help='clients joining per mode')
+    parser.add_argument('--frame-size', type=int, default=20000, help='bytes per frame')
+    parser.add_argument('--client-rate', type=int, default=0, help='per-client rate limit in bytes/s, 0 for none')
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'p50 ms':>8} {'max ms':>8} {'gaps':>5}")
+    for mode in ('tcp', 'mux', 'mux+gop'):
+        times, gaps = asyncio.run(run(mode, args.fps, args.gop, args.joins, args.frame_size,
+                                       args.client_rate))
+        print(f"{mode:>8} {statistics.median(times) * 1000:>8.1f} {max(times) * 1000:>8.1f} {gaps:>5}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""RTSP proxy benchmark: byte relay vs. session multiplexing.
+
+N clients play the same path through the proxy from a local stand-in RTSP
+server. With the TCP relay every client opens its own upstream session; with
+the RTSP mux they share one. Reports upstream sessions, upstream bytes and
+what the clients received.
+
+    python benchmarks/rtsp_mux_benchmark.py --clients 1,4,16 --duration 3
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.rtsp_standin import StandInServer, play
+from src.rtsp_proxy import RtspListener
+from src.tcp_proxy import ProxyEngine
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.02)
+    raise RuntimeError(f'proxy did not come up on port {port}')
+
+
+async def run(mode, clients, duration):
+    standin = StandInServer()
+    upstream_port = await standin.start()
+    engine = ProxyEngine()
+    engine.daemon = True
+    engine.start()
+    port = free_port()
+    engine.add_proxy(port, '127.0.0.1', upstream_port, RtspListener if mode == 'mux' else None)
+    await asyncio.get_running_loop().run_in_executor(None, wait_for_port, port)
+
+    results = await asyncio.gather(*(play(port, duration=duration) for _ in range(clients)))
+    engine.stop()
+    await standin.stop()
+    received = sum(r.bytes for r in results)
+    startup = max((r.first_packet_at or duration) for r in results)
+    return {
+        'mode': mode,
+        'clients': clients,
+        'upstream_sessions': standin.sessions_opened,
+        'upstream_mbit': round(standin.bytes_sent * 8 / duration / 1e6, 1),
+        'client_mbit': round(received * 8 / duration / 1e6, 1),
+        'first_packet_ms': round(startup * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RTSP proxy multiplexing benchmark')
+    parser.add_argument('--clients', default='1,4,16', help='comma separated client counts')
+    parser.add_argument('--duration', type=float, default=3)
+    args = parser.parse_args()
+
+    print(f"{'mode':>5} {'clients':>7} {'upstream':>8} {'up Mbit/s':>9} {'down Mbit/s':>11} {'first pkt ms':>12}")
+    for clients in (int(c) for c in args.clients.split(',')):
+        for mode in ('tcp', 'mux'):
+            r = asyncio.run(run(mode, clients, args.duration))
+            print(f"{r['mode']:>5} {r['clients']:>7} {r['upstream_sessions']:>8} {r['upstream_mbit']:>9} "
+                  f"{r['client_mbit']:>11} {r['first_packet_ms']:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""Local stand-in for mediamtx/a camera when testing the RTSP proxy.
+
+StandInServer answers DESCRIBE/SETUP/PLAY for any path with a single H.264
+track and streams synthetic RTP over the RTSP connection (interleaved). Each
+GOP starts with SPS, PPS and an IDR frame, followed by P frames; frames are
+FU-A fragmented like a real camera's. Like a live encoder, a new session
+starts at the current frame, usually in the middle of a GOP. It counts the sessions it serves, so a
+test can check how many upstream sessions the proxy opened.
+
+play() is a minimal interleaved RTSP client that records what it receives,
+including gaps in the RTP sequence numbers, e.g. from a cut-short GOP.
+"""
+import asyncio
+import os
+import socket
+import struct
+import time
+
+SDP = (
+    'v=0\r\n'
+    'o=- 0 0 IN IP4 127.0.0.1\r\n'
+    's=Stand-in\r\n'
+    't=0 0\r\n'
+    'm=video 0 RTP/AVP 96\r\n'
+    'a=rtpmap:96 H264/90000\r\n'
+    'a=fmtp:96 packetization-mode=1\r\n'
+    'a=control:trackID=0\r\n'
+)
+MAX_PAYLOAD = 1400
+
+
+def parse_request(data):
+    head, _, rest = data.partition(b'\r\n\r\n')
+    lines = head.decode().split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return lines[0], headers, rest
+
+
+def h264_frame(keyframe, size):
+    # NAL units of one access unit
+    if keyframe:
+        return [b'\x67' + b'\x42' * 8, b'\x68' + b'\xce' * 3, b'\x65' + os.urandom(16) * (size // 16)]
+    return [b'\x41' + os.urandom(16) * (size // 16)]
+
+
+def rtp_packets(nals, seq, timestamp, ssrc=0x1234):
+    packets = []
+    for i, nal in enumerate(nals):
+        last_nal = i == len(nals) - 1
+        if len(nal) <= MAX_PAYLOAD:
+            payloads = [(nal, last_nal)]
+        else:
+            # FU-A: indicator keeps NRI, header carries start/end bits and the NAL type
+            indicator = (nal[0] & 0xe0) | 28
+            body = nal[1:]
+            chunks = [body[j:j + MAX_PAYLOAD] for j in range(0, len(body), MAX_PAYLOAD)]
+            payloads = []
+            for j, chunk in enumerate(chunks):
+                header = nal[0] & 0x1f
+                if j == 0:
+                    header |= 0x80
+                if j == len(chunks) - 1:
+                    header |= 0x40
+                payloads.append((bytes((indicator, header)) + chunk, last_nal and j == len(chunks) - 1))
+        for payload, marker in payloads:
+            header = struct.pack('!BBHII', 0x80, (0x80 if marker else 0) | 96, seq & 0xffff, timestamp & 0xffffffff, ssrc)
+            packets.append(header + payload)
+            seq += 1
+    return packets, seq
+
+
+def frame_packet(channel, packet):
+    return b'$' + bytes((channel,)) + struct.pack('!H', len(packet)) + packet
+
+
+class StandInServer:
+    def __init__(self, fps=30, gop=30, frame_size=20000):
+        self.fps = fps
+        self.gop = gop
+        self.frame_size = frame_size
+        self.sessions_opened = 0
+        self.active_sessions = 0
+        self.bytes_sent = 0
+        self.server = None
+        self.handlers = set()
+        self.started = time.monotonic()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for task in list(self.handlers):
+            task.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        session = os.urandom(4).hex()
+        streaming = None
+        try:
+            while True:
+                data = await reader.readuntil(b'\r\n\r\n')
+                first_line, headers, _ = parse_request(data)
+                method, url, _ = first_line.split(' ')
+                cseq = headers.get('cseq', '0')
+                extra = ''
+                body = b''
+                if method == 'DESCRIBE':
+                    body = SDP.encode()
+                    extra = f"Content-Base: {url}/\r\nContent-Type: application/sdp\r\nContent-Length: {len(body)}\r\n"
+                elif method == 'SETUP':
+                    extra = f"Transport: {headers.get('transport', '')};ssrc=00001234\r\nSession: {session};timeout=60\r\n"
+                elif method == 'PLAY':
+                    extra = f"Session: {session}\r\n"
+                elif method == 'TEARDOWN':
+                    writer.write(f"RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\n\r\n".encode())
+                    break
+                writer.write(f"RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\n{extra}\r\n".encode() + body)
+                if method == 'PLAY' and streaming is None:
+                    self.sessions_opened += 1
+                    self.active_sessions += 1
+                    streaming = asyncio.get_running_loop().create_task(self.stream(writer))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.handlers.discard(asyncio.current_task())
+            if streaming is not None:
+                streaming.cancel()
+                self.active_sessions -= 1
+            writer.close()
+
+    async def stream(self, writer):
+        seq = 0
+        first = int((time.monotonic() - self.started) * self.fps)
+        for index in range(first, 1 << 62):
+            if writer.is_closing():
+                return
+            packets, seq = rtp_packets(h264_frame(index % self.gop == 0, self.frame_size), seq, index * 90000 // self.fps)
+            data = b''.join(frame_packet(0, p) for p in packets)
+            writer.write(data)
+            self.bytes_sent += len(data)
+            await writer.drain()
+            delay = self.started + (index + 1) / self.fps - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+class PlayResult:
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.first_packet_at = None
+        self.first_keyframe_at = None
+        self.first_nal_types = []
+        self.gaps = 0
+        self.status = {}
+
+
+def _nal_type(packet):
+    # NAL type of an RTP H.264 payload, FU-A resolved to the fragmented unit
+    payload = packet[12:]
+    nal = payload[0] & 0x1f
+    if nal == 28:
+        return payload[1] & 0x1f
+    return nal
+
+
+async def play(port, path='/cam', duration=2.0, host='127.0.0.1', channel=0, after_keyframe=None, rcvbuf=None):
+    # With after_keyframe, stops that many seconds after the first keyframe.
+    # A small rcvbuf makes the proxy's socket buffer fill like on a slow link.
+    result = PlayResult()
+    started = time.monotonic()
+    sock = socket.socket()
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, (host, port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    url = f"rtsp://{host}:{port}{path}"
+    cseq = 0
+
+    async def call(method, target, headers=''):
+        nonlocal cseq
+        cseq += 1
+        writer.write(f"{method} {target} RTSP/1.0\r\nCSeq: {cseq}\r\n{headers}\r\n".encode())
+        data = await reader.readuntil(b'\r\n\r\n')
+        first_line, resp_headers, _ = parse_request(data)
+        body = b''
+        if 'content-length' in resp_headers:
+            body = await reader.readexactly(int(resp_headers['content-length']))
+        result.status[method] = first_line.split(' ')[1]
+        return resp_headers, body
+
+    try:
+        headers, sdp = await call('DESCRIBE', url, 'Accept: application/sdp\r\n')
+        if result.status['DESCRIBE'] != '200':
+            return result
+        base = headers.get('content-base', url + '/')
+        control = [line for line in sdp.decode().split('\r\n') if line.startswith('a=control:')][0][len('a=control:'):]
+        track_url = control if control.startswith('rtsp://') else base + control
+        headers, _ = await call('SETUP', track_url, f"Transport: RTP/AVP/TCP;unicast;interleaved={channel}-{channel + 1}\r\n")
+        session = headers['session'].split(';')[0]
+        await call('PLAY', base, f"Session: {session}\r\n")
+
+        deadline = started + duration
+        last_seq = None
+        while time.monotonic() < deadline:
+            try:
+                head = await asyncio.wait_for(reader.readexactly(4), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+            if head[0] != 0x24:
+                # Keep-alive response or similar, skip to the end of it
+                await reader.readuntil(b'\r\n\r\n')
+                continue
+            packet = await reader.readexactly(struct.unpack('!H', head[2:])[0])
+            if head[1] != channel:
+                continue
+            seq = struct.unpack('!H', packet[2:4])[0]
+            if result.first_packet_at is None:
+                result.first_packet_at = time.monotonic() - started
+            elif seq != (last_seq + 1) & 0xffff:
+                result.gaps += 1
+            last_seq = seq
+            nal_type = _nal_type(packet)
+            if len(result.first_nal_types) < 4:
+                result.first_nal_types.append(nal_type)
+            if result.first_keyframe_at is None and nal_type in (5, 7):
+                result.first_keyframe_at = time.monotonic() - started
+                if after_keyframe is not None:
+                    deadline = min(deadline, time.monotonic() + after_keyframe)
+            result.packets += 1
+            result.bytes += len(packet)
+    finally:
+        writer.close()
+    return result
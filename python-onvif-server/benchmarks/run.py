@@ -0,0 +1,288 @@
+"""Benchmark suite: SOAP, WS-Discovery and proxy relay against a running bridge.
+
+Starts main.py on localhost with a config of --cameras cameras whose RTSP
+proxies point at a local sink, then runs each scenario:
+
+    soap       UniFi Protect's adoption sequence on keep-alive connections, per --clients level
+    discovery  WS-Discovery probes from concurrent senders, each answered by every camera
+    proxy      bulk data pushed through the cameras' RTSP proxy ports into the sink
+
+Every result has throughput, p50/p99 latency and the bridge's CPU%, peak RSS
+and peak thread count during the run (summed over its child processes). The
+output is JSON tagged with the commit, so runs can be compared across commits:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.proxy_benchmark import free_port, start_sink, wait_for_port
+from benchmarks.soap_load_test import percentile, run as run_soap
+from benchmarks.unifi_requests import TEST_CONFIG, probe
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+DISCOVERY_PORT = 3702
+SCENARIOS = ('soap', 'discovery', 'proxy')
+# Compared by --compare, with the direction that counts as better
+COMPARED = (('req_per_s', 1), ('mbit_per_s', 1), ('p50_ms', -1), ('p99_ms', -1), ('cpu_percent', -1), ('rss_mb', -1))
+
+
+def _process_tree(pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, ()))
+    return pids
+
+
+def tree_stats(pid):
+    # CPU seconds, RSS bytes and threads of a process and all its descendants
+    cpu = rss = threads = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLK_TCK
+        threads += int(fields[17])
+        rss += int(fields[21]) * PAGE_SIZE
+    return cpu, rss, threads
+
+
+class Sampler(threading.Thread):
+    # Samples the bridge while a scenario runs: CPU used, peak RSS and threads
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.done = threading.Event()
+        self.peak_rss = 0
+        self.peak_threads = 0
+
+    def run(self):
+        while not self.done.wait(0.1):
+            self.sample()
+
+    def sample(self):
+        _, rss, threads = tree_stats(self.pid)
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_threads = max(self.peak_threads, threads)
+
+    def __enter__(self):
+        self.sample()
+        self.cpu_before = tree_stats(self.pid)[0]
+        self.started = time.perf_counter()
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.join()
+        self.sample()
+        elapsed = time.perf_counter() - self.started
+        self.stats = {
+            'cpu_percent': round(100 * (tree_stats(self.pid)[0] - self.cpu_before) / elapsed, 1),
+            'rss_mb': round(self.peak_rss / 1e6, 1),
+            'threads': self.peak_threads,
+        }
+
+
+def write_config(path, cameras, sink_port):
+    onvif = []
+    for i in range(cameras):
+        conf = copy.deepcopy(TEST_CONFIG)
+        conf['name'] = f'Camera {i}'
+        conf['uuid'] = f'00000000-0000-4000-8000-{i:012x}'
+        conf['ports'] = {'server': free_port(), 'rtsp': free_port()}
+        conf['target'] = {'hostname': '127.0.0.1', 'ports': {'rtsp': sink_port}}
+        onvif.append(conf)
+    config = {'onvif': onvif}
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    return config
+
+
+def discovery(cameras, senders, duration):
+    # Each sender probes, waits for every camera's ProbeMatch, then probes again
+    latencies = []
+    errors = [0]
+    deadline = time.perf_counter() + duration
+
+    def sender():
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(1)
+            while time.perf_counter() < deadline:
+                message_id = str(uuid.uuid4()).encode()
+                started = time.perf_counter()
+                sock.sendto(probe(message_id.decode()), ('127.0.0.1', DISCOVERY_PORT))
+                matches = 0
+                try:
+                    while matches < cameras:
+                        data = sock.recv(65536)
+                        if message_id in data:
+                            matches += 1
+                except socket.timeout:
+                    errors[0] += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=sender) for _ in range(senders)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'req_per_s': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def proxy(ports, clients, duration):
+    chunk = os.urandom(65536)
+    sent = [0] * clients
+    deadline = time.perf_counter() + duration
+
+    def push(slot, port):
+        with socket.create_connection(('127.0.0.1', port)) as s:
+            while time.perf_counter() < deadline:
+                s.sendall(chunk)
+                sent[slot] += len(chunk)
+
+    threads = [threading.Thread(target=push, args=(i, ports[i % len(ports)])) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {'mbit_per_s': round(sum(sent) * 8 / duration / 1e6, 1)}
+
+
+def wait_for_discovery(cameras, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if discovery(cameras, 1, 0.2)['requests']:
+            return
+    raise RuntimeError('bridge does not answer WS-Discovery probes')
+
+
+def git_info():
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {'commit': git('rev-parse', 'HEAD') or None, 'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def compare(old, new):
+    # Relative change per metric, positive means better
+    old_results = {(r['scenario'], r['concurrency']): r for r in old['results']}
+    print(f"{'scenario':<10} {'conc':>5} {'metric':<12} {'old':>10} {'new':>10} {'change':>8}", file=sys.stderr)
+    for r in new['results']:
+        before = old_results.get((r['scenario'], r['concurrency']))
+        if before is None:
+            continue
+        for metric, direction in COMPARED:
+            if r.get(metric) is None or before.get(metric) is None:
+                continue
+            change = (r[metric] - before[metric]) / before[metric] * 100 * direction if before[metric] else 0.0
+            change += 0.0  # no -0.0
+            print(f"{r['scenario']:<10} {r['concurrency']:>5} {metric:<12} {before[metric]:>10} {r[metric]:>10} "
+                  f"{change:>+7.1f}%", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite for the ONVIF bridge')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated, any of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--cameras', type=int, default=4)
+    parser.add_argument('--clients', default='1,8,32', help='comma separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per scenario and level')
+    parser.add_argument('--bridge-args', default='', help='extra main.py arguments, e.g. "--processes 4"')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', metavar='JSON', help='print the change against an earlier run')
+    args = parser.parse_args()
+
+    sink_port = start_sink()
+    config_path = os.path.join(tempfile.mkdtemp(), 'config.yaml')
+    config = write_config(config_path, args.cameras, sink_port)
+    server_port = config['onvif'][0]['ports']['server']
+    ports = [conf['ports']['rtsp'] for conf in config['onvif']]
+    levels = [int(c) for c in args.clients.split(',')]
+
+    report = {
+        **git_info(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'params': {'cameras': args.cameras, 'duration': args.duration, 'bridge_args': args.bridge_args},
+        'results': [],
+    }
+    bridge = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py'), *args.bridge_args.split(), config_path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for conf in config['onvif']:
+            wait_for_port(conf['ports']['server'], timeout=30)
+            wait_for_port(conf['ports']['rtsp'], timeout=30)
+        scenarios = args.scenarios.split(',')
+        if 'discovery' in scenarios:
+            wait_for_discovery(args.cameras)
+        idle = tree_stats(bridge.pid)
+        report['idle'] = {'rss_mb': round(idle[1] / 1e6, 1), 'threads': idle[2]}
+
+        for scenario in scenarios:
+            for level in levels:
+                with Sampler(bridge.pid) as sampler:
+                    if scenario == 'soap':
+                        result = run_soap('127.0.0.1', server_port, level, args.duration, True)
+                        del result['clients'], result['keepalive']
+                    elif scenario == 'discovery':
+                        result = discovery(args.cameras, level, args.duration)
+                    elif scenario == 'proxy':
+                        result = proxy(ports, level, args.duration)
+                    else:
+                        parser.error(f"unknown scenario {scenario}")
+                result = {'scenario': scenario, 'concurrency': level, **result, **sampler.stats}
+                report['results'].append(result)
+                print(json.dumps(result), file=sys.stderr)
+    finally:
+        bridge.terminate()
+        bridge.wait()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
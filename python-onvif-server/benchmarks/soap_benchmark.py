@@ -0,0 +1,64 @@
+"""Single-core SOAP routing microbenchmark.
+
+Replays the UniFi Protect adoption sequence through the request parser and
+OnvifServerInstance.handle_request, and compares it with the previous routing
+(decode + ElementTree parse of the whole envelope). Reports requests/sec of
+CPU time on one core.
+
+    python benchmarks/soap_benchmark.py --iterations 20000
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+from xml.etree import ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.unifi_requests import ADOPTION_SEQUENCE, TEST_CONFIG
+from src.onvif_server import OnvifServerInstance
+from src.soap_request import SoapRequest, parse_soap_request
+
+
+def legacy_route(path, data):
+    # Routing as done by OnvifHandler.do_POST before the byte scanner
+    post_data = data.decode('utf-8')
+    action = "Unknown"
+    try:
+        root = ET.fromstring(post_data)
+        body = root.find('.//{http://www.w3.org/2003/05/soap-envelope}Body')
+        if body is not None and len(body) > 0:
+            action = body[0].tag.split('}')[-1]
+    except:
+        pass
+    token = 'sub_stream' if 'sub_stream' in post_data else 'main_stream'
+    return SoapRequest(path, action, token)
+
+
+def measure(route, instance, iterations):
+    requests = [(path, body) for path, _, body in ADOPTION_SEQUENCE]
+    started = time.process_time()
+    for _ in range(iterations):
+        for path, body in requests:
+            instance.handle_request(route(path, body))
+    elapsed = time.process_time() - started
+    return iterations * len(requests) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SOAP routing microbenchmark')
+    parser.add_argument('--iterations', type=int, default=20000, help='replays of the adoption sequence')
+    args = parser.parse_args()
+
+    instance = OnvifServerInstance(copy.deepcopy(TEST_CONFIG))
+    for path, action, body in ADOPTION_SEQUENCE:
+        assert parse_soap_request(path, body).action == action
+
+    for name, route in (('elementtree', legacy_route), ('scanner', parse_soap_request)):
+        rate = measure(route, instance, args.iterations)
+        print(f"{name:<12} {rate:>10.0f} req/s per core")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Load test for the ONVIF SOAP HTTP server.
+
+N concurrent clients each hold one keep-alive connection and replay the UniFi
+Protect adoption sequence for a fixed duration. Reports throughput and p50/p99
+request latency. Without --port a local server is started in a child process
+from the benchmark config.
+
+    python benchmarks/soap_load_test.py --clients 1,8,32 --duration 5
+"""
+import argparse
+import copy
+import http.client
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.unifi_requests import ADOPTION_SEQUENCE, TEST_CONFIG
+
+
+def serve(port, max_in_flight):
+    import threading
+    from src.onvif_server import OnvifServerInstance, OnvifHTTPServer
+    instance = OnvifServerInstance(copy.deepcopy(TEST_CONFIG))
+    httpd = OnvifHTTPServer(('127.0.0.1', port), instance, threading.BoundedSemaphore(max_in_flight),
+                            max_connections=1024)
+    httpd.serve_forever()
+
+
+def client(args):
+    host, port, duration, keepalive = args
+    latencies = []
+    errors = 0
+    headers = {'Content-Type': 'application/soap+xml; charset=utf-8'}
+    if not keepalive:
+        headers['Connection'] = 'close'
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for path, _, body in ADOPTION_SEQUENCE:
+            started = time.perf_counter()
+            try:
+                conn.request('POST', path, body, headers)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    errors += 1
+                if resp.will_close:
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+                continue
+            latencies.append(time.perf_counter() - started)
+    conn.close()
+    return latencies, errors
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(host, port, clients, duration, keepalive):
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(client, [(host, port, duration, keepalive)] * clients)
+    latencies = [l for r, _ in results for l in r]
+    errors = sum(e for _, e in results)
+    return {
+        'clients': clients,
+        'keepalive': keepalive,
+        'requests': len(latencies),
+        'errors': errors,
+        'req_per_s': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            http.client.HTTPConnection(host, port, timeout=1).connect()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'server did not come up on port {port}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ONVIF SOAP load test')
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='test a running server instead of starting one')
+    parser.add_argument('--clients', default='1,8,32', help='comma separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per concurrency level')
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    parser.add_argument('--no-keepalive', action='store_true', help='open a new connection per request')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.max_in_flight)
+        return
+
+    server = None
+    port = args.port
+    if port is None:
+        import socket
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port),
+                                   '--max-in-flight', str(args.max_in_flight)])
+    try:
+        wait_for_port(args.host, port)
+        print(f"{'clients':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for clients in (int(c) for c in args.clients.split(',')):
+            r = run(args.host, port, clients, args.duration, not args.no_keepalive)
+            print(f"{r['clients']:>7} {r['req_per_s']:>9} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['errors']:>7}")
+    finally:
+        if server is not None:
+            server.kill()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
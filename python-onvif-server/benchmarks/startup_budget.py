@@ -0,0 +1,110 @@
+"""Startup budget check for server mode, exits 1 when over budget.
+
+Measures, each in a fresh interpreter:
+  - which modules `import main` loads: the --create-config stack (onvif,
+    zeep, lxml, requests) must never be among them
+  - the time `import main` takes
+  - the time from starting `main.py config.yaml` until every camera's SOAP
+    port accepts connections, i.e. how long NVRs lose the cameras on a
+    systemd restart, and the process RSS at that point
+
+The time and RSS budgets default to a Pi 4; pass larger ones on slower boards.
+
+    python benchmarks/startup_budget.py --cameras 16
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run import tree_stats, write_config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORBIDDEN = ('onvif', 'zeep', 'lxml', 'requests')
+RUNS = 5
+
+
+def imported_modules():
+    code = "import sys; sys.argv = ['main.py']; import main; print(' '.join(sys.modules))"
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return set(out.stdout.split())
+
+
+def import_seconds():
+    # Best of several runs, the first one may still be warming the page cache
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    return min(float(subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True,
+                                    check=True).stdout) for _ in range(RUNS))
+
+
+def ready(ports):
+    for port in ports:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+        except OSError:
+            return False
+    return True
+
+
+def startup(config_path, ports, timeout=30):
+    started = time.perf_counter()
+    bridge = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py'), config_path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not ready(ports):
+            if time.perf_counter() - started > timeout or bridge.poll() is not None:
+                raise RuntimeError('bridge did not start')
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - started
+        # Let the background threads (discovery, snapshot prewarm) settle
+        time.sleep(0.5)
+        rss = tree_stats(bridge.pid)[1]
+    finally:
+        bridge.terminate()
+        bridge.wait()
+    return elapsed, rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Server mode startup budget check')
+    parser.add_argument('--cameras', type=int, default=16)
+    parser.add_argument('--max-import-ms', type=float, default=250)
+    parser.add_argument('--max-ready-ms', type=float, default=1000)
+    parser.add_argument('--max-rss-mb', type=float, default=40)
+    args = parser.parse_args()
+
+    config_path = os.path.join(tempfile.mkdtemp(), 'config.yaml')
+    # No proxy targets are needed, the SOAP ports are what NVRs wait for
+    config = write_config(config_path, args.cameras, 9)
+    ports = [conf['ports']['server'] for conf in config['onvif']]
+
+    failures = []
+    loaded = sorted({m.split('.')[0] for m in imported_modules()} & set(FORBIDDEN))
+    if loaded:
+        failures.append(f"server mode imports {', '.join(loaded)}")
+    import_ms = import_seconds() * 1000
+    results = [startup(config_path, ports) for _ in range(RUNS)]
+    ready_ms = sorted(r[0] for r in results)[RUNS // 2] * 1000
+    rss_mb = max(r[1] for r in results) / 1e6
+
+    for name, value, budget in (('import main', import_ms, args.max_import_ms),
+                                (f'ready with {args.cameras} cameras', ready_ms, args.max_ready_ms)):
+        print(f"{name:<28} {value:>8.1f} ms  (budget {budget:g} ms)")
+        if value > budget:
+            failures.append(f"{name} took {value:.1f} ms, budget {budget:g} ms")
+    print(f"{'RSS':<28} {rss_mb:>8.1f} MB  (budget {args.max_rss_mb:g} MB)")
+    if rss_mb > args.max_rss_mb:
+        failures.append(f"RSS is {rss_mb:.1f} MB, budget {args.max_rss_mb:g} MB")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""Aggregate relay throughput of the bridge by worker process count.
+
+Writes a config with N cameras whose RTSP ports are relayed to a local sink,
+starts main.py with --processes 1, 2, ... and pushes data through every
+camera's proxy port from several load generator processes for a fixed time.
+Reports the aggregate throughput and, as a check of the merged metrics, the
+bytes the bridge itself reports in onvif_bridge_proxy_relayed_bytes_total.
+The copy relay is used by default: splice moves bytes in the kernel and is
+bound by loopback bandwidth rather than by the GIL.
+
+    python benchmarks/supervisor_benchmark.py --cameras 16 --processes 1,2,4
+"""
+import argparse
+import copy
+import multiprocessing
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.proxy_benchmark import free_port, start_sink, wait_for_port
+from benchmarks.unifi_requests import TEST_CONFIG
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+
+def write_config(path, cameras, sink_port, relay_mode, metrics_port):
+    onvif = []
+    for i in range(cameras):
+        conf = copy.deepcopy(TEST_CONFIG)
+        conf['name'] = f'Camera {i}'
+        conf['uuid'] = f'00000000-0000-4000-8000-{i:012x}'
+        conf['hostname'] = '127.0.0.1'
+        conf['ports'] = {'server': free_port(), 'rtsp': free_port()}
+        conf['target'] = {'hostname': '127.0.0.1', 'ports': {'rtsp': sink_port}}
+        onvif.append(conf)
+    config = {'onvif': onvif, 'proxy': {'relayMode': relay_mode}, 'metrics': {'port': metrics_port}}
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    return config
+
+
+def push(ports, connections, duration, results):
+    # Load generator process: `connections` clients per port, sending until the deadline
+    chunk = os.urandom(65536)
+    sent = [0] * (len(ports) * connections)
+    deadline = time.monotonic() + duration
+
+    def client(slot, port):
+        with socket.create_connection(('127.0.0.1', port)) as s:
+            while time.monotonic() < deadline:
+                s.sendall(chunk)
+                sent[slot] += len(chunk)
+
+    threads = [threading.Thread(target=client, args=(i, port))
+               for i, port in enumerate(p for p in ports for _ in range(connections))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put(sum(sent))
+
+
+def relayed_bytes(url):
+    text = urllib.request.urlopen(url, timeout=10).read().decode()
+    return sum(float(m) for m in re.findall(r'^onvif_bridge_proxy_relayed_bytes_total\{[^}]*\} (\S+)$', text, re.M))
+
+
+def workers_reporting(url):
+    # Number of worker processes in the merged metrics
+    try:
+        text = urllib.request.urlopen(url, timeout=10).read().decode()
+    except OSError:
+        return 0
+    return len(set(re.findall(r'^onvif_bridge_proxy_active_connections\{process="(worker-\d+)"', text, re.M)))
+
+
+def run(processes, config_path, config, args):
+    ports = [conf['ports']['rtsp'] for conf in config['onvif']]
+    bridge = subprocess.Popen([sys.executable, MAIN, '--processes', str(processes), config_path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for conf in config['onvif']:
+            wait_for_port(conf['ports']['rtsp'], timeout=30)
+        if processes == 1:
+            metrics_url = f"http://127.0.0.1:{config['onvif'][0]['ports']['server']}/metrics"
+        else:
+            metrics_url = f"http://127.0.0.1:{config['metrics']['port']}/metrics"
+            # Every worker has to be listening before the load starts
+            deadline = time.time() + 30
+            while workers_reporting(metrics_url) < processes and time.time() < deadline:
+                time.sleep(0.2)
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        generators = [context.Process(target=push, args=(ports[i::args.load_processes], args.connections,
+                                                            args.duration, results))
+                      for i in range(args.load_processes)]
+        for g in generators:
+            g.start()
+        total = sum(results.get() for _ in generators)
+        for g in generators:
+            g.join()
+        # Let the relay drain what is still buffered before reading its counters
+        time.sleep(0.5)
+        reported = relayed_bytes(metrics_url)
+    finally:
+        bridge.terminate()
+        bridge.wait()
+    return {
+        'processes': processes,
+        'mbit_per_s': round(total * 8 / args.duration / 1e6, 1),
+        'reported_mb': round(reported / 1e6, 1),
+        'sent_mb': round(total / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-process relay throughput benchmark')
+    parser.add_argument('--cameras', type=int, default=16)
+    parser.add_argument('--processes', default=f"1,{max(2, os.cpu_count() or 1)}",
+                        help='comma separated worker process counts')
+    parser.add_argument('--connections', type=int, default=1, help='clients per camera')
+    parser.add_argument('--load-processes', type=int, default=max(2, os.cpu_count() or 1))
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--relay-mode', default='copy', choices=('copy', 'splice', 'auto'))
+    args = parser.parse_args()
+
+    sink_port = start_sink()
+    config_path = os.path.join(tempfile.mkdtemp(), 'config.yaml')
+    config = write_config(config_path, args.cameras, sink_port, args.relay_mode, free_port())
+
+    print(f"cores: {os.cpu_count()}, cameras: {args.cameras}, relay: {args.relay_mode}")
+    print(f"{'processes':>9} {'Mbit/s':>9} {'sent MB':>9} {'reported MB':>12}")
+    for processes in (int(p) for p in args.processes.split(',')):
+        r = run(processes, config_path, config, args)
+        print(f"{r['processes']:>9} {r['mbit_per_s']:>9} {r['sent_mb']:>9} {r['reported_mb']:>12}")
+
+
+if __name__ == '__main__':
+    main()
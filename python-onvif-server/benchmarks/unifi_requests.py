@@ -0,0 +1,105 @@
+"""SOAP request bodies shaped like the ones UniFi Protect sends while adopting
+and polling a camera: SOAP 1.2 envelope, WS-Security UsernameToken header and
+default-namespaced operations. The nonce and digest are fixed dummies since the
+bridge doesn't verify them.
+"""
+
+_ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope">'
+    '{header}'
+    '<s:Body xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">'
+    '{body}'
+    '</s:Body></s:Envelope>'
+)
+
+_SECURITY = (
+    '<s:Header>'
+    '<Security s:mustUnderstand="1" xmlns="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd">'
+    '<UsernameToken>'
+    '<Username>admin</Username>'
+    '<Password Type="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0#PasswordDigest">'
+    'dN0TX9kqJ6mI9qW0LsGm7eQmS5A=</Password>'
+    '<Nonce EncodingType="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-soap-message-security-1.0#Base64Binary">'
+    'bWFnaWNub25jZXZhbHVlMTIzNA==</Nonce>'
+    '<Created xmlns="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd">'
+    '2025-11-02T09:14:27Z</Created>'
+    '</UsernameToken>'
+    '</Security>'
+    '</s:Header>'
+)
+
+
+def _request(body, secure=True):
+    return _ENVELOPE.format(header=_SECURITY if secure else '', body=body).encode('utf-8')
+
+
+GET_SYSTEM_DATE_AND_TIME = _request('<GetSystemDateAndTime xmlns="http://www.onvif.org/ver10/device/wsdl"/>', secure=False)
+GET_CAPABILITIES = _request(
+    '<GetCapabilities xmlns="http://www.onvif.org/ver10/device/wsdl"><Category>All</Category></GetCapabilities>')
+GET_DEVICE_INFORMATION = _request('<GetDeviceInformation xmlns="http://www.onvif.org/ver10/device/wsdl"/>')
+GET_PROFILES = _request('<GetProfiles xmlns="http://www.onvif.org/ver10/media/wsdl"/>')
+GET_VIDEO_SOURCES = _request('<GetVideoSources xmlns="http://www.onvif.org/ver10/media/wsdl"/>')
+
+
+def get_stream_uri(token):
+    return _request(
+        '<GetStreamUri xmlns="http://www.onvif.org/ver10/media/wsdl">'
+        '<StreamSetup><Stream xmlns="http://www.onvif.org/ver10/schema">RTP-Unicast</Stream>'
+        '<Transport xmlns="http://www.onvif.org/ver10/schema"><Protocol>RTSP</Protocol></Transport></StreamSetup>'
+        f'<ProfileToken>{token}</ProfileToken>'
+        '</GetStreamUri>')
+
+
+def get_snapshot_uri(token):
+    return _request(
+        '<GetSnapshotUri xmlns="http://www.onvif.org/ver10/media/wsdl">'
+        f'<ProfileToken>{token}</ProfileToken>'
+        '</GetSnapshotUri>')
+
+
+# (path, action, body) in the order Protect issues them when adopting a camera
+ADOPTION_SEQUENCE = [
+    ('/onvif/device_service', 'GetSystemDateAndTime', GET_SYSTEM_DATE_AND_TIME),
+    ('/onvif/device_service', 'GetCapabilities', GET_CAPABILITIES),
+    ('/onvif/device_service', 'GetDeviceInformation', GET_DEVICE_INFORMATION),
+    ('/onvif/media_service', 'GetProfiles', GET_PROFILES),
+    ('/onvif/media_service', 'GetVideoSources', GET_VIDEO_SOURCES),
+    ('/onvif/media_service', 'GetStreamUri', get_stream_uri('main_stream')),
+    ('/onvif/media_service', 'GetStreamUri', get_stream_uri('sub_stream')),
+    ('/onvif/media_service', 'GetSnapshotUri', get_snapshot_uri('main_stream')),
+]
+
+
+
+def probe(message_id):
+    # WS-Discovery Probe for video transmitters, sent to udp/3702
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" '
+        'xmlns:a="http://schemas.xmlsoap.org/ws/2004/08/addressing">'
+        '<s:Header>'
+        '<a:Action s:mustUnderstand="1">http://schemas.xmlsoap.org/ws/2005/04/discovery/Probe</a:Action>'
+        f'<a:MessageID>uuid:{message_id}</a:MessageID>'
+        '<a:ReplyTo><a:Address>http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous</a:Address></a:ReplyTo>'
+        '<a:To s:mustUnderstand="1">urn:schemas-xmlsoap-org:ws:2005:04:discovery</a:To>'
+        '</s:Header>'
+        '<s:Body><Probe xmlns="http://schemas.xmlsoap.org/ws/2005/04/discovery">'
+        '<d:Types xmlns:d="http://schemas.xmlsoap.org/ws/2005/04/discovery" '
+        'xmlns:dp0="http://www.onvif.org/ver10/network/wsdl">dp0:NetworkVideoTransmitter</d:Types>'
+        '</Probe></s:Body></s:Envelope>'
+    ).encode('utf-8')
+
+
+TEST_CONFIG = {
+    'mac': '00:00:00:00:00:00',
+    'hostname': '127.0.0.1',
+    'ports': {'server': 8081, 'rtsp': 8555, 'snapshot': 8580},
+    'name': 'Bench Camera',
+    'uuid': '00000000-0000-4000-8000-000000000000',
+    'target': {'hostname': '127.0.0.1', 'ports': {'rtsp': 8554, 'snapshot': 80}},
+    'highQuality': {'rtsp': '/cam', 'snapshot': '/snap/hq', 'width': 1920, 'height': 1080,
+                    'framerate': 5, 'bitrate': 2000, 'quality': 4},
+    'lowQuality': {'rtsp': '/cam_sub', 'snapshot': '/snap/lq', 'width': 640, 'height': 360,
+                   'framerate': 5, 'bitrate': 500, 'quality': 1},
+}
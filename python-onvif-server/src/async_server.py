@@ -0,0 +1,461 @@
+import asyncio
+import http.client
+import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+
+from . import metrics, tracing
+from .onvif_server import (MAX_REQUEST_SIZE, SOAP_REQUEST_DURATION, WSDiscovery, debug_report, handle_soap,
+                           health_report)
+from .snapshot import FORWARD_REQUEST_HEADERS, FORWARD_RESPONSE_HEADERS, get_pool, load_placeholder
+from .tcp_proxy import ACCEPT_BACKLOG, ScratchProtocol, listen_socket
+
+logger = logging.getLogger('AsyncServer')
+
+# Request line and headers; SOAP bodies are capped by MAX_REQUEST_SIZE
+MAX_HEADER_SIZE = 16384
+# Threads for the few calls that block: snapshot fetches and mediamtx scrapes
+BLOCKING_THREADS = 4
+# Threads for requests forwarded by HTTP snapshot proxies, shared by all
+# cameras: an NVR fetches thumbnails of many cameras at once
+SNAPSHOT_PROXY_THREADS = 16
+SERVER_HEADER = f"{BaseHTTPRequestHandler.server_version} {BaseHTTPRequestHandler.sys_version}"
+# How long stopping waits for the loop
+STOP_TIMEOUT = 5
+SOAP_CONTENT_TYPE = 'application/soap+xml; charset=utf-8'
+
+_blocking = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix='Blocking')
+# Threads are only started once requests come in
+_snapshot_fetches = ThreadPoolExecutor(max_workers=SNAPSHOT_PROXY_THREADS, thread_name_prefix='SnapshotProxy')
+_date = {'second': None, 'value': ''}
+
+
+def _http_date():
+    # Formatted at most once a second
+    now = int(time.time())
+    if _date['second'] != now:
+        _date['second'] = now
+        _date['value'] = formatdate(now, usegmt=True)
+    return _date['value']
+
+
+def render_response(status, content_type, body, headers=(), close=False, length=None):
+    # length: Content-Length when it isn't the body's, e.g. a HEAD response
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+             f"Server: {SERVER_HEADER}",
+             f"Date: {_http_date()}"]
+    if content_type:
+        lines.append(f"Content-Type: {content_type}")
+    lines.append(f"Content-Length: {len(body) if length is None else length}")
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    if close:
+        lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+class _Request:
+    __slots__ = ('method', 'target', 'headers', 'body', 'keep_alive', 'trace')
+
+    def __init__(self, method, target, headers, body, keep_alive):
+        self.method = method
+        self.target = target
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+        self.trace = None
+
+
+class _HttpError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def parse_request(buf, pos, stop):
+    # Returns (request, end) for a complete request in buf[pos:stop], None if more data is needed
+    header_end = buf.find(b'\r\n\r\n', pos, min(stop, pos + MAX_HEADER_SIZE + 4))
+    if header_end < 0:
+        if stop - pos > MAX_HEADER_SIZE:
+            raise _HttpError(431)
+        return None
+    lines = buf[pos:header_end].decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ')
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise _HttpError(400)
+    method, target, version = parts
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise _HttpError(400)
+    if length < 0:
+        raise _HttpError(400)
+    if length > MAX_REQUEST_SIZE:
+        raise _HttpError(413)
+    end = header_end + 4 + length
+    if stop < end:
+        return None
+    connection = headers.get('connection', '').lower()
+    keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+    return _Request(method, target, headers, bytes(buf[header_end + 4:end]), keep_alive), end
+
+
+class _HttpProtocol(ScratchProtocol):
+    # One client connection; requests are answered in order by serve(), which
+    # only runs while there are any, so an idle keep-alive connection is just
+    # this object and its transport
+    __slots__ = ('server', 'loop', 'transport', 'requests', 'idle_handle', 'task', 'closed', 'client_ip')
+    # SOAP requests are traced, see tracing.py
+    traced = True
+
+    def __init__(self, server):
+        super().__init__(server.engine)
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.requests = []
+        self.idle_handle = None
+        self.task = None
+        self.closed = False
+        self.client_ip = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_ip = transport.get_extra_info('peername')[0]
+        server = self.server
+        if len(server.connections) >= server.max_connections:
+            logger.debug(f"Rejecting {self.client_ip}: {len(server.connections)} connections open")
+            self.closed = True
+            transport.abort()
+            return
+        server.connections.add(self)
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.touch()
+
+    def touch(self):
+        # Keep-alive connections are closed after idle_timeout seconds without a request
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        if self.server.idle_timeout:
+            self.idle_handle = self.loop.call_later(self.server.idle_timeout, self.close)
+
+    def feed(self, buf, stop):
+        if self.closed:
+            return None
+        pos = 0
+        while pos < stop:
+            try:
+                parsed = parse_request(buf, pos, stop)
+            except _HttpError as e:
+                # Framing is lost, answer after the requests already queued and hang up
+                self.queue(e)
+                self.transport.pause_reading()
+                return None
+            if parsed is None:
+                break
+            request, pos = parsed
+            if request.method == 'POST' and self.traced:
+                # Starts with the complete request, the first span is its wait for serve()
+                request.trace = tracing.begin(self.client_ip, request.target)
+            self.queue(request)
+        return pos
+
+    def queue(self, request):
+        self.requests.append(request)
+        if self.task is None:
+            self.task = self.loop.create_task(self.serve())
+
+    def connection_lost(self, exc):
+        self.close()
+
+    async def serve(self):
+        try:
+            await self._serve()
+        finally:
+            self.task = None
+
+    async def _serve(self):
+        while self.requests and not self.closed:
+            request = self.requests.pop(0)
+            trace = request.trace
+            if trace is not None:
+                trace.mark('queued')
+            self.touch()
+            if isinstance(request, _HttpError):
+                self.transport.write(render_response(request.status, 'text/plain', b'', close=True))
+                self.close()
+                return
+            length = None
+            try:
+                status, content_type, body, headers = await self.handle(request)
+                if request.method == 'HEAD':
+                    # No body, the handler passes on the length a GET would have
+                    length = next((value for name, value in headers if name == 'Content-Length'), None)
+                    headers = [(name, value) for name, value in headers if name != 'Content-Length']
+            except Exception as e:
+                logger.error(f"{request.method} {request.target} failed: {e}")
+                status, content_type, body, headers = 500, 'text/plain', b'', ()
+            if self.closed:
+                return
+            self.transport.write(render_response(status, content_type, body, headers, close=not request.keep_alive,
+                                                 length=length))
+            if trace is not None:
+                trace.mark('write')
+                trace.finish()
+            if not request.keep_alive:
+                self.close()
+
+    async def handle(self, request):
+        if request.method == 'POST':
+            started = time.perf_counter()
+            # Read once, a config reload swaps it from another thread
+            instance = self.server.onvif_instance
+            response, action = handle_soap(instance, request.target, request.body, self.client_ip, request.trace)
+            SOAP_REQUEST_DURATION.observe(time.perf_counter() - started, action)
+            return 200, SOAP_CONTENT_TYPE, response, ()
+        if request.method != 'GET':
+            return 501, 'text/plain', b'', ()
+
+        path, _, query = request.target.partition('?')
+        if path == '/metrics' and metrics.settings['enabled']:
+            # May scrape mediamtx
+            text = await self.loop.run_in_executor(_blocking, metrics.render)
+            return 200, 'text/plain; version=0.0.4; charset=utf-8', text.encode('utf-8'), ()
+        if path == '/health':
+            status, body = health_report()
+            return status, 'application/json', body, ()
+        if path.startswith('/debug/'):
+            status, body = debug_report(path, query)
+            return status, 'application/json' if status != 404 else 'text/plain', body, ()
+        if path.startswith('/snapshot/'):
+            return await self.snapshot(path[len('/snapshot/'):], request)
+        if path == '/snapshot.png':
+            try:
+                snapshot = load_placeholder()
+            except FileNotFoundError:
+                return 404, 'text/plain', b'Snapshot not found', ()
+            return 200, snapshot.content_type, snapshot.data, ()
+        return 404, 'text/plain', b'', ()
+
+    async def snapshot(self, token, request):
+        instance = self.server.onvif_instance
+        try:
+            # Fetches from the camera on a cache miss
+            snapshot = await self.loop.run_in_executor(_blocking, instance.get_snapshot, token)
+        except KeyError:
+            return 404, 'text/plain', b'Snapshot not found', ()
+        except Exception as e:
+            logger.debug(f"Snapshot for {token} failed: {e}")
+            return 502, 'text/plain', b'Snapshot unavailable', ()
+
+        headers = (('ETag', snapshot.etag),
+                   ('Cache-Control', f"max-age={instance.snapshot_cache.max_age(snapshot)}"))
+        if request.headers.get('if-none-match') == snapshot.etag:
+            return 304, None, b'', headers
+        return 200, snapshot.content_type, snapshot.data, headers
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.connections.discard(self)
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        if self.task is not None and self.task is not asyncio.current_task(self.loop):
+            self.task.cancel()
+        self.transport.close()
+
+
+class AsyncOnvifServer:
+    # asyncio counterpart of OnvifHTTPServer, served on the proxy engine's
+    # event loop: no thread per connection, SOAP responses are built right on
+    # the loop and only snapshot fetches go to a small thread pool.
+    def __init__(self, engine, server_address, onvif_instance, max_connections=64, idle_timeout=30,
+                 reuse_port=False):
+        self.engine = engine
+        self.loop = engine.loop
+        self.onvif_instance = onvif_instance
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connections = set()
+        self.server = None
+
+        # Bound right away, so a port conflict raises here like OnvifHTTPServer
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.sock.bind(server_address)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def start(self):
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self):
+        self.server = await self.loop.create_server(lambda: _HttpProtocol(self), sock=self.sock, backlog=128)
+
+    def close(self):
+        # Stops accepting and closes open keep-alive connections
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(STOP_TIMEOUT)
+
+    async def _close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        else:
+            self.sock.close()
+        for conn in list(self.connections):
+            conn.close()
+
+
+class _SnapshotProxyProtocol(_HttpProtocol):
+    # One client of a SnapshotProxyListener
+    __slots__ = ()
+    traced = False
+
+    async def handle(self, request):
+        listener = self.server
+        if request.method not in ('GET', 'HEAD'):
+            return 501, 'text/plain', b'', ()
+        if not listener.target.healthy:
+            # Fast fail instead of waiting on a dead camera
+            listener.rejected += 1
+            return 503, 'text/plain', b'', ()
+        headers = {name: request.headers[name.lower()] for name in FORWARD_REQUEST_HEADERS
+                   if name.lower() in request.headers}
+        try:
+            resp, body = await self.loop.run_in_executor(_snapshot_fetches, listener.pool.request, request.method,
+                                                         request.target, headers)
+        except (http.client.HTTPException, OSError) as e:
+            logger.debug(f"Snapshot proxy to {listener.dst_host}:{listener.dst_port} failed: {e}")
+            listener.connect_failures += 1
+            return 502, 'text/plain', b'', ()
+        try:
+            HTTPStatus(resp.status)
+        except ValueError:
+            # render_response needs a status it knows the phrase of
+            return 502, 'text/plain', b'', ()
+        listener.bytes_relayed += len(body)
+        names = FORWARD_RESPONSE_HEADERS + ('Content-Length',) if request.method == 'HEAD' else FORWARD_RESPONSE_HEADERS
+        forwarded = [(name, resp.getheader(name)) for name in names]
+        return resp.status, None, body, [(name, value) for name, value in forwarded if value is not None]
+
+
+class SnapshotProxyListener:
+    # HTTP-aware alternative to the TCP proxy for a camera's snapshot port, a
+    # listener_class for ProxyEngine.add_proxy: requests go out over the
+    # camera's pooled keep-alive connections from a fixed set of threads, so
+    # clients don't get a thread each
+    max_connections = 64
+    idle_timeout = 30
+
+    def __init__(self, engine, src_port, dst_host, dst_port):
+        self.engine = engine
+        self.loop = engine.loop
+        self.src_port = src_port
+        self.dst_host = dst_host
+        self.dst_port = dst_port
+        self.pool = get_pool(dst_host, dst_port)
+        self.connections = set()
+        self.server = None
+        self.closed = False
+        self.bytes_relayed = 0
+        self.connect_failures = 0
+        self.rejected = 0
+        self.limited = 0
+        self.throttled_bytes = 0
+        self.bucket = engine.port_bucket(src_port)
+        self.target = engine.get_target(dst_host, dst_port)
+        self.released = False
+
+    @property
+    def active(self):
+        return len(self.connections)
+
+    def start(self):
+        sock = listen_socket(self.engine, self.src_port)
+        self.loop.create_task(self._serve(sock))
+        logger.info(f"HTTP Snapshot Proxy started: Local :{self.src_port} -> {self.dst_host}:{self.dst_port}")
+
+    async def _serve(self, sock):
+        self.server = await self.loop.create_server(lambda: _SnapshotProxyProtocol(self), sock=sock,
+                                                    backlog=ACCEPT_BACKLOG)
+        if self.closed:
+            self.server.close()
+
+    def close(self):
+        # Stops accepting, open keep-alive connections run until idle
+        self.closed = True
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        if not self.released:
+            self.released = True
+            self.engine.release_target(self.target)
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, discovery):
+        self.discovery = discovery
+
+    def datagram_received(self, data, addr):
+        try:
+            self.discovery.datagram_received(data, addr)
+        except Exception as e:
+            logger.error(f"Discovery error: {e}")
+
+    def error_received(self, exc):
+        logger.debug(f"Discovery socket error: {exc}")
+
+
+class AsyncWSDiscovery(WSDiscovery):
+    # WSDiscovery on the proxy engine's event loop instead of a receive thread
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        self.transport = None
+
+    def start(self):
+        try:
+            asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        except OSError as e:
+            logger.error(f"Discovery failed to start: {e}")
+
+    async def _start(self):
+        self.bind()
+        self.sock.setblocking(False)
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: _DiscoveryProtocol(self), sock=self.sock)
+        self.running = True
+        for device in self.devices.values():
+            self.send_announcement(device, 'hello')
+
+    def stop(self):
+        if self.running:
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result(STOP_TIMEOUT)
+
+    async def _stop(self):
+        for device in self.devices.values():
+            self.send_announcement(device, 'bye')
+        self.running = False
+        # Flushes the byes before the socket closes
+        self.transport.close()
+
+    def announce(self, device, kind):
+        # Called from reloads on other threads, only the loop touches the socket
+        self.loop.call_soon_threadsafe(self.send_announcement, device, kind)
+
+    def send_announcement(self, device, kind):
+        super().announce(device, kind)
+
+    def sendto(self, data, addr):
+        self.transport.sendto(data, addr)
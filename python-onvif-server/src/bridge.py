@@ -0,0 +1,307 @@
+import copy
+import logging
+import threading
+
+from . import metrics, netinfo, profile_policy, profiler, tracing
+from .async_server import AsyncOnvifServer, AsyncWSDiscovery, SnapshotProxyListener
+from .onvif_server import OnvifServerInstance, OnvifHTTPServer, WSDiscovery
+from .rtsp_proxy import RtspListener, configure_gop_cache, configure_ring
+from .snapshot import configure_pools, get_pool
+from .tcp_proxy import ProxyEngine
+
+logger = logging.getLogger('Bridge')
+
+
+class _Camera:
+    def __init__(self, raw, instance, httpd):
+        # The config as read from YAML, OnvifServerInstance fills in the hostname on its own copy
+        self.raw = raw
+        self.instance = instance
+        self.httpd = httpd
+
+
+def _binding(conf):
+    # Changing any of these needs a new listening socket. Without a hostname
+    # the camera follows the address of its MAC's interface.
+    return conf['mac'], conf.get('hostname') or netinfo.lookup(conf['mac']), conf['ports']['server']
+
+
+class Bridge:
+    # Owns everything started from the config and can apply a changed config
+    # in place: only cameras and proxies that differ are touched, connections
+    # on unchanged proxy ports keep running.
+    # A supervisor worker runs without discovery (the supervisor answers for
+    # all cameras) and with reuse_port, as other workers may bind the same ports.
+    # With `http.server: async` (the default) SOAP servers and discovery share
+    # the proxy engine's event loop, so the thread count doesn't grow with
+    # cameras or clients; `threaded` keeps a thread per connection.
+    def __init__(self, discovery=True, reuse_port=False):
+        self.config = None
+        self.cameras = {}
+        self.proxies = {}
+        self.prewarmed = set()
+        self.use_discovery = discovery
+        self.discovery = None
+        self.async_http = True
+        self.reuse_port = reuse_port
+        self.proxy_engine = None
+        self.in_flight = None
+        self.in_flight_size = None
+        # Reloads and address changes apply from different threads
+        self.lock = threading.Lock()
+
+    def start(self, config):
+        proxy_conf = config.get('proxy') or {}
+        self.proxy_engine = ProxyEngine(relay_mode=proxy_conf.get('relayMode', 'auto'), reuse_port=self.reuse_port)
+        self.proxy_engine.daemon = True
+        self.configure_engine(proxy_conf)
+        self.proxy_engine.start()
+
+        self.async_http = (config.get('http') or {}).get('server', 'async') == 'async'
+        if self.use_discovery:
+            self.discovery = AsyncWSDiscovery(self.proxy_engine.loop) if self.async_http else WSDiscovery()
+
+        self.apply(config)
+        netinfo.subscribe(self.on_address_change)
+        netinfo.watch()
+
+        if isinstance(self.discovery, AsyncWSDiscovery):
+            self.discovery.start()
+        elif self.discovery is not None:
+            t_discovery = threading.Thread(target=self.discovery.start)
+            t_discovery.daemon = True
+            t_discovery.start()
+
+    def stop(self):
+        # Let NVRs know the cameras are gone
+        if self.discovery is not None:
+            self.discovery.stop()
+        with self.lock:
+            for uuid in list(self.cameras):
+                self.stop_camera(uuid)
+        # Closes the proxies and their connections
+        self.proxy_engine.stop()
+        self.proxy_engine.join(5)
+
+    def apply(self, config):
+        with self.lock:
+            self._apply(config)
+
+    def dump_traces(self):
+        # SIGUSR1: the request trace ring, empty unless `debug.tracing` is on
+        try:
+            path, count = tracing.dump()
+        except OSError as e:
+            logger.error(f"Writing request traces failed: {e}")
+            return
+        logger.info(f"Wrote {count} request traces to {path}")
+
+    def profile(self):
+        # SIGUSR2: profiles for `debug.profileSeconds`, with or without `debug.profiling`
+        try:
+            profiler.start()
+        except RuntimeError as e:
+            logger.warning(f"Not profiling: {e}")
+
+    def on_address_change(self, macs):
+        # Cameras on a changed interface are restarted on the new address, so
+        # every cached response and discovery message is rendered again
+        if self.config is not None:
+            self.apply(self.config)
+
+    def _apply(self, config):
+        # Everything that can reject the config runs first, so a failed reload
+        # leaves the running cameras and proxies as they were
+        instances = self.build_instances(config['onvif'])
+        debug_conf = config.get('debug') or {}
+        profiler.configure(enabled=debug_conf.get('profiling', False), mode=debug_conf.get('profileMode', 'sample'),
+                           seconds=debug_conf.get('profileSeconds', 30), directory=debug_conf.get('dumpDir'),
+                           loop=self.proxy_engine.loop if self.proxy_engine is not None else None)
+        policy_conf = config.get('profilePolicy') or {}
+        # Throughput marks are configured in kbit/s, the policy counts bytes
+        throughput_low = policy_conf.get('throughputLow')
+        profile_policy.configure(enabled=policy_conf.get('enabled', False),
+                                 throughput_high=policy_conf.get('throughputHigh', 0) * 125,
+                                 throughput_low=None if throughput_low is None else throughput_low * 125,
+                                 cpu_high=policy_conf.get('cpuHigh', 0),
+                                 cpu_low=policy_conf.get('cpuLow'),
+                                 interval=policy_conf.get('interval', 5),
+                                 hold_time=policy_conf.get('holdTime', 30),
+                                 classes=[(c['name'], c.get('networks') or [], c.get('profile', 'adaptive'))
+                                          for c in policy_conf.get('classes') or []],
+                                 default_profile=policy_conf.get('defaultProfile', 'adaptive'),
+                                 loop=self.proxy_engine.loop if self.proxy_engine is not None else None)
+
+        metrics_conf = config.get('metrics') or {}
+        metrics.configure(enabled=metrics_conf.get('enabled', True),
+                          scrape_urls=[metrics_conf['mediamtx']] if metrics_conf.get('mediamtx') else [])
+        tracing.configure(enabled=debug_conf.get('tracing', False), size=debug_conf.get('traceSize', 256),
+                          directory=debug_conf.get('dumpDir'))
+
+        proxy_conf = config.get('proxy') or {}
+        configure_pools(size=proxy_conf.get('snapshotPoolSize', 2))
+        if self.proxy_engine is not None:
+            self.configure_engine(proxy_conf)
+        configure_gop_cache(enabled=proxy_conf.get('gopCache', True),
+                            max_bytes=proxy_conf.get('gopCacheMaxBytes', 4 * 1024 * 1024),
+                            total_bytes=proxy_conf.get('gopCacheTotalBytes', 32 * 1024 * 1024))
+        configure_ring(max_bytes=proxy_conf.get('rtspRingBytes', 4 * 1024 * 1024))
+        if self.config is not None:
+            old_relay_mode = (self.config.get('proxy') or {}).get('relayMode', 'auto')
+            if proxy_conf.get('relayMode', 'auto') != old_relay_mode:
+                logger.warning("proxy.relayMode changes take effect after a restart")
+            old_server = (self.config.get('http') or {}).get('server', 'async')
+            if (config.get('http') or {}).get('server', 'async') != old_server:
+                logger.warning("http.server changes take effect after a restart")
+
+        # Shared by the SOAP servers of all cameras
+        http_conf = config.get('http') or {}
+        max_in_flight = http_conf.get('maxInFlight', 8)
+        if max_in_flight != self.in_flight_size:
+            self.in_flight = threading.BoundedSemaphore(max_in_flight)
+            self.in_flight_size = max_in_flight
+        self.apply_cameras(config['onvif'], http_conf, instances)
+        self.apply_proxies(config)
+        self.config = config
+
+    def configure_engine(self, proxy_conf):
+        # Rate limits are configured in kbit/s like the camera bitrates, the engine counts bytes
+        port_rates = proxy_conf.get('portRateLimits') or {}
+        self.proxy_engine.configure(connect_timeout=proxy_conf.get('connectTimeout', 10),
+                                    idle_timeout=proxy_conf.get('idleTimeout', 0),
+                                    health_interval=proxy_conf.get('healthCheckInterval', 10),
+                                    failure_threshold=proxy_conf.get('healthCheckFailures', 3),
+                                    port_rate_limit=proxy_conf.get('portRateLimit', 0) * 125,
+                                    port_rate_limits={int(port): rate * 125 for port, rate in port_rates.items()},
+                                    client_rate_limit=proxy_conf.get('clientRateLimit', 0) * 125,
+                                    rate_burst=proxy_conf.get('rateBurst', 1),
+                                    max_target_connections=proxy_conf.get('maxTargetConnections', 0))
+
+    def build_instances(self, onvif_confs):
+        # Instances for new, changed and moved cameras, built before any camera
+        # is stopped: one the instance rejects (e.g. a bad snapshot source)
+        # fails the whole reload
+        instances = {}
+        for conf in onvif_confs:
+            camera = self.cameras.get(conf['uuid'])
+            if camera is None or conf != camera.raw or _binding(conf) != _binding(camera.instance.config):
+                instances[conf['uuid']] = OnvifServerInstance(copy.deepcopy(conf))
+        return instances
+
+    def apply_cameras(self, onvif_confs, http_conf, instances):
+        desired = {conf['uuid']: conf for conf in onvif_confs}
+
+        # Free ports first, a moved camera may reuse one in the same reload
+        for uuid, camera in list(self.cameras.items()):
+            conf = desired.get(uuid)
+            if conf is None or _binding(conf) != _binding(camera.instance.config):
+                self.stop_camera(uuid)
+
+        for uuid, conf in desired.items():
+            camera = self.cameras.get(uuid)
+            if camera is None:
+                self.start_camera(conf, http_conf, instances[uuid])
+            elif conf != camera.raw:
+                self.update_camera(camera, conf, instances[uuid])
+
+        for camera in self.cameras.values():
+            if not self.async_http:
+                camera.httpd.in_flight = self.in_flight
+            camera.httpd.max_connections = http_conf.get('maxConnections', 64)
+            camera.httpd.idle_timeout = http_conf.get('idleTimeout', 30)
+
+    def start_camera(self, conf, http_conf, server_instance):
+        raw = copy.deepcopy(conf)
+
+        if not server_instance.config['hostname']:
+            logger.error(f"Could not determine IP for MAC {conf['mac']}")
+            return
+
+        address = (server_instance.config['hostname'], conf['ports']['server'])
+        try:
+            if self.async_http:
+                httpd = AsyncOnvifServer(self.proxy_engine, address, server_instance,
+                                         max_connections=http_conf.get('maxConnections', 64),
+                                         idle_timeout=http_conf.get('idleTimeout', 30),
+                                         reuse_port=self.reuse_port)
+            else:
+                httpd = OnvifHTTPServer(address, server_instance, self.in_flight,
+                                        max_connections=http_conf.get('maxConnections', 64),
+                                        idle_timeout=http_conf.get('idleTimeout', 30),
+                                        reuse_port=self.reuse_port)
+        except OSError as e:
+            logger.error(f"ONVIF Server for {conf['name']} failed to start: {e}")
+            return
+
+        if self.async_http:
+            httpd.start()
+        else:
+            t_server = threading.Thread(target=httpd.serve_forever)
+            t_server.daemon = True
+            t_server.start()
+        logger.info(f"Started ONVIF Server for {conf['name']} at {server_instance.config['hostname']}:{conf['ports']['server']}")
+
+        if self.discovery is not None:
+            self.discovery.add_device(server_instance.config)
+        self.cameras[conf['uuid']] = _Camera(raw, server_instance, httpd)
+
+    def update_camera(self, camera, conf, server_instance):
+        raw = copy.deepcopy(conf)
+        # Requests pick up the instance once, so swapping it never mixes old and new responses
+        camera.httpd.onvif_instance = server_instance
+        if conf['name'] != camera.raw['name'] and self.discovery is not None:
+            self.discovery.add_device(server_instance.config)
+        camera.raw = raw
+        camera.instance = server_instance
+        logger.info(f"Reloaded ONVIF Server for {conf['name']}")
+
+    def stop_camera(self, uuid):
+        camera = self.cameras.pop(uuid)
+        if self.discovery is not None:
+            self.discovery.remove_device(uuid)
+        if self.async_http:
+            camera.httpd.close()
+        else:
+            camera.httpd.shutdown()
+            camera.httpd.server_close()
+        logger.info(f"Stopped ONVIF Server for {camera.raw['name']}")
+
+    def apply_proxies(self, config):
+        proxy_conf = config.get('proxy') or {}
+        snapshot_mode = proxy_conf.get('snapshotMode', 'tcp')
+        rtsp_listener = RtspListener if proxy_conf.get('rtspMode', 'tcp') == 'mux' else None
+        snapshot_listener = SnapshotProxyListener if snapshot_mode == 'http' else None
+        proxies = {}
+        for onvif_conf in config['onvif']:
+            if onvif_conf['uuid'] not in self.cameras:
+                continue
+            target = onvif_conf['target']
+            if onvif_conf['ports'].get('rtsp') and target['ports'].get('rtsp'):
+                proxies[onvif_conf['ports']['rtsp']] = (target['hostname'], target['ports']['rtsp'], rtsp_listener)
+
+            if onvif_conf['ports'].get('snapshot') and target['ports'].get('snapshot'):
+                proxies[onvif_conf['ports']['snapshot']] = (target['hostname'], target['ports']['snapshot'],
+                                                            snapshot_listener)
+
+        for src_port, dst in list(self.proxies.items()):
+            if proxies.get(src_port) != dst:
+                self.proxy_engine.remove_proxy(src_port)
+                del self.proxies[src_port]
+
+        # TCP relays, RTSP mux and HTTP snapshot proxies, all served from a single event loop thread
+        for src_port, (dst_host, dst_port, listener_class) in proxies.items():
+            if src_port not in self.proxies:
+                self.proxy_engine.add_proxy(src_port, dst_host, dst_port, listener_class)
+                self.proxies[src_port] = (dst_host, dst_port, listener_class)
+
+        # Open the pooled connections of cameras whose snapshots go through a
+        # pool (HTTP snapshot proxy, snapshot cache fetching over HTTP), so an
+        # NVR asking for thumbnails right after startup doesn't wait for connects
+        snapshot_targets = {(dst_host, dst_port) for dst_host, dst_port, listener_class in proxies.values()
+                             if listener_class is SnapshotProxyListener}
+        for camera in self.cameras.values():
+            snapshot_targets.update(source.http_target for source in camera.instance.snapshot_sources.values()
+                                    if source.source == 'http')
+        for (dst_host, dst_port) in snapshot_targets - self.prewarmed:
+            threading.Thread(target=get_pool(dst_host, dst_port).prewarm, daemon=True).start()
+        self.prewarmed |= snapshot_targets
@@ -1,37 +1,117 @@
+import asyncio
+import copy
+import ipaddress
+import logging
+import socket
+import threading
 import uuid
-from onvif import ONVIFCamera
+from concurrent.futures import ThreadPoolExecutor
+from onvif import ONVIFCamera, ONVIFService
+from onvif.client import UsernameDigestTokenDtDiff
 from urllib.parse import urlparse
+from zeep.client import CachingClient, Settings
+from zeep.transports import Transport
+
+logger = logging.getLogger('ConfigBuilder')
+
+# Default first ports handed out in generated configs
+SERVER_PORT = 8081
+RTSP_PORT = 8554
+SNAPSHOT_PORT = 8580
 
 def extract_path(url):
     parsed = urlparse(url)
     return parsed.path
 
-async def create_config(hostname, username, password):
-    # Determine port
-    port = 80
-    host_clean = hostname
+def split_host(hostname, default_port=80):
     if ':' in hostname:
-        parts = hostname.split(':')
-        host_clean = parts[0]
-        port = int(parts[1])
+        host, port = hostname.rsplit(':', 1)
+        return host, int(port)
+    return hostname, default_port
+
+def expand_targets(specs, default_port=80):
+    # Accepts "host", "host:port" and CIDR subnets such as "192.168.1.0/24"
+    targets = []
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        if '/' in spec:
+            network, _, port = spec.partition(':')
+            for addr in ipaddress.ip_network(network, strict=False).hosts():
+                targets.append((str(addr), int(port) if port else default_port, True))
+        else:
+            host, port = split_host(spec, default_port)
+            targets.append((host, port, False))
+    return targets
+
+class _ClientCache:
+    # Parsing the ONVIF WSDLs is the slowest part of talking to a camera, so
+    # every camera gets a shallow copy of one parsed zeep client per WSDL with
+    # its own credentials and HTTP transport
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def client(self, wsdl_file, wsse, timeout):
+        with self.lock:
+            template = self.templates.get(wsdl_file)
+            if template is None:
+                settings = Settings()
+                settings.strict = False
+                settings.xml_huge_tree = True
+                template = self.templates[wsdl_file] = CachingClient(wsdl=wsdl_file, settings=settings)
+        client = copy.copy(template)
+        client.wsse = wsse
+        client.transport = Transport(timeout=timeout, operation_timeout=timeout)
+        return client
 
+_client_cache = _ClientCache()
+
+class _CachedONVIFCamera(ONVIFCamera):
+    timeout = 10
+
+    def create_onvif_service(self, name, from_template=True, portType=None):
+        name = name.lower()
+        xaddr, wsdl_file, binding_name = self.get_definition(name, portType)
+        wsse = UsernameDigestTokenDtDiff(self.user, self.passwd, dt_diff=self.dt_diff, use_digest=self.encrypt)
+        zeep_client = _client_cache.client(wsdl_file, wsse, self.timeout)
+
+        with self.services_lock:
+            service = ONVIFService(xaddr, self.user, self.passwd, wsdl_file, self.encrypt, self.daemon,
+                                   zeep_client=zeep_client, portType=portType, dt_diff=self.dt_diff,
+                                   binding_name=binding_name)
+            self.services[name] = service
+            setattr(self, name, service)
+            if not self.services_template.get(name):
+                self.services_template[name] = service
+        return service
+
+def _port_open(host, port, timeout):
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+def probe_camera(host_clean, port, username, password, camera_class=ONVIFCamera):
     # Connect to Camera
-    my_cam = ONVIFCamera(host_clean, port, username, password)
+    my_cam = camera_class(host_clean, port, username, password)
     media_service = my_cam.create_media_service()
-    
+
     profiles = media_service.GetProfiles()
-    
+
     cameras = {}
-    
+
     for profile in profiles:
         video_source = profile.VideoSourceConfiguration.SourceToken
-        
+
         if video_source not in cameras:
             cameras[video_source] = []
 
         # Get Snapshot URI
         snapshot_resp = media_service.GetSnapshotUri({'ProfileToken': profile.token})
-        
+
         # Get Stream URI
         stream_setup = {'Stream': 'RTP-Unicast', 'Transport': {'Protocol': 'RTSP'}}
         stream_resp = media_service.GetStreamUri({'StreamSetup': stream_setup, 'ProfileToken': profile.token})
@@ -41,13 +121,12 @@ async def create_config(hostname, username, password):
         profile.snapshotUri = snapshot_resp.Uri
         cameras[video_source].append(profile)
 
-    config = {'onvif': []}
-    server_port = 8081
+    camera_configs = []
 
     for source_token, profile_list in cameras.items():
         if not profile_list:
             continue
-            
+
         # Logic to find Main (High) and Sub (Low) streams
         main_stream = profile_list[0]
         sub_stream = profile_list[1] if len(profile_list) > 1 else profile_list[0]
@@ -55,7 +134,7 @@ async def create_config(hostname, username, password):
         swap_streams = False
         mq = main_stream.VideoEncoderConfiguration.Quality
         sq = sub_stream.VideoEncoderConfiguration.Quality
-        
+
         if sq > mq:
             swap_streams = True
         elif sq == mq:
@@ -63,16 +142,16 @@ async def create_config(hostname, username, password):
             sw = sub_stream.VideoEncoderConfiguration.Resolution.Width
             if sw > mw:
                 swap_streams = True
-        
+
         if swap_streams:
             main_stream, sub_stream = sub_stream, main_stream
 
         camera_config = {
             'mac': '<ONVIF PROXY MAC ADDRESS HERE>',
             'ports': {
-                'server': server_port,
-                'rtsp': 8554,
-                'snapshot': 8580
+                'server': None,
+                'rtsp': None,
+                'snapshot': None
             },
             'name': main_stream.VideoSourceConfiguration.Name,
             'uuid': str(uuid.uuid4()),
@@ -102,8 +181,60 @@ async def create_config(hostname, username, password):
                 }
             }
         }
-        
-        config['onvif'].append(camera_config)
-        server_port += 1
 
-    return config
\ No newline at end of file
+        camera_configs.append(camera_config)
+
+    return camera_configs
+
+def assign_ports(camera_configs):
+    # Every camera gets its own SOAP port; RTSP and snapshot listeners are
+    # shared by the channels of one target but must differ between targets
+    used = set()
+    target_ports = {}
+
+    def take(start):
+        port = start
+        while port in used:
+            port += 1
+        used.add(port)
+        return port
+
+    for camera_config in camera_configs:
+        camera_config['ports']['server'] = take(SERVER_PORT)
+    for camera_config in camera_configs:
+        target = camera_config['target']['hostname']
+        if target not in target_ports:
+            target_ports[target] = (take(RTSP_PORT), take(SNAPSHOT_PORT))
+        camera_config['ports']['rtsp'], camera_config['ports']['snapshot'] = target_ports[target]
+    return {'onvif': camera_configs}
+
+async def create_config(hostname, username, password):
+    # Determine port
+    host_clean, port = split_host(hostname)
+    loop = asyncio.get_running_loop()
+    camera_configs = await loop.run_in_executor(None, probe_camera, host_clean, port, username, password)
+    return assign_ports(camera_configs)
+
+async def create_batch_config(specs, username, password, workers=8, timeout=10):
+    # Probe many cameras at once; the blocking onvif-zeep calls run on a
+    # bounded thread pool and share parsed WSDLs
+    targets = expand_targets(specs)
+    loop = asyncio.get_running_loop()
+    _CachedONVIFCamera.timeout = timeout
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        async def probe(host, port, scanned):
+            # Hosts from a subnet scan are checked for an open port before
+            # spending a WSDL round-trip on them
+            if scanned and not await loop.run_in_executor(executor, _port_open, host, port, 1):
+                return []
+            try:
+                return await loop.run_in_executor(executor, probe_camera, host, port, username, password,
+                                                  _CachedONVIFCamera)
+            except Exception as e:
+                logger.warning(f"Skipping {host}:{port}: {e}")
+                return []
+
+        results = await asyncio.gather(*(probe(*target) for target in targets))
+
+    return assign_ports([camera_config for result in results for camera_config in result])
@@ -0,0 +1,230 @@
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger('Metrics')
+
+PREFIX = 'onvif_bridge_'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics = self.metrics + [metric]
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            _render_family(lines, metric.name, metric.documentation, metric.type, metric.collect())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        # Plain tuples, so another process can merge them (see render_merged)
+        return [(metric.name, metric.documentation, metric.type, list(metric.collect()))
+                for metric in self.metrics]
+
+
+REGISTRY = Registry()
+
+# Set from the `metrics` config section
+settings = {'enabled': True, 'scrape_urls': []}
+
+
+def configure(enabled=True, scrape_urls=()):
+    settings.update(enabled=enabled, scrape_urls=list(scrape_urls))
+
+
+def _render_family(lines, name, documentation, type, samples):
+    lines.append(f"# HELP {name} {documentation}")
+    lines.append(f"# TYPE {name} {type}")
+    for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{k}="{str(v)}"' for k, v in labels)
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Sharded:
+    # Each thread updates its own dict, scrapes merge them. Updates never take
+    # a lock and never contend; only the first update from a thread registers
+    # its shard. Shards of threads that have exited (one per connection with
+    # the threaded SOAP server) are folded into a base dict, so they don't
+    # pile up.
+    def __init__(self, name, documentation, labelnames):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._base = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold_finished()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _fold_finished(self):
+        # Called with the lock held, a finished thread no longer touches its shard
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+                continue
+            for labels, value in shard.items():
+                self._fold(labels, value)
+        self._shards = live
+
+    def _merged(self):
+        with self._lock:
+            self._fold_finished()
+            shards = [self._base.copy()] + [shard for _, shard in self._shards]
+        merged = {}
+        for shard in shards:
+            for labels, value in shard.copy().items():
+                merged.setdefault(labels, []).append(value)
+        return merged
+
+    def _labels(self, values):
+        return tuple(zip(self.labelnames, values))
+
+
+class Counter(_Sharded):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _fold(self, labels, value):
+        self._base[labels] = self._base.get(labels, 0) + value
+
+    def collect(self):
+        merged = self._merged()
+        if not merged and not self.labelnames:
+            yield '', (), 0
+        for labels, values in merged.items():
+            yield '', self._labels(labels), sum(values)
+
+
+class Histogram(_Sharded):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # Per-bucket counts followed by the running sum
+            state = shard[labels] = [0] * (len(self.buckets) + 2)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def _fold(self, labels, value):
+        state = self._base.get(labels)
+        if state is None:
+            self._base[labels] = list(value)
+        else:
+            for i, v in enumerate(value):
+                state[i] += v
+
+    def collect(self):
+        for labels, states in self._merged().items():
+            base = self._labels(labels)
+            counts = [sum(s[i] for s in states) for i in range(len(self.buckets) + 1)]
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', base + (('le', bound),), cumulative
+            cumulative += counts[-1]
+            yield '_bucket', base + (('le', '+Inf'),), cumulative
+            yield '_sum', base, sum(s[-1] for s in states)
+            yield '_count', base, cumulative
+
+
+class CallbackMetric:
+    # Values read at scrape time from state owned by a single thread,
+    # e.g. the proxy engine's per-listener counters
+    def __init__(self, name, documentation, type, callback):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.type = type
+        self.callback = callback
+
+    def collect(self):
+        for labels, value in self.callback():
+            yield '', labels, value
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def callback(name, documentation, type, fn):
+    return REGISTRY.register(CallbackMetric(name, documentation, type, fn))
+
+
+def render():
+    return REGISTRY.render() + _scrape()
+
+
+def snapshot():
+    return REGISTRY.snapshot()
+
+
+def render_merged(snapshots, label='process'):
+    # One exposition for several processes: (source, snapshot) pairs, every
+    # sample gets a `label` naming the process it came from
+    families = {}
+    for source, metric_snapshot in snapshots:
+        for name, documentation, type, samples in metric_snapshot:
+            family = families.setdefault(name, (documentation, type, []))
+            family[2].extend((suffix, ((label, source),) + tuple(labels), value) for suffix, labels, value in samples)
+    lines = []
+    for name, (documentation, type, samples) in families.items():
+        _render_family(lines, name, documentation, type, samples)
+    return '\n'.join(lines) + '\n' + _scrape()
+
+
+def _scrape():
+    text = ''
+    if settings['scrape_urls']:
+        # Only needed with `metrics.mediamtx`, importing it costs ssl and email
+        import urllib.request
+    for url in settings['scrape_urls']:
+        # e.g. mediamtx's own metrics listener
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                text += resp.read().decode('utf-8', 'replace')
+        except Exception as e:
+            logger.debug(f"Scraping {url} failed: {e}")
+            text += f"# scrape of {url} failed\n"
+    return text
@@ -0,0 +1,117 @@
+import logging
+import socket
+import threading
+import time
+
+import netifaces
+
+logger = logging.getLogger('NetInfo')
+
+# rtnetlink multicast groups: link up/down and IPv4 address changes
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+# Changes usually come in bursts (DHCP renew, interface restart), wait for them to settle
+SETTLE_TIME = 0.5
+# Used where netlink isn't available
+POLL_INTERVAL = 30
+
+_index = None
+_index_lock = threading.Lock()
+_callbacks = []
+_watcher = None
+
+
+def _scan():
+    # One pass over all interfaces: MAC -> first IPv4 address of the first
+    # interface with that MAC that has one
+    index = {}
+    for iface in netifaces.interfaces():
+        addrs = netifaces.ifaddresses(iface)
+        if netifaces.AF_LINK not in addrs or netifaces.AF_INET not in addrs:
+            continue
+        for link in addrs[netifaces.AF_LINK]:
+            index.setdefault(link['addr'].lower(), addrs[netifaces.AF_INET][0]['addr'])
+    return index
+
+
+def lookup(mac_address):
+    global _index
+    index = _index
+    if index is None:
+        with _index_lock:
+            if _index is None:
+                _index = _scan()
+            index = _index
+    return index.get(mac_address.lower())
+
+
+def subscribe(callback):
+    # callback(macs) runs on the watcher thread with the MACs whose address changed
+    _callbacks.append(callback)
+
+
+def refresh():
+    global _index
+    with _index_lock:
+        old = _index or {}
+        _index = new = _scan()
+    changed = {mac for mac in old.keys() | new.keys() if old.get(mac) != new.get(mac)}
+    for mac in sorted(changed):
+        logger.info(f"Address of {mac} changed: {old.get(mac)} -> {new.get(mac)}")
+    if changed:
+        for callback in list(_callbacks):
+            try:
+                callback(changed)
+            except Exception as e:
+                logger.error(f"Address change handler failed: {e}")
+    return changed
+
+
+def watch():
+    # Starts the watcher thread once per process
+    global _watcher
+    with _index_lock:
+        if _watcher is not None:
+            return
+        _watcher = threading.Thread(target=_watch, name='NetInfo', daemon=True)
+    _watcher.start()
+
+
+def _open_netlink():
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    except (AttributeError, OSError) as e:
+        logger.info(f"No netlink ({e}), checking interface addresses every {POLL_INTERVAL}s")
+        return None
+    try:
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+    except OSError as e:
+        logger.info(f"No netlink ({e}), checking interface addresses every {POLL_INTERVAL}s")
+        sock.close()
+        return None
+    return sock
+
+
+def _watch():
+    sock = _open_netlink()
+    while True:
+        if sock is None:
+            time.sleep(POLL_INTERVAL)
+        else:
+            # The messages themselves aren't parsed, any of them means rescan
+            sock.settimeout(None)
+            try:
+                sock.recv(65536)
+                sock.settimeout(SETTLE_TIME)
+                while True:
+                    sock.recv(65536)
+            except socket.timeout:
+                pass
+            except OSError as e:
+                # e.g. ENOBUFS after a flood of messages, a rescan catches up
+                logger.debug(f"Netlink receive failed: {e}")
+        try:
+            refresh()
+        except Exception as e:
+            logger.error(f"Interface address scan failed: {e}")
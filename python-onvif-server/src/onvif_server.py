@@ -1,75 +1,259 @@
+import json
+import re
 import socket
 import struct
+import time
 import uuid
 import datetime
-import netifaces
 import logging
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from xml.etree import ElementTree as ET
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from urllib.parse import parse_qs
+
+from . import metrics, netinfo, profile_policy, profiler, tracing
+from .snapshot import SnapshotCache, SnapshotSource, load_placeholder
+from .soap_request import parse_soap_request
+from .tcp_proxy import target_health
 
 logger = logging.getLogger('OnvifServer')
 
+# SOAP requests we answer are a few KB at most
+MAX_REQUEST_SIZE = 65536
+# How long a request waits for an in-flight slot before getting a 503
+IN_FLIGHT_WAIT = 5
+
+SOAP_REQUEST_DURATION = metrics.histogram(
+    'soap_request_duration_seconds', 'Time to read, route and answer a SOAP request', ('action',),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+DISCOVERY_PROBES = metrics.counter('discovery_probes_total', 'WS-Discovery probes for video transmitters received')
+DISCOVERY_MATCHES = metrics.counter('discovery_matches_total', 'WS-Discovery ProbeMatch messages sent')
+
 def get_ip_address_from_mac(mac_address):
-    mac_address = mac_address.lower()
-    for iface in netifaces.interfaces():
-        addrs = netifaces.ifaddresses(iface)
-        if netifaces.AF_LINK in addrs:
-            for link in addrs[netifaces.AF_LINK]:
-                if link['addr'].lower() == mac_address:
-                    if netifaces.AF_INET in addrs:
-                        return addrs[netifaces.AF_INET][0]['addr']
-    return None
+    # Served from an index kept current by netinfo's watcher
+    return netinfo.lookup(mac_address)
+
+def handle_soap(instance, path, data, client_ip=None, trace=None):
+    # Shared by OnvifHandler and the asyncio server, returns the response and its metrics label
+    request = parse_soap_request(path, data, client_ip)
+    if trace is not None:
+        trace.mark('parse')
+        trace.action = request.action
+    response = instance.handle_request(request)
+    if trace is not None:
+        trace.mark('dispatch')
+    # Unknown operations share one label to keep the series count bounded
+    return response, request.action if request.action in instance.actions else 'Other'
+
+def health_report():
+    # 503 while any proxy target is down, for load balancers and uptime checks
+    targets = list(target_health())
+    healthy = all(t['healthy'] for t in targets)
+    body = json.dumps({'status': 'ok' if healthy else 'degraded', 'targets': targets}).encode('utf-8')
+    return (200 if healthy else 503), body
+
+def debug_report(path, query):
+    # /debug/traces and /debug/profile?seconds=N, 404 while switched off in the `debug` config
+    if path == '/debug/traces' and tracing.settings['enabled']:
+        return 200, tracing.render()
+    if path == '/debug/profile' and profiler.settings['enabled']:
+        try:
+            seconds = parse_qs(query).get('seconds')
+            profile_path, seconds = profiler.start(float(seconds[0]) if seconds else None)
+        except ValueError:
+            return 400, b''
+        except RuntimeError as e:
+            return 409, json.dumps({'error': str(e)}).encode('utf-8')
+        return 202, json.dumps({'path': profile_path, 'seconds': seconds}).encode('utf-8')
+    return 404, b''
+
+class OnvifHTTPServer(ThreadingHTTPServer):
+    # One thread per connection, bounded by max_connections. Requests from all
+    # cameras share the in_flight semaphore, so a burst of polls can't pile up
+    # more concurrent work than the Pi can handle.
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, onvif_instance, in_flight, max_connections=64, idle_timeout=30,
+                 reuse_port=False):
+        self.allow_reuse_port = reuse_port
+        self.onvif_instance = onvif_instance
+        self.in_flight = in_flight
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+        super().__init__(server_address, OnvifHandler)
+
+    def verify_request(self, request, client_address):
+        with self.connections_lock:
+            if self.connections >= self.max_connections:
+                logger.debug(f"Rejecting {client_address[0]}: {self.connections} connections open")
+                return False
+            self.connections += 1
+        return True
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections -= 1
 
 class OnvifHandler(BaseHTTPRequestHandler):
+    # Persistent connections, UniFi Protect polls the same camera constantly
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in one segment, flushed after each request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # Socket timeout doubles as the keep-alive idle timeout
+        self.timeout = self.server.idle_timeout
+        super().setup()
+
     def log_message(self, format, *args):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(format % args)
 
+    def send_body(self, content_type, body, headers=(), status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        
-        # Determine service and action
-        action = "Unknown"
-        # Very basic XML parsing to find body content
+        started = time.perf_counter()
+        trace = tracing.begin(self.client_address[0], self.path)
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            self.send_error(400)
+            return
+        if content_length > MAX_REQUEST_SIZE:
+            self.send_error(413)
+            return
+        post_data = self.rfile.read(content_length)
+        if trace is not None:
+            trace.mark('read')
+        # Both can be swapped by a config reload while the request runs
+        instance = self.server.onvif_instance
+        in_flight = self.server.in_flight
+
+        if not in_flight.acquire(timeout=IN_FLIGHT_WAIT):
+            self.send_error(503)
+            return
+        if trace is not None:
+            trace.mark('wait')
         try:
-            root = ET.fromstring(post_data)
-            # Namespaces are annoying in ElementTree, ignore for simple routing
-            body = root.find('.//{http://www.w3.org/2003/05/soap-envelope}Body')
-            if body is not None and len(body) > 0:
-                action = body[0].tag.split('}')[-1]
-        except:
-            pass
-
-        response_xml = self.server.onvif_instance.handle_request(self.path, action, post_data)
+            response, action = handle_soap(instance, self.path, post_data, self.client_address[0], trace)
+        finally:
+            in_flight.release()
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/soap+xml; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(response_xml.encode('utf-8'))
+        self.send_body('application/soap+xml; charset=utf-8', response)
+        SOAP_REQUEST_DURATION.observe(time.perf_counter() - started, action)
+        if trace is not None:
+            trace.mark('write')
+            trace.finish()
 
     def do_GET(self):
-        if self.path == '/snapshot.png':
+        path, _, query = self.path.partition('?')
+        if path == '/metrics' and metrics.settings['enabled']:
+            self.send_body('text/plain; version=0.0.4; charset=utf-8', metrics.render().encode('utf-8'))
+        elif path == '/health':
+            self.send_health()
+        elif path.startswith('/snapshot/'):
+            self.send_snapshot(path[len('/snapshot/'):])
+        elif path == '/snapshot.png':
             try:
-                with open('./resources/snapshot.png', 'rb') as f:
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'image/png')
-                    self.end_headers()
-                    self.wfile.write(f.read())
+                snapshot = load_placeholder()
             except FileNotFoundError:
                 self.send_error(404, "Snapshot not found")
+                return
+            self.send_body(snapshot.content_type, snapshot.data)
+        elif path.startswith('/debug/'):
+            status, body = debug_report(path, query)
+            if status == 404:
+                self.send_error(404)
+                return
+            self.send_body('application/json', body, status=status)
         else:
             self.send_error(404)
 
+    def send_health(self):
+        status, body = health_report()
+        self.send_body('application/json', body, status=status)
+
+    def send_snapshot(self, token):
+        instance = self.server.onvif_instance
+        try:
+            snapshot = instance.get_snapshot(token)
+        except KeyError:
+            self.send_error(404, "Snapshot not found")
+            return
+        except Exception as e:
+            logger.debug(f"Snapshot for {token} failed: {e}")
+            self.send_error(502, "Snapshot unavailable")
+            return
+
+        headers = (('ETag', snapshot.etag),
+                   ('Cache-Control', f"max-age={instance.snapshot_cache.max_age(snapshot)}"))
+        if self.headers.get('If-None-Match') == snapshot.etag:
+            self.send_response(304)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.send_body(snapshot.content_type, snapshot.data, headers)
+
 class OnvifServerInstance:
     def __init__(self, config):
+        self.update_config(config)
+
+    def update_config(self, config):
+        # Cached responses are rendered from the config, so they are rebuilt here
         self.config = config
         self.uuid = config['uuid']
         if not self.config.get('hostname'):
             self.config['hostname'] = get_ip_address_from_mac(self.config['mac'])
         
+        self.setup_snapshots()
         self.setup_profiles()
 
+        self.handlers = {
+            'GetSystemDateAndTime': self._handle_get_system_date_and_time,
+            'GetSnapshotUri': self._handle_get_snapshot_uri,
+            'GetStreamUri': self._handle_get_stream_uri,
+        }
+        self.actions = frozenset(self.handlers) | frozenset(self.responses)
+
+    def setup_snapshots(self):
+        # Frames are grabbed from the camera on demand and shared for `ttl` seconds.
+        # Off unless configured, the fetches carry no camera credentials.
+        snap_conf = self.config.get('snapshotCache') or {}
+        self.snapshot_cache = None
+        self.snapshot_sources = {}
+        if not snap_conf.get('enabled', False):
+            return
+        timeout = snap_conf.get('timeout', 5)
+        self.snapshot_cache = SnapshotCache(ttl=snap_conf.get('ttl', 5), fetch_timeout=timeout)
+        source = snap_conf.get('source', 'auto')
+        self.snapshot_sources['main_stream'] = SnapshotSource(self.config, self.config['highQuality'], source, timeout)
+        if self.config.get('lowQuality'):
+            self.snapshot_sources['sub_stream'] = SnapshotSource(self.config, self.config['lowQuality'], source, timeout)
+
+    def get_snapshot(self, token):
+        if self.snapshot_cache is None:
+            raise KeyError(token)
+        return self.snapshot_cache.get(token, self.snapshot_sources[token].fetch)
+
     def setup_profiles(self):
         # Construct profile objects similar to Node version
         self.profiles = []
@@ -79,6 +263,23 @@ class OnvifServerInstance:
         if self.config.get('lowQuality'):
             self.profiles.append(self._create_profile('SubStream', 'sub_stream', self.config['lowQuality'], 'encoder_lq'))
 
+        self.render_responses()
+
+    def render_responses(self):
+        # Everything but the clock and the stream/snapshot URI choice is fixed
+        # for the lifetime of the config, so render it to bytes once
+        self.responses = {
+            'GetCapabilities': self.resp_get_capabilities().encode('utf-8'),
+            'GetServices': self.resp_get_services().encode('utf-8'),
+            'GetDeviceInformation': self.resp_get_device_information().encode('utf-8'),
+            'GetProfiles': self.resp_get_profiles().encode('utf-8'),
+            'GetVideoSources': self.resp_get_video_sources().encode('utf-8'),
+        }
+        self.empty_response = self.wrap_soap("").encode('utf-8')
+        self.date_time_template = self.resp_get_system_date_and_time().encode('utf-8')
+        self.snapshot_uri_responses = {p['token']: self.resp_get_snapshot_uri(p['token']).encode('utf-8') for p in self.profiles}
+        self.stream_uri_responses = {p['token']: self.resp_get_stream_uri(p['token']).encode('utf-8') for p in self.profiles}
+
     def _create_profile(self, name, token, conf, enc_token):
         return {
             'Name': name,
@@ -87,30 +288,34 @@ class OnvifServerInstance:
             'height': conf['height'],
             'framerate': conf['framerate'],
             'bitrate': conf['bitrate'],
+            'quality': conf.get('quality', 1),
             'enc_token': enc_token
         }
 
-    def handle_request(self, path, action, body):
-        logger.debug(f"Request: {path} Action: {action}")
-        
-        if action == 'GetSystemDateAndTime':
-            return self.resp_get_system_date_and_time()
-        elif action == 'GetCapabilities':
-            return self.resp_get_capabilities()
-        elif action == 'GetServices':
-            return self.resp_get_services()
-        elif action == 'GetDeviceInformation':
-            return self.resp_get_device_information()
-        elif action == 'GetProfiles':
-            return self.resp_get_profiles()
-        elif action == 'GetVideoSources':
-            return self.resp_get_video_sources()
-        elif action == 'GetSnapshotUri':
-            return self.resp_get_snapshot_uri(body)
-        elif action == 'GetStreamUri':
-            return self.resp_get_stream_uri(body)
+    def handle_request(self, request):
+        logger.debug(f"Request: {request.path} Action: {request.action}")
         
-        return self.wrap_soap("")
+        handler = self.handlers.get(request.action)
+        if handler is not None:
+            return handler(request)
+        return self.responses.get(request.action, self.empty_response)
+
+    def _handle_get_system_date_and_time(self, request):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.date_time_template % (now.hour, now.minute, now.second, now.year, now.month, now.day)
+
+    def _profile_token(self, request):
+        # Unknown tokens get the main stream, which the profile policy may swap for the sub stream
+        token = request.profile_token if request.profile_token in self.stream_uri_responses else 'main_stream'
+        if 'sub_stream' in self.stream_uri_responses:
+            token = profile_policy.choose(token, request.client_ip)
+        return token
+
+    def _handle_get_snapshot_uri(self, request):
+        return self.snapshot_uri_responses[self._profile_token(request)]
+
+    def _handle_get_stream_uri(self, request):
+        return self.stream_uri_responses[self._profile_token(request)]
 
     def wrap_soap(self, content):
         return f"""<?xml version="1.0" encoding="UTF-8"?>
@@ -121,16 +326,16 @@ class OnvifServerInstance:
     # --- SOAP Responses ---
     
     def resp_get_system_date_and_time(self):
-        now = datetime.datetime.now(datetime.timezone.utc)
-        return self.wrap_soap(f"""
+        # Clock fields are %d slots, filled in per request by _handle_get_system_date_and_time
+        return self.wrap_soap("""
             <tds:GetSystemDateAndTimeResponse>
                 <tds:SystemDateAndTime>
                     <tt:DateTimeType>NTP</tt:DateTimeType>
                     <tt:DaylightSavings>false</tt:DaylightSavings>
                     <tt:TimeZone><tt:TZ>UTC+00:00</tt:TZ></tt:TimeZone>
                     <tt:UTCDateTime>
-                        <tt:Time><tt:Hour>{now.hour}</tt:Hour><tt:Minute>{now.minute}</tt:Minute><tt:Second>{now.second}</tt:Second></tt:Time>
-                        <tt:Date><tt:Year>{now.year}</tt:Year><tt:Month>{now.month}</tt:Month><tt:Day>{now.day}</tt:Day></tt:Date>
+                        <tt:Time><tt:Hour>%d</tt:Hour><tt:Minute>%d</tt:Minute><tt:Second>%d</tt:Second></tt:Time>
+                        <tt:Date><tt:Year>%d</tt:Year><tt:Month>%d</tt:Month><tt:Day>%d</tt:Day></tt:Date>
                     </tt:UTCDateTime>
                 </tds:SystemDateAndTime>
             </tds:GetSystemDateAndTimeResponse>
@@ -199,6 +404,7 @@ class OnvifServerInstance:
                         <tt:UseCount>1</tt:UseCount>
                         <tt:Encoding>H264</tt:Encoding>
                         <tt:Resolution><tt:Width>{p['width']}</tt:Width><tt:Height>{p['height']}</tt:Height></tt:Resolution>
+                        <tt:Quality>{p['quality']}</tt:Quality>
                         <tt:RateControl><tt:FrameRateLimit>{p['framerate']}</tt:FrameRateLimit><tt:EncodingInterval>1</tt:EncodingInterval><tt:BitrateLimit>{p['bitrate']}</tt:BitrateLimit></tt:RateControl>
                     </tt:VideoEncoderConfiguration>
                 </trt:Profiles>
@@ -216,14 +422,16 @@ class OnvifServerInstance:
             </trt:GetVideoSourcesResponse>
         """)
 
-    def resp_get_snapshot_uri(self, body):
-        # Basic parsing to check for sub_stream
+    def resp_get_snapshot_uri(self, token):
         uri = f"http://{self.config['hostname']}:{self.config['ports']['server']}/snapshot.png"
-        if 'sub_stream' in body and self.config.get('lowQuality') and self.config['lowQuality'].get('snapshot'):
-             uri = f"http://{self.config['hostname']}:{self.config['ports']['snapshot']}{self.config['lowQuality']['snapshot']}"
-        elif self.config['highQuality'].get('snapshot'):
-             uri = f"http://{self.config['hostname']}:{self.config['ports']['snapshot']}{self.config['highQuality']['snapshot']}"
-             
+        if self.snapshot_cache is not None:
+            uri = f"http://{self.config['hostname']}:{self.config['ports']['server']}/snapshot/{token}"
+        elif self.config['ports'].get('snapshot'):
+            if token == 'sub_stream' and self.config['lowQuality'].get('snapshot'):
+                uri = f"http://{self.config['hostname']}:{self.config['ports']['snapshot']}{self.config['lowQuality']['snapshot']}"
+            elif self.config['highQuality'].get('snapshot'):
+                uri = f"http://{self.config['hostname']}:{self.config['ports']['snapshot']}{self.config['highQuality']['snapshot']}"
+
         return self.wrap_soap(f"""
             <trt:GetSnapshotUriResponse>
                 <trt:MediaUri>
@@ -235,9 +443,9 @@ class OnvifServerInstance:
             </trt:GetSnapshotUriResponse>
         """)
 
-    def resp_get_stream_uri(self, body):
+    def resp_get_stream_uri(self, token):
         path = self.config['highQuality']['rtsp']
-        if 'sub_stream' in body and self.config.get('lowQuality'):
+        if token == 'sub_stream':
             path = self.config['lowQuality']['rtsp']
             
         uri = f"rtsp://{self.config['hostname']}:{self.config['ports']['rtsp']}{path}"
@@ -254,52 +462,148 @@ class OnvifServerInstance:
         """)
 
 # --- Discovery Class ---
-class WSDiscovery:
+DISCOVERY_GROUP = ('239.255.255.250', 3702)
+_PROBE_MESSAGE_ID = re.compile(rb'<(?:[\w.-]+:)?MessageID(?:\s[^>]*)?>\s*([^<\s]+)')
+
+def _discovery_envelope(header, body):
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+        <SOAP-ENV:Envelope xmlns:SOAP-ENV="http://www.w3.org/2003/05/soap-envelope" xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:d="http://schemas.xmlsoap.org/ws/2005/04/discovery" xmlns:dn="http://www.onvif.org/ver10/network/wsdl">
+            <SOAP-ENV:Header>{header}
+            </SOAP-ENV:Header>
+            <SOAP-ENV:Body>{body}
+            </SOAP-ENV:Body>
+        </SOAP-ENV:Envelope>"""
+
+class DiscoveryDevice:
+    # Discovery payloads for one virtual camera, rendered once from its config
+    _MESSAGE_ID = '\x00message-id\x00'
+    _RELATES_TO = '\x00relates-to\x00'
+
     def __init__(self, config):
-        self.config = config
+        self.uuid = config['uuid']
+        self.hostname = config['hostname']
+
+        endpoint = f"<wsa:EndpointReference><wsa:Address>urn:uuid:{config['uuid']}</wsa:Address></wsa:EndpointReference>"
+        details = f"""{endpoint}
+                        <d:Types>dn:NetworkVideoTransmitter</d:Types>
+                        <d:Scopes>onvif://www.onvif.org/type/video_encoder onvif://www.onvif.org/name/{config['name']}</d:Scopes>
+                        <d:XAddrs>http://{config['hostname']}:{config['ports']['server']}/onvif/device_service</d:XAddrs>
+                        <d:MetadataVersion>1</d:MetadataVersion>"""
+
+        probe_match = _discovery_envelope(f"""
+                <wsa:MessageID>uuid:{self._MESSAGE_ID}</wsa:MessageID>
+                <wsa:RelatesTo>{self._RELATES_TO}</wsa:RelatesTo>
+                <wsa:To SOAP-ENV:mustUnderstand="true">http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous</wsa:To>
+                <wsa:Action SOAP-ENV:mustUnderstand="true">http://schemas.xmlsoap.org/ws/2005/04/discovery/ProbeMatches</wsa:Action>""", f"""
+                <d:ProbeMatches>
+                    <d:ProbeMatch>
+                        {details}
+                    </d:ProbeMatch>
+                </d:ProbeMatches>""")
+        # Static parts around the per-response MessageID and RelatesTo
+        head, rest = probe_match.encode('utf-8').split(self._MESSAGE_ID.encode('utf-8'))
+        middle, tail = rest.split(self._RELATES_TO.encode('utf-8'))
+        self.probe_match_parts = (head, middle, tail)
+
+        self.hello = self._announcement('Hello', f"""
+                <d:Hello>
+                        {details}
+                </d:Hello>""")
+        self.bye = self._announcement('Bye', f"""
+                <d:Bye>
+                        {endpoint}
+                </d:Bye>""")
+
+    def _announcement(self, action, body):
+        # Hello/Bye are rare, only the MessageID and AppSequence are filled in when sent
+        return _discovery_envelope(f"""
+                <wsa:MessageID>uuid:{{message_id}}</wsa:MessageID>
+                <wsa:To SOAP-ENV:mustUnderstand="true">urn:schemas-xmlsoap-org:ws:2005:04:discovery</wsa:To>
+                <wsa:Action SOAP-ENV:mustUnderstand="true">http://schemas.xmlsoap.org/ws/2005/04/discovery/{action}</wsa:Action>
+                <d:AppSequence InstanceId="{{instance_id}}" MessageNumber="{{message_number}}"/>""", body.replace('{', '{{').replace('}', '}}'))
+
+    def probe_match(self, relates_to):
+        head, middle, tail = self.probe_match_parts
+        return b''.join((head, str(uuid.uuid4()).encode('ascii'), middle, relates_to, tail))
+
+class WSDiscovery:
+    # One socket on UDP 3702 answering probes for every virtual camera
+    def __init__(self):
+        self.devices = {}
+        self.running = False
+        self.instance_id = int(time.time())
+        self.message_number = 0
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
-    def start(self):
+
+    def add_device(self, config):
+        device = DiscoveryDevice(config)
+        # Copy on write, the receive loop iterates without taking a lock
+        self.devices = {**self.devices, device.uuid: device}
+        if self.running:
+            self.announce(device, 'hello')
+
+    def remove_device(self, device_uuid):
+        devices = dict(self.devices)
+        device = devices.pop(device_uuid, None)
+        self.devices = devices
+        if device is not None and self.running:
+            self.announce(device, 'bye')
+
+    def bind(self):
         # Bind to all interfaces on 3702
-        self.sock.bind(('', 3702))
+        self.sock.bind(('', DISCOVERY_GROUP[1]))
         
         # Add membership to multicast group
-        mreq = struct.pack("4sl", socket.inet_aton('239.255.255.250'), socket.INADDR_ANY)
+        mreq = struct.pack("4sl", socket.inet_aton(DISCOVERY_GROUP[0]), socket.INADDR_ANY)
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+    def start(self):
+        self.bind()
+        self.running = True
+        for device in self.devices.values():
+            self.announce(device, 'hello')
         
-        while True:
+        while self.running:
             try:
                 data, addr = self.sock.recvfrom(4096)
-                if b'Probe' in data and b'NetworkVideoTransmitter' in data:
-                    self.send_probe_match(data, addr)
+                self.datagram_received(data, addr)
             except Exception as e:
-                logger.error(f"Discovery error: {e}")
+                if self.running:
+                    logger.error(f"Discovery error: {e}")
 
-    def send_probe_match(self, data, addr):
-        # Extract RelatesTo/MessageID logic omitted for brevity, using generic match
-        # In a robust app, extract the MessageID from 'data' to use as RelatesTo
-        msg_uuid = uuid.uuid4()
-        
-        response = f"""<?xml version="1.0" encoding="UTF-8"?>
-        <SOAP-ENV:Envelope xmlns:SOAP-ENV="http://www.w3.org/2003/05/soap-envelope" xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:d="http://schemas.xmlsoap.org/ws/2005/04/discovery" xmlns:dn="http://www.onvif.org/ver10/network/wsdl">
-            <SOAP-ENV:Header>
-                <wsa:MessageID>uuid:{msg_uuid}</wsa:MessageID>
-                <wsa:RelatesTo>uuid:{self.config['uuid']}</wsa:RelatesTo>
-                <wsa:To SOAP-ENV:mustUnderstand="true">http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous</wsa:To>
-                <wsa:Action SOAP-ENV:mustUnderstand="true">http://schemas.xmlsoap.org/ws/2005/04/discovery/ProbeMatches</wsa:Action>
-            </SOAP-ENV:Header>
-            <SOAP-ENV:Body>
-                <d:ProbeMatches>
-                    <d:ProbeMatch>
-                        <wsa:EndpointReference><wsa:Address>urn:uuid:{self.config['uuid']}</wsa:Address></wsa:EndpointReference>
-                        <d:Types>dn:NetworkVideoTransmitter</d:Types>
-                        <d:Scopes>onvif://www.onvif.org/type/video_encoder onvif://www.onvif.org/name/{self.config['name']}</d:Scopes>
-                        <d:XAddrs>http://{self.config['hostname']}:{self.config['ports']['server']}/onvif/device_service</d:XAddrs>
-                        <d:MetadataVersion>1</d:MetadataVersion>
-                    </d:ProbeMatch>
-                </d:ProbeMatches>
-            </SOAP-ENV:Body>
-        </SOAP-ENV:Envelope>"""
-        
-        self.sock.sendto(response.encode('utf-8'), addr)
\ No newline at end of file
+    def datagram_received(self, data, addr):
+        if b'Probe' in data and b'NetworkVideoTransmitter' in data:
+            DISCOVERY_PROBES.inc()
+            self.send_probe_matches(data, addr)
+
+    def sendto(self, data, addr):
+        self.sock.sendto(data, addr)
+
+    def stop(self):
+        if not self.running:
+            return
+        for device in self.devices.values():
+            self.announce(device, 'bye')
+        self.running = False
+        self.sock.close()
+
+    def send_probe_matches(self, data, addr):
+        match = _PROBE_MESSAGE_ID.search(data)
+        relates_to = match.group(1) if match else b''
+        devices = self.devices
+        for device in devices.values():
+            self.sendto(device.probe_match(relates_to), addr)
+        DISCOVERY_MATCHES.inc(amount=len(devices))
+
+    def announce(self, device, kind):
+        self.message_number += 1
+        template = device.hello if kind == 'hello' else device.bye
+        message = template.format(message_id=uuid.uuid4(), instance_id=self.instance_id,
+                                  message_number=self.message_number)
+        try:
+            # Multicast from the camera's own interface
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(device.hostname))
+            self.sendto(message.encode('utf-8'), DISCOVERY_GROUP)
+        except OSError as e:
+            logger.error(f"Discovery {kind} for {device.uuid} failed: {e}")
@@ -0,0 +1,142 @@
+import ipaddress
+import logging
+import threading
+import time
+
+from . import metrics
+from .tcp_proxy import relayed_bytes
+
+logger = logging.getLogger('ProfilePolicy')
+
+# high: always the profile asked for (e.g. the NVR), low: always lowQuality,
+# adaptive: lowQuality while the bridge is busy
+PROFILES = ('high', 'low', 'adaptive')
+# Client IPs whose class is remembered, forgotten all at once when full
+MAX_CLASSIFIED = 1024
+
+# Set from the `profilePolicy` config section, rates in bytes per second. The
+# loop is the proxy engine's, which samples the load.
+_settings = {'enabled': False, 'throughput_high': 0, 'throughput_low': 0, 'cpu_high': 0, 'cpu_low': 0,
+             'interval': 5, 'hold_time': 30, 'classes': (), 'default_profile': 'adaptive', 'loop': None}
+_state = {'busy': False, 'changed': 0, 'sampled': None, 'bytes': 0, 'cpu': None, 'timer': None}
+_classified = {}
+_lock = threading.Lock()
+
+DOWNGRADES = metrics.counter('profile_policy_downgrades_total',
+                             'Stream and snapshot URIs handed out for lowQuality instead of highQuality', ('class',))
+metrics.callback('profile_policy_busy', 'Whether the profile policy considers the bridge busy', 'gauge',
+                 lambda: [((), int(_state['busy']))])
+
+
+def configure(enabled=False, throughput_high=0, throughput_low=None, cpu_high=0, cpu_low=None, interval=5,
+              hold_time=30, classes=(), default_profile='adaptive', loop=None):
+    # classes: (name, networks, profile) tuples, networks as CIDR strings.
+    # Without low marks the load has to drop a quarter below the high ones.
+    parsed = []
+    for name, networks, profile in classes:
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown profile {profile!r} for client class {name}, expected one of {', '.join(PROFILES)}")
+        parsed.append((name, [ipaddress.ip_network(n, strict=False) for n in networks], profile))
+    if default_profile not in PROFILES:
+        raise ValueError(f"Unknown default profile {default_profile!r}, expected one of {', '.join(PROFILES)}")
+    if not interval > 0:
+        raise ValueError(f"Profile policy interval must be positive, got {interval}")
+    with _lock:
+        _settings.update(enabled=enabled, throughput_high=throughput_high,
+                         throughput_low=throughput_high * 3 / 4 if throughput_low is None else throughput_low,
+                         cpu_high=cpu_high, cpu_low=cpu_high * 3 / 4 if cpu_low is None else cpu_low,
+                         interval=interval, hold_time=hold_time, classes=parsed, default_profile=default_profile,
+                         loop=loop)
+        _classified.clear()
+    if loop is not None:
+        loop.call_soon_threadsafe(_restart)
+
+
+def _cpu_times():
+    # Busy and total jiffies of all CPUs since boot
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(v) for v in f.readline().split()[1:8]]
+    except (OSError, ValueError):
+        return None
+    return sum(fields) - fields[3] - fields[4], sum(fields)
+
+
+def _classify(client_ip):
+    cls = _classified.get(client_ip)
+    if cls is None:
+        cls = ('default', _settings['default_profile'])
+        try:
+            address = ipaddress.ip_address(client_ip)
+        except ValueError:
+            address = None
+        for name, networks, profile in _settings['classes']:
+            if address is not None and any(address in network for network in networks):
+                cls = (name, profile)
+                break
+        if len(_classified) >= MAX_CLASSIFIED:
+            _classified.clear()
+        _classified[client_ip] = cls
+    return cls
+
+
+def _restart():
+    # On the loop: samples every `interval` seconds while the policy is on, so
+    # a URI request gets the load of the last few seconds however long ago the
+    # previous one came. Two reads of counters, nothing runs while it's off.
+    if _state['timer'] is not None:
+        _state['timer'].cancel()
+        _state['timer'] = None
+    _state['sampled'] = None
+    if _settings['enabled']:
+        _tick()
+
+
+def _tick():
+    with _lock:
+        _sample(time.monotonic())
+    _state['timer'] = _settings['loop'].call_later(_settings['interval'], _tick)
+
+
+def _sample(now):
+    # Load averaged since the previous sample
+    relayed = relayed_bytes()
+    cpu = _cpu_times()
+    last, last_bytes, last_cpu = _state['sampled'], _state['bytes'], _state['cpu']
+    _state.update(sampled=now, bytes=relayed, cpu=cpu)
+    if last is None:
+        return
+
+    # Listeners removed by a reload take their byte counts with them
+    throughput = max(0, relayed - last_bytes) / (now - last)
+    cpu_percent = 0
+    if cpu is not None and last_cpu is not None and cpu[1] > last_cpu[1]:
+        cpu_percent = 100 * (cpu[0] - last_cpu[0]) / (cpu[1] - last_cpu[1])
+
+    s = _settings
+    if now - _state['changed'] < s['hold_time']:
+        return
+    if not _state['busy']:
+        if (s['throughput_high'] and throughput >= s['throughput_high']) or \
+                (s['cpu_high'] and cpu_percent >= s['cpu_high']):
+            _state.update(busy=True, changed=now)
+            logger.warning(f"Busy ({throughput * 8 / 1000:.0f} kbit/s relayed, CPU {cpu_percent:.0f}%), "
+                           f"handing out lowQuality to adaptive clients")
+    elif (not s['throughput_high'] or throughput < s['throughput_low']) and \
+            (not s['cpu_high'] or cpu_percent < s['cpu_low']):
+        _state.update(busy=False, changed=now)
+        logger.info(f"Load is back to normal ({throughput * 8 / 1000:.0f} kbit/s relayed, CPU {cpu_percent:.0f}%), "
+                    f"handing out highQuality again")
+
+
+def choose(token, client_ip):
+    # Profile token whose URI a client asking for `token` gets
+    if not _settings['enabled'] or token != 'main_stream':
+        return token
+    name, profile = _classify(client_ip)
+    if profile == 'high':
+        return token
+    if profile == 'adaptive' and not _state['busy']:
+        return token
+    DOWNGRADES.inc(name)
+    return 'sub_stream'
@@ -0,0 +1,111 @@
+import collections
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger('Profiler')
+
+MODES = ('sample', 'cprofile')
+# Longest profile a request may ask for
+MAX_SECONDS = 600
+
+# Set from the `debug` config section. The loop is the proxy engine's, which
+# the cprofile mode profiles.
+settings = {'enabled': False, 'mode': 'sample', 'seconds': 30, 'interval': 0.005,
+            'directory': tempfile.gettempdir(), 'loop': None}
+_running = {'path': None}
+_lock = threading.Lock()
+
+
+def configure(enabled=False, mode='sample', seconds=30, interval=0.005, directory=None, loop=None):
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode {mode!r}, expected one of {', '.join(MODES)}")
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError(f"profileSeconds must be between 0 and {MAX_SECONDS}, got {seconds}")
+    settings.update(enabled=enabled, mode=mode, seconds=seconds, interval=interval,
+                    directory=directory or tempfile.gettempdir(), loop=loop)
+
+
+def start(seconds=None):
+    # Profiles for `seconds` (default `profileSeconds`) in the background,
+    # returns the file the profile will be written to. Raises ValueError for
+    # a length that isn't positive, RuntimeError while another one runs.
+    if seconds is None:
+        seconds = settings['seconds']
+    elif not 0 < seconds:
+        raise ValueError(f"seconds must be positive, got {seconds}")
+    seconds = min(seconds, MAX_SECONDS)
+    mode = settings['mode']
+    if mode == 'cprofile' and settings['loop'] is None:
+        raise RuntimeError('cprofile mode needs the event loop')
+    suffix = 'folded' if mode == 'sample' else 'pstats'
+    path = os.path.join(settings['directory'],
+                        f"onvif-bridge-profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{suffix}")
+    with _lock:
+        if _running['path'] is not None:
+            raise RuntimeError(f"already profiling into {_running['path']}")
+        _running['path'] = path
+    target = _sample if mode == 'sample' else _cprofile
+    threading.Thread(target=_run, args=(target, seconds, path), name='Profiler', daemon=True).start()
+    logger.info(f"Profiling ({mode}) for {seconds:g}s into {path}")
+    return path, seconds
+
+
+def _run(target, seconds, path):
+    try:
+        target(seconds, path)
+        logger.info(f"Wrote profile {path}")
+    except Exception as e:
+        logger.error(f"Profiling failed: {e}")
+    finally:
+        _running['path'] = None
+
+
+def _sample(seconds, path):
+    # Stacks of all threads every `interval` seconds, written in the folded
+    # format flamegraph.pl and speedscope read: "thread;outer;...;inner count"
+    interval = settings['interval']
+    me = threading.get_ident()
+    counts = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    with open(path, 'w') as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def _cprofile(seconds, path):
+    # cProfile only sees the thread that enables it: the event loop, which
+    # runs the proxies and, with `http.server: async`, all SOAP requests.
+    # Imported here, it isn't needed unless someone profiles.
+    import cProfile
+
+    loop = settings['loop']
+    profile = cProfile.Profile()
+    stopped = threading.Event()
+
+    def stop():
+        profile.disable()
+        stopped.set()
+
+    loop.call_soon_threadsafe(profile.enable)
+    time.sleep(seconds)
+    loop.call_soon_threadsafe(stop)
+    if not stopped.wait(5):
+        raise RuntimeError('event loop did not stop the profile')
+    profile.dump_stats(path)
@@ -0,0 +1,764 @@
+import asyncio
+import logging
+import os
+import re
+import socket
+from urllib.parse import urljoin, urlsplit
+
+from . import metrics
+from .tcp_proxy import ACCEPT_BACKLOG, CHUNK_SIZE, HIGH_WATER, LOW_WATER, ScratchProtocol, charge, listen_socket
+
+logger = logging.getLogger('RTSPProxy')
+
+# Interleaved packets kept per upstream session, shared by all its clients.
+# A client lagging further behind than this, or than `rtspRingBytes`, is
+# disconnected.
+RING_PACKETS = 8192
+# Seconds an upstream session stays open after its last client left
+LINGER = 5
+# RTSP requests/responses never get anywhere near this
+MAX_MESSAGE_SIZE = 65536
+SESSION_TIMEOUT = 60
+PUBLIC_METHODS = 'OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER, SET_PARAMETER'
+
+_INTERLEAVED = re.compile(r'interleaved=(\d+)(?:-(\d+))?')
+_SSRC = re.compile(r';ssrc=[0-9A-Fa-f]+')
+
+# Set from the `proxy` config section
+_gop_settings = {'enabled': True, 'max_bytes': 4 * 1024 * 1024, 'total_bytes': 32 * 1024 * 1024}
+# Bytes held by the GOP caches of all sessions, only touched on the engine loop
+_gop_usage = {'bytes': 0}
+_ring_settings = {'max_bytes': 4 * 1024 * 1024}
+# Bytes held by the packet rings of all sessions, likewise
+_ring_usage = {'bytes': 0}
+
+metrics.callback('rtsp_gop_cache_bytes', 'Bytes held in RTSP GOP caches', 'gauge',
+                 lambda: [((), _gop_usage['bytes'])])
+metrics.callback('rtsp_ring_bytes', 'Bytes of RTSP packets not yet sent to every client', 'gauge',
+                 lambda: [((), _ring_usage['bytes'])])
+
+
+def configure_gop_cache(enabled=True, max_bytes=4 * 1024 * 1024, total_bytes=32 * 1024 * 1024):
+    _gop_settings.update(enabled=enabled, max_bytes=max_bytes, total_bytes=total_bytes)
+
+
+def configure_ring(max_bytes=4 * 1024 * 1024):
+    _ring_settings.update(max_bytes=max_bytes)
+
+
+class RtspError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(f"{status} {reason}")
+        self.status = status
+        self.reason = reason
+
+
+class RtspMessage:
+    __slots__ = ('first_line', 'headers', 'body')
+
+    def __init__(self, first_line, headers, body):
+        self.first_line = first_line
+        self.headers = headers
+        self.body = body
+
+
+def parse_message(buf, pos, stop):
+    # Returns (message, end) for a complete RTSP request/response in buf[pos:stop], None if more data is needed
+    header_end = buf.find(b'\r\n\r\n', pos, stop)
+    if header_end < 0:
+        if stop - pos > MAX_MESSAGE_SIZE:
+            raise RtspError(400, 'Bad Request')
+        return None
+    lines = buf[pos:header_end].decode('utf-8', 'replace').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise RtspError(400, 'Bad Request')
+    if not 0 <= length <= MAX_MESSAGE_SIZE:
+        raise RtspError(400, 'Bad Request')
+    end = header_end + 4 + length
+    if stop < end:
+        return None
+    return RtspMessage(lines[0], headers, bytes(buf[header_end + 4:end])), end
+
+
+def render_message(first_line, headers, body=b''):
+    lines = [first_line]
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    if body:
+        lines.append(f"Content-Length: {len(body)}")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + body
+
+
+def parse_sdp_media(sdp):
+    # [control, encoding name] of every m= section, in order
+    media = []
+    for line in sdp.splitlines():
+        if line.startswith('m='):
+            media.append(['', ''])
+        elif line.startswith('a=control:') and media:
+            media[-1][0] = line[len('a=control:'):].strip()
+        elif line.startswith('a=rtpmap:') and media and not media[-1][1]:
+            encoding = line.split(' ', 1)[1] if ' ' in line else ''
+            media[-1][1] = encoding.split('/', 1)[0].upper()
+    return media
+
+
+def is_keyframe(encoding, frame):
+    # Does this interleaved RTP packet start an H.264/H.265 keyframe (parameter sets or IDR)?
+    if len(frame) < 4 + 12:
+        # Shorter than an RTP header, e.g. an empty interleaved frame
+        return False
+    offset = 4 + 12 + 4 * (frame[4] & 0x0f)
+    if frame[4] & 0x10:
+        # Header extension
+        if len(frame) < offset + 4:
+            return False
+        offset += 4 + 4 * ((frame[offset + 2] << 8) | frame[offset + 3])
+    if len(frame) < offset + 3:
+        return False
+    if encoding == 'H264':
+        nal = frame[offset] & 0x1f
+        if nal == 24:
+            # STAP-A, look at the first aggregated unit
+            return len(frame) > offset + 3 and (frame[offset + 3] & 0x1f) in (5, 7)
+        if nal == 28:
+            # FU-A, only the first fragment
+            return bool(frame[offset + 1] & 0x80) and (frame[offset + 1] & 0x1f) == 5
+        return nal in (5, 7)
+    if encoding == 'H265':
+        nal = (frame[offset] >> 1) & 0x3f
+        if nal == 48:
+            return len(frame) > offset + 4 and 16 <= (frame[offset + 4] >> 1) & 0x3f <= 34
+        if nal == 49:
+            return bool(frame[offset + 2] & 0x80) and 16 <= frame[offset + 2] & 0x3f <= 21
+        return 16 <= nal <= 21 or 32 <= nal <= 34
+    return False
+
+
+def _path(url):
+    parts = urlsplit(url)
+    return parts.path + (f"?{parts.query}" if parts.query else '')
+
+
+class _Ring:
+    # Fixed-size ring of interleaved frames; readers keep their own cursor.
+    # Frames from tail to head are held: those every reader has passed are
+    # released, and the oldest are dropped beyond `rtspRingBytes`.
+    def __init__(self, size):
+        self.size = size
+        self.slots = [None] * size
+        self.head = 0
+        self.tail = 0
+        self.bytes = 0
+
+    def append(self, frame):
+        if self.head - self.tail == self.size:
+            self._drop()
+        self.slots[self.head % self.size] = frame
+        self.head += 1
+        self.bytes += len(frame)
+        _ring_usage['bytes'] += len(frame)
+        max_bytes = _ring_settings['max_bytes']
+        while self.bytes > max_bytes and self.tail < self.head - 1:
+            self._drop()
+
+    def _drop(self):
+        i = self.tail % self.size
+        size = len(self.slots[i])
+        self.slots[i] = None
+        self.tail += 1
+        self.bytes -= size
+        _ring_usage['bytes'] -= size
+
+    def release(self, seq):
+        # Every reader is at seq or later
+        while self.tail < seq:
+            self._drop()
+
+    def get(self, seq):
+        return self.slots[seq % self.size]
+
+
+class _UpstreamProtocol(ScratchProtocol):
+    __slots__ = ('session', 'transport', 'cseq', 'pending')
+
+    def __init__(self, session):
+        super().__init__(session.listener.engine)
+        self.session = session
+        self.transport = None
+        self.cseq = 0
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def request(self, method, url, headers=(), wait=True):
+        self.cseq += 1
+        self.transport.write(render_message(f"{method} {url} RTSP/1.0",
+                                            [('CSeq', self.cseq), ('User-Agent', 'onvif-bridge')] + list(headers)))
+        if not wait:
+            return None
+        future = self.pending[self.cseq] = self.session.loop.create_future()
+        return future
+
+    def feed(self, buf, stop):
+        pos = 0
+        session = self.session
+        ring = session.ring
+        while pos < stop:
+            if buf[pos] == 0x24:
+                # $ <channel> <length:16> <packet>
+                if stop - pos < 4:
+                    break
+                end = pos + 4 + ((buf[pos + 2] << 8) | buf[pos + 3])
+                if stop < end:
+                    break
+                frame = bytes(buf[pos:end])
+                ring.append(frame)
+                if session.gop_channels:
+                    session.cache_frame(frame)
+                pos = end
+                continue
+            try:
+                parsed = parse_message(buf, pos, stop)
+            except RtspError as e:
+                self.transport.abort()
+                self.session.fail(e)
+                return None
+            if parsed is None:
+                break
+            message, pos = parsed
+            future = self.pending.pop(int(message.headers.get('cseq') or 0), None)
+            if future is not None and not future.done():
+                future.set_result(message)
+        self.session.publish()
+        return pos
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('upstream closed'))
+        self.pending.clear()
+        self.session.fail(exc or ConnectionError('upstream closed'))
+
+
+class _UpstreamSession:
+    # One RTSP session to the target per stream path, fanned out to every client
+    def __init__(self, listener, path):
+        self.listener = listener
+        self.loop = listener.loop
+        self.path = path
+        self.url = f"rtsp://{listener.dst_host}:{listener.dst_port}{path}"
+        self.ring = _Ring(RING_PACKETS)
+        self.protocol = None
+        self.session_id = None
+        self.sdp = None
+        self.tracks = []
+        # Most recent GOP: interleaved frames since the last keyframe, replayed to joining clients
+        self.gop_channels = {}
+        self.gop = None
+        self.gop_bytes = 0
+        self.gop_timestamp = None
+        self.clients = set()
+        self.subscribers = set()
+        self.target = listener.target
+        self.target.connections += 1
+        self.ready = self.loop.create_task(self.open())
+        self.keepalive = None
+        self.linger = None
+        self.playing = False
+        self.closed = False
+
+    async def open(self):
+        try:
+            _, self.protocol = await asyncio.wait_for(
+                self.loop.create_connection(lambda: _UpstreamProtocol(self), self.listener.dst_host,
+                                            self.listener.dst_port),
+                self.listener.engine.connect_timeout)
+            self.protocol.transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            resp = await self.call('DESCRIBE', self.url, [('Accept', 'application/sdp')])
+            self.sdp = resp.body.decode('utf-8', 'replace')
+            base = resp.headers.get('content-base') or resp.headers.get('content-location') or self.url
+            if not base.endswith('/'):
+                base += '/'
+            self.base = base
+
+            # Every track is pulled interleaved on channels 2i / 2i+1
+            for i, (control, encoding) in enumerate(parse_sdp_media(self.sdp)):
+                url = urljoin(base, control) if control and control != '*' else self.url
+                headers = [('Transport', f"RTP/AVP/TCP;unicast;interleaved={2 * i}-{2 * i + 1}")]
+                if self.session_id:
+                    headers.append(('Session', self.session_id))
+                resp = await self.call('SETUP', url, headers)
+                session, _, params = resp.headers.get('session', '').partition(';')
+                self.session_id = session.strip()
+                timeout = re.search(r'timeout=(\d+)', params)
+                self.timeout = int(timeout.group(1)) if timeout else SESSION_TIMEOUT
+                ssrc = _SSRC.search(resp.headers.get('transport', ''))
+                self.tracks.append((_path(url), ssrc.group(0) if ssrc else ''))
+                if _gop_settings['enabled'] and encoding in ('H264', 'H265'):
+                    self.gop_channels[2 * i] = encoding
+
+            if not self.tracks:
+                raise RtspError(415, 'Unsupported Media Type')
+            await self.call('PLAY', base, [('Session', self.session_id), ('Range', 'npt=0.000-')])
+        except asyncio.CancelledError:
+            self.close()
+            raise
+        except Exception as e:
+            self.listener.connect_failures += 1
+            if not isinstance(e, RtspError):
+                # An RTSP error status means the target is up but the path is not
+                self.listener.target.record_failure(e if str(e) else TimeoutError('upstream timed out'))
+            self.close()
+            raise
+        self.listener.target.record_success()
+        self.playing = True
+        self.keepalive = self.loop.call_later(self.timeout / 2, self._keepalive)
+        logger.info(f"RTSP upstream session opened: {self.url} ({len(self.tracks)} tracks)")
+
+    async def call(self, method, url, headers=()):
+        resp = await asyncio.wait_for(self.protocol.request(method, url, headers),
+                                      self.listener.engine.connect_timeout)
+        status = resp.first_line.split(' ', 2)
+        if len(status) < 2 or status[1] != '200':
+            raise RtspError(int(status[1]) if len(status) > 1 and status[1].isdigit() else 502,
+                            status[2] if len(status) > 2 else 'Bad Gateway')
+        return resp
+
+    def _keepalive(self):
+        if self.closed:
+            return
+        # The response is consumed by the protocol, nobody waits for it
+        self.protocol.request('OPTIONS', self.url, [('Session', self.session_id)], wait=False)
+        self.keepalive = self.loop.call_later(self.timeout / 2, self._keepalive)
+
+    def track_for(self, url):
+        path = _path(url)
+        for i, (track_path, _) in enumerate(self.tracks):
+            if track_path == path:
+                return i
+        for i, (track_path, _) in enumerate(self.tracks):
+            # Clients may use another host name or drop the query
+            if track_path.split('?', 1)[0].endswith(path.split('?', 1)[0].rsplit('/', 1)[-1]):
+                return i
+        if len(self.tracks) == 1:
+            return 0
+        raise RtspError(404, 'Not Found')
+
+    def rewrite_sdp(self, base):
+        # Absolute URLs in the SDP point at the target, clients must come back to us
+        sdp = self.sdp
+        upstream = [f"rtsp://{self.listener.dst_host}:{self.listener.dst_port}"]
+        if self.listener.dst_port == 554:
+            upstream.append(f"rtsp://{self.listener.dst_host}")
+        for prefix in upstream:
+            sdp = sdp.replace(prefix, base)
+        return sdp.encode('utf-8')
+
+    def attach(self, client):
+        self.clients.add(client)
+        if self.linger is not None:
+            self.linger.cancel()
+            self.linger = None
+
+    def detach(self, client):
+        self.clients.discard(client)
+        self.subscribers.discard(client)
+        if not self.clients and not self.closed:
+            self.linger = self.loop.call_later(LINGER, self._close_unused)
+
+    def _close_unused(self):
+        if not self.clients:
+            logger.info(f"RTSP upstream session closed: {self.url} (no clients)")
+            self.close()
+
+    def cache_frame(self, frame):
+        channel = frame[1]
+        if channel & 1:
+            # RTCP
+            return
+        encoding = self.gop_channels.get(channel)
+        if encoding is not None and is_keyframe(encoding, frame):
+            # Parameter sets and the IDR of one access unit share a timestamp
+            timestamp = frame[8:12]
+            if timestamp != self.gop_timestamp:
+                self.drop_gop()
+                self.gop = []
+                self.gop_timestamp = timestamp
+        if self.gop is None:
+            return
+        size = len(frame)
+        if self.gop_bytes + size > _gop_settings['max_bytes'] or \
+                _gop_usage['bytes'] + size > _gop_settings['total_bytes']:
+            # Too long a GOP to keep, joining clients wait for the next keyframe
+            self.drop_gop()
+            return
+        self.gop.append(frame)
+        self.gop_bytes += size
+        _gop_usage['bytes'] += size
+
+    def drop_gop(self):
+        _gop_usage['bytes'] -= self.gop_bytes
+        self.gop = None
+        self.gop_bytes = 0
+        self.gop_timestamp = None
+
+    def publish(self):
+        ring = self.ring
+        cursor = ring.head
+        for client in list(self.subscribers):
+            client.flush()
+            if not client.closed and client.cursor < cursor:
+                cursor = client.cursor
+        ring.release(cursor)
+
+    def fail(self, exc):
+        if not self.closed:
+            logger.info(f"RTSP upstream session {self.url} lost: {exc}")
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.target.connections -= 1
+        self.drop_gop()
+        self.ring.release(self.ring.head)
+        if self.listener.sessions.get(self.path) is self:
+            del self.listener.sessions[self.path]
+        for handle in (self.keepalive, self.linger):
+            if handle is not None:
+                handle.cancel()
+        if self.protocol is not None and self.protocol.transport is not None:
+            if self.session_id and not self.protocol.transport.is_closing():
+                self.protocol.request('TEARDOWN', self.url, [('Session', self.session_id)], wait=False)
+            self.protocol.transport.close()
+        # Clients reconnect and get a fresh upstream session. While still
+        # opening, waiting clients get an error response instead.
+        if self.playing:
+            for client in list(self.clients):
+                client.close()
+
+
+class _ClientProtocol(ScratchProtocol):
+    # One downstream RTSP client; requests are answered in order by serve(),
+    # which only runs while there are any
+    __slots__ = ('listener', 'loop', 'transport', 'requests', 'upstream', 'session_id', 'channels', 'cursor',
+                 'replay', 'replay_pos', 'replay_end', 'paused', 'closed', 'task', 'client_ip', 'client_bucket',
+                 'buckets', 'throttle')
+
+    def __init__(self, listener):
+        super().__init__(listener.engine)
+        self.listener = listener
+        self.loop = listener.loop
+        self.transport = None
+        self.requests = []
+        self.upstream = None
+        self.session_id = os.urandom(8).hex()
+        self.channels = {}
+        self.cursor = 0
+        # Cached GOP still to send, frames replay_pos up to replay_end of it
+        self.replay = None
+        self.replay_pos = 0
+        self.replay_end = 0
+        self.paused = False
+        self.closed = False
+        self.task = None
+        self.client_ip = None
+        self.client_bucket = None
+        self.buckets = ()
+        # Pending flush while paused for a rate limit
+        self.throttle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=HIGH_WATER, low=LOW_WATER)
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        engine = self.listener.engine
+        self.client_ip = transport.get_extra_info('peername')[0]
+        self.client_bucket = engine.client_bucket(self.client_ip)
+        self.buckets = engine.limiting_buckets(self.listener, self.client_bucket)
+        engine.mux_clients.add(self)
+        self.listener.active += 1
+
+    def feed(self, buf, stop):
+        pos = 0
+        while pos < stop:
+            if buf[pos] == 0x24:
+                # RTCP receiver reports, the upstream session sends its own
+                if stop - pos < 4:
+                    break
+                end = pos + 4 + ((buf[pos + 2] << 8) | buf[pos + 3])
+                if stop < end:
+                    break
+                pos = end
+                continue
+            try:
+                parsed = parse_message(buf, pos, stop)
+            except RtspError:
+                self.close()
+                return None
+            if parsed is None:
+                break
+            message, pos = parsed
+            self.requests.append(message)
+            if self.task is None:
+                self.task = self.loop.create_task(self.serve())
+        return pos
+
+    def connection_lost(self, exc):
+        self.close()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    async def serve(self):
+        try:
+            await self._serve()
+        finally:
+            self.task = None
+
+    async def _serve(self):
+        while self.requests and not self.closed:
+            request = self.requests.pop(0)
+            method, url = (request.first_line.split(' ') + ['', ''])[:2]
+            cseq = request.headers.get('cseq', '0')
+            try:
+                headers, body = await self.handle(method, url, request)
+                status = 'RTSP/1.0 200 OK'
+            except RtspError as e:
+                headers, body = [], b''
+                status = f"RTSP/1.0 {e.status} {e.reason}"
+            except Exception as e:
+                logger.debug(f"RTSP {method} {url} failed: {e}")
+                headers, body = [], b''
+                status = 'RTSP/1.0 503 Service Unavailable'
+            if self.closed:
+                return
+            self.transport.write(render_message(status, [('CSeq', cseq)] + headers, body))
+            if method == 'PLAY' and status.endswith('200 OK'):
+                self.subscribe()
+            elif method == 'TEARDOWN':
+                self.close()
+
+    async def handle(self, method, url, request):
+        if method == 'OPTIONS':
+            return [('Public', PUBLIC_METHODS)], b''
+        if method in ('GET_PARAMETER', 'SET_PARAMETER'):
+            return [('Session', self.session_id)], b''
+        if method == 'DESCRIBE':
+            upstream = await self.attach(_path(url))
+            base = url.rstrip('/')
+            authority = base.split('/', 3)
+            authority = '/'.join(authority[:3]) if len(authority) >= 3 else base
+            return [('Content-Base', base + '/'), ('Content-Type', 'application/sdp')], upstream.rewrite_sdp(authority)
+        if method == 'SETUP':
+            if self.upstream is None:
+                await self.attach(_path(url).rsplit('/', 1)[0])
+            transport = request.headers.get('transport', '')
+            if 'TCP' not in transport.upper():
+                raise RtspError(461, 'Unsupported Transport')
+            track = self.upstream.track_for(url)
+            match = _INTERLEAVED.search(transport)
+            rtp = int(match.group(1)) if match else 2 * track
+            rtcp = int(match.group(2)) if match and match.group(2) else rtp + 1
+            self.channels[2 * track] = rtp
+            self.channels[2 * track + 1] = rtcp
+            return [('Transport', f"RTP/AVP/TCP;unicast;interleaved={rtp}-{rtcp}{self.upstream.tracks[track][1]}"),
+                    ('Session', f"{self.session_id};timeout={SESSION_TIMEOUT}")], b''
+        if method == 'PLAY':
+            if self.upstream is None or not self.channels:
+                raise RtspError(455, 'Method Not Valid in This State')
+            return [('Session', self.session_id), ('Range', 'npt=0.000-')], b''
+        if method == 'TEARDOWN':
+            return [('Session', self.session_id)], b''
+        raise RtspError(405, 'Method Not Allowed')
+
+    async def attach(self, path):
+        if self.upstream is not None:
+            if self.upstream.path != path:
+                raise RtspError(459, 'Aggregate Operation Not Allowed')
+            return self.upstream
+        upstream = self.listener.sessions.get(path)
+        if upstream is None:
+            if not self.listener.target.healthy:
+                # Fast fail instead of waiting on a dead camera
+                self.listener.rejected += 1
+                raise RtspError(503, 'Service Unavailable')
+            if self.listener.target.at_limit():
+                self.listener.limited += 1
+                raise RtspError(503, 'Service Unavailable')
+            upstream = self.listener.sessions[path] = _UpstreamSession(self.listener, path)
+        upstream.attach(self)
+        self.upstream = upstream
+        try:
+            await asyncio.shield(upstream.ready)
+        except RtspError:
+            self.detach()
+            raise
+        except Exception as e:
+            self.detach()
+            raise RtspError(503, 'Service Unavailable') from e
+        return upstream
+
+    def detach(self):
+        if self.upstream is not None:
+            self.upstream.detach(self)
+            self.upstream = None
+
+    def subscribe(self):
+        upstream = self.upstream
+        upstream.subscribers.add(self)
+        self.cursor = upstream.ring.head
+        if upstream.gop:
+            # Start with the cached GOP so the client can decode right away,
+            # then continue live where the cache ends. The GOP list is only
+            # appended to, or replaced when the next one starts, so its first
+            # replay_end frames stay put while flush() works through them.
+            self.replay = upstream.gop
+            self.replay_pos = 0
+            self.replay_end = len(upstream.gop)
+        self.flush()
+
+    def write_frames(self, frames):
+        # Frames go out in batches of up to CHUNK_SIZE bytes, one send() each.
+        # Returns False once the transport stops taking data.
+        channels = self.channels
+        batch = []
+        size = 0
+        for frame in frames:
+            channel = channels.get(frame[1])
+            if channel is None:
+                continue
+            if channel != frame[1]:
+                frame = b'$' + bytes((channel,)) + frame[2:]
+            batch.append(frame)
+            size += len(frame)
+            if size >= CHUNK_SIZE:
+                if not self._send(batch, size):
+                    return False
+                batch = []
+                size = 0
+        return not batch or self._send(batch, size)
+
+    def _send(self, batch, size):
+        if self.transport.is_closing():
+            # Lost connection, connection_lost() hasn't run yet
+            self.close()
+            return False
+        self.transport.write(b''.join(batch))
+        self.listener.bytes_relayed += size
+        if self.buckets:
+            wait = charge(self.buckets, size, self.listener)
+            if wait:
+                # Frames wait in the ring meanwhile, a client throttled below
+                # the stream's bitrate falls behind and is disconnected
+                self.throttle = self.loop.call_later(wait, self._unthrottle)
+                return False
+        return not self.paused
+
+    def _unthrottle(self):
+        self.throttle = None
+        self.flush()
+
+    def _replay_frames(self):
+        replay = self.replay
+        while self.replay_pos < self.replay_end:
+            frame = replay[self.replay_pos]
+            self.replay_pos += 1
+            yield frame
+
+    def _ring_frames(self, ring, head):
+        while self.cursor < head:
+            frame = ring.get(self.cursor)
+            self.cursor += 1
+            yield frame
+
+    def flush(self):
+        # Copy frames from the cached GOP, then from the shared ring, until
+        # caught up or the socket buffer fills
+        if self.paused or self.closed or self.throttle is not None:
+            return
+        ring = self.upstream.ring
+        if self.cursor < ring.tail:
+            logger.info(f"RTSP client on port {self.listener.src_port} fell behind, disconnecting")
+            self.close()
+            return
+        if self.replay is not None:
+            sent = self.write_frames(self._replay_frames())
+            if self.replay_pos == self.replay_end:
+                self.replay = None
+            if not sent:
+                return
+        self.write_frames(self._ring_frames(ring, ring.head))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.listener.active -= 1
+        self.listener.engine.mux_clients.discard(self)
+        self.listener.engine.release_client_bucket(self.client_ip)
+        if self.throttle is not None:
+            self.throttle.cancel()
+        self.replay = None
+        self.detach()
+        if self.task is not None and self.task is not asyncio.current_task(self.loop):
+            self.task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+
+class RtspListener:
+    # RTSP-aware alternative to the TCP proxy for a camera's RTSP port:
+    # all clients of one stream path share a single upstream session
+    def __init__(self, engine, src_port, dst_host, dst_port):
+        self.engine = engine
+        self.loop = engine.loop
+        self.src_port = src_port
+        self.dst_host = dst_host
+        self.dst_port = dst_port
+        self.server = None
+        self.closed = False
+        self.sessions = {}
+        self.active = 0
+        self.bytes_relayed = 0
+        self.connect_failures = 0
+        self.rejected = 0
+        self.limited = 0
+        self.throttled_bytes = 0
+        self.bucket = engine.port_bucket(src_port)
+        self.target = engine.get_target(dst_host, dst_port)
+        self.released = False
+
+    def start(self):
+        sock = listen_socket(self.engine, self.src_port)
+        self.loop.create_task(self._serve(sock))
+        logger.info(f"RTSP Proxy started: Local :{self.src_port} -> {self.dst_host}:{self.dst_port}")
+
+    async def _serve(self, sock):
+        self.server = await self.loop.create_server(lambda: _ClientProtocol(self), sock=sock,
+                                                    backlog=ACCEPT_BACKLOG)
+        if self.closed:
+            self.server.close()
+
+    def close(self):
+        # Stops accepting, sessions already running carry on
+        self.closed = True
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        if not self.released:
+            self.released = True
+            self.engine.release_target(self.target)
@@ -0,0 +1,233 @@
+import collections
+import hashlib
+import http.client
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger('Snapshot')
+
+PLACEHOLDER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources', 'snapshot.png')
+SOURCES = ('auto', 'http', 'rtsp', 'static')
+
+# Headers passed through the HTTP snapshot proxy (async_server.SnapshotProxyListener) in each direction
+FORWARD_REQUEST_HEADERS = ('Authorization', 'Accept', 'User-Agent', 'If-None-Match', 'If-Modified-Since')
+FORWARD_RESPONSE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'WWW-Authenticate')
+
+_placeholder = None
+_pools = {}
+_pools_lock = threading.Lock()
+_pool_settings = {'size': 2, 'timeout': 5, 'max_idle': 10}
+
+
+def load_placeholder():
+    global _placeholder
+    if _placeholder is None:
+        with open(PLACEHOLDER_PATH, 'rb') as f:
+            _placeholder = Snapshot(f.read(), 'image/png')
+    return _placeholder
+
+
+def configure_pools(size=2, timeout=5, max_idle=10):
+    _pool_settings.update(size=size, timeout=timeout, max_idle=max_idle)
+
+
+def get_pool(host, port):
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None:
+            pool = _pools[(host, port)] = ConnectionPool(host, port, **_pool_settings)
+        return pool
+
+
+def _pool_values(attr):
+    for (host, port), pool in list(_pools.items()):
+        yield (('target', f"{host}:{port}"),), getattr(pool, attr)
+
+
+metrics.callback('snapshot_pool_hits_total', 'Snapshot requests served on a pooled connection', 'counter',
+                 lambda: _pool_values('hits'))
+metrics.callback('snapshot_pool_misses_total', 'Snapshot requests that had to open a new connection', 'counter',
+                 lambda: _pool_values('misses'))
+
+
+class ConnectionPool:
+    # Keep-alive HTTP connections to one camera, reused across clients
+    def __init__(self, host, port, size=2, timeout=5, max_idle=10):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        # Cameras drop idle keep-alive connections, don't bother reusing older ones
+        self.max_idle = max_idle
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def prewarm(self):
+        # Opens the pool's connections ahead of the first request. Nothing
+        # keeps them warm, they are dropped once idle for max_idle seconds.
+        for _ in range(self.size - len(self.idle)):
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.connect()
+            except OSError as e:
+                logger.debug(f"Pre-warming {self.host}:{self.port} failed: {e}")
+                return
+            self._release(conn)
+        logger.debug(f"Pre-warmed {len(self.idle)} connections to {self.host}:{self.port}")
+
+    def request(self, method, path, headers=None):
+        for attempt in range(2):
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused and attempt == 0:
+                    # The camera closed the idle connection under us
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return resp, body
+
+    def _acquire(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                conn, released_at = self.idle.pop()
+                if now - released_at < self.max_idle:
+                    self.hits += 1
+                    return conn, True
+                conn.close()
+            self.misses += 1
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+
+class Snapshot:
+    __slots__ = ('data', 'content_type', 'etag', 'fetched_at')
+
+    def __init__(self, data, content_type):
+        self.data = data
+        self.content_type = content_type
+        self.etag = f'"{hashlib.blake2b(data, digest_size=8).hexdigest()}"'
+        self.fetched_at = time.monotonic()
+
+
+class _Flight:
+    # An upstream fetch in progress, later requests for the same key wait on it
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SnapshotCache:
+    def __init__(self, ttl=5, fetch_timeout=5):
+        self.ttl = ttl
+        self.fetch_timeout = fetch_timeout
+        self.entries = {}
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def max_age(self, snapshot):
+        return max(0, int(self.ttl - (time.monotonic() - snapshot.fetched_at)))
+
+    def get(self, key, fetch):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry.fetched_at < self.ttl:
+                return entry
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if leader:
+            try:
+                flight.result = fetch()
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                    if flight.result is not None:
+                        self.entries[key] = flight.result
+                flight.done.set()
+        else:
+            flight.done.wait(self.fetch_timeout * 2)
+
+        if flight.result is not None:
+            return flight.result
+        # Better a stale frame than none while the camera is briefly unreachable
+        if entry is not None:
+            logger.debug(f"Serving stale snapshot for {key}: {flight.error}")
+            return entry
+        raise flight.error or TimeoutError(f"Snapshot fetch for {key} timed out")
+
+
+class SnapshotSource:
+    # Grabs a current frame for one profile of a camera
+    def __init__(self, config, quality, source='auto', timeout=5):
+        target = config['target']
+        self.timeout = timeout
+        self.http_url = None
+        self.rtsp_url = None
+        if quality.get('snapshot') and target['ports'].get('snapshot'):
+            self.http_target = (target['hostname'], target['ports']['snapshot'])
+            self.http_url = f"http://{target['hostname']}:{target['ports']['snapshot']}{quality['snapshot']}"
+            self.http_path = quality['snapshot']
+        if quality.get('rtsp') and target['ports'].get('rtsp'):
+            self.rtsp_url = f"rtsp://{target['hostname']}:{target['ports']['rtsp']}{quality['rtsp']}"
+
+        if source == 'auto':
+            if self.http_url:
+                source = 'http'
+            elif self.rtsp_url and shutil.which('ffmpeg'):
+                source = 'rtsp'
+            else:
+                source = 'static'
+        elif source == 'http' and not self.http_url:
+            raise ValueError("snapshot source 'http' needs a snapshot path and target snapshot port")
+        elif source == 'rtsp' and not (self.rtsp_url and shutil.which('ffmpeg')):
+            raise ValueError("snapshot source 'rtsp' needs a target rtsp port and ffmpeg")
+        self.source = source
+
+    def fetch(self):
+        if self.source == 'http':
+            return self.fetch_http()
+        if self.source == 'rtsp':
+            return self.fetch_rtsp()
+        return load_placeholder()
+
+    def fetch_http(self):
+        resp, body = get_pool(*self.http_target).request('GET', self.http_path)
+        if resp.status != 200:
+            raise OSError(f"{self.http_url} returned HTTP {resp.status}")
+        return Snapshot(body, resp.getheader('Content-Type', 'image/jpeg'))
+
+    def fetch_rtsp(self):
+        # Decode a single frame, ffmpeg starts at the first keyframe it sees
+        result = subprocess.run(
+            ['ffmpeg', '-loglevel', 'error', '-rtsp_transport', 'tcp', '-i', self.rtsp_url,
+             '-frames:v', '1', '-f', 'image2', '-c:v', 'mjpeg', '-'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout, check=True)
+        return Snapshot(result.stdout, 'image/jpeg')
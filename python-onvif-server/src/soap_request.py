@@ -0,0 +1,40 @@
+import re
+
+# Routing only needs the operation name and the ProfileToken, so instead of
+# building a full ElementTree we scan the raw bytes for them. Namespace
+# prefixes vary between clients (s:, soap:, SOAP-ENV:, none), hence the
+# optional prefix group.
+_BODY_TAG = re.compile(rb'<(?:[\w.-]+:)?Body[\s/>]')
+_START_TAG = re.compile(rb'<(?:[\w.-]+:)?([A-Za-z_][\w.-]*)')
+_PROFILE_TOKEN = re.compile(rb'<(?:[\w.-]+:)?ProfileToken(?:\s[^>]*)?>\s*([^<\s]+)')
+
+
+class SoapRequest:
+    __slots__ = ('path', 'action', 'profile_token', 'client_ip')
+
+    def __init__(self, path, action, profile_token=None, client_ip=None):
+        self.path = path
+        self.action = action
+        self.profile_token = profile_token
+        self.client_ip = client_ip
+
+    def __repr__(self):
+        return (f"SoapRequest(path={self.path!r}, action={self.action!r}, profile_token={self.profile_token!r}, "
+                f"client_ip={self.client_ip!r})")
+
+
+def parse_soap_request(path, data, client_ip=None):
+    body = _BODY_TAG.search(data)
+    if body is None:
+        return SoapRequest(path, 'Unknown', client_ip=client_ip)
+
+    # First element inside Body is the operation. Closing tags, comments and
+    # PIs don't match, so an empty Body finds nothing.
+    op = _START_TAG.search(data, body.end())
+    if op is None:
+        return SoapRequest(path, 'Unknown', client_ip=client_ip)
+    action = op.group(1).decode('ascii', 'replace')
+
+    token = _PROFILE_TOKEN.search(data, op.end())
+    profile_token = token.group(1).decode('utf-8', 'replace') if token else None
+    return SoapRequest(path, action, profile_token, client_ip)
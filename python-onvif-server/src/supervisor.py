@@ -0,0 +1,318 @@
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import metrics, netinfo
+from .bridge import Bridge
+from .onvif_server import WSDiscovery
+from .tcp_proxy import target_health
+
+logger = logging.getLogger('Supervisor')
+
+LOG_FORMAT = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+# Delay before restarting a worker that exited, doubled while it keeps dying
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 30
+# A worker that stayed up this long gets the short restart delay again
+STABLE_AFTER = 60
+# How long a scrape of /metrics or /health waits for each worker
+STATUS_TIMEOUT = 2
+# Default for `metrics.port`, where the supervisor serves the merged metrics
+METRICS_PORT = 9101
+
+WORKER_RESTARTS = metrics.counter('worker_restarts_total', 'Worker processes restarted after exiting unexpectedly')
+
+
+def shard(config, index, count):
+    # Cameras are dealt round-robin in config order, a camera added at the end
+    # of the list never moves the others to a different worker
+    return {**config, 'onvif': config['onvif'][index::count]}
+
+
+def _discovery_key(conf):
+    return conf['name'], conf['hostname'], conf['ports']['server']
+
+
+def _worker_main(index, count, config, log_queue, log_level, conn):
+    # Entry point of a worker process. The supervisor owns Ctrl+C and SIGHUP
+    # and stops workers with SIGTERM. It forwards SIGUSR1/SIGUSR2, which dump
+    # and profile each worker on its own.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(log_level)
+
+    bridge = Bridge(discovery=False, reuse_port=True)
+    bridge.start(shard(config, index, count))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=bridge.dump_traces).start())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=bridge.profile).start())
+    while True:
+        try:
+            command, request_id, arg = conn.recv()
+        except EOFError:
+            # The supervisor is gone
+            return
+        if command == 'apply':
+            try:
+                bridge.apply(shard(arg, index, count))
+            except Exception as e:
+                logger.error(f"Reload failed, keeping the running config: {e}")
+        elif command == 'status':
+            conn.send((request_id, {'metrics': metrics.snapshot(), 'health': list(target_health())}))
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.name = f'worker-{index}'
+        self.process = None
+        self.conn = None
+        # Serializes requests on the pipe, scrapes and reloads come from different threads
+        self.lock = threading.Lock()
+        self.request_id = 0
+        self.started_at = 0
+        self.restart_delay = RESTART_DELAY
+        self.restart_at = None
+
+    def send(self, command, arg=None):
+        self.request_id += 1
+        self.conn.send((command, self.request_id, arg))
+        return self.request_id
+
+    def status(self):
+        if self.process is None or not self.process.is_alive():
+            return None
+        try:
+            request_id = self.send('status')
+            deadline = time.monotonic() + STATUS_TIMEOUT
+            while self.conn.poll(max(0, deadline - time.monotonic())):
+                reply_id, status = self.conn.recv()
+                # Skip late answers to requests that already timed out
+                if reply_id == request_id:
+                    return status
+        except (OSError, EOFError) as e:
+            logger.debug(f"Status of {self.name} failed: {e}")
+        return None
+
+
+class Supervisor:
+    # Multi-process runtime: the cameras are sharded across worker processes,
+    # each running a Bridge for its share (SOAP servers and proxies). Workers
+    # bind with SO_REUSEPORT, so a proxy port used by cameras on several
+    # workers is shared and the kernel spreads its connections. The supervisor
+    # answers WS-Discovery for all cameras, writes the workers' logs, serves
+    # their merged metrics and restarts workers that die.
+    def __init__(self, processes):
+        self.count = processes if processes > 0 else os.cpu_count() or 1
+        self.context = multiprocessing.get_context('spawn')
+        self.config = None
+        self.workers = [_Worker(i) for i in range(self.count)]
+        self.discovery = WSDiscovery()
+        self.devices = {}
+        self.log_queue = None
+        self.log_listener = None
+        self.status_server = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self, config):
+        self.config = config
+
+        # Workers log through a queue, records are written here tagged with the worker's name
+        root = logging.getLogger()
+        for handler in root.handlers:
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.log_queue = self.context.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, *root.handlers, respect_handler_level=True)
+        self.log_listener.start()
+
+        self.apply_local(config)
+        netinfo.subscribe(lambda macs: self.apply_local(self.config))
+        netinfo.watch()
+        for worker in self.workers:
+            with worker.lock:
+                self.spawn(worker)
+        logger.info(f"Sharding {len(config['onvif'])} cameras across {self.count} worker processes")
+
+        metrics_conf = config.get('metrics') or {}
+        port = metrics_conf.get('port', METRICS_PORT)
+        try:
+            self.status_server = _StatusServer(('0.0.0.0', port), self)
+        except OSError as e:
+            logger.error(f"Metrics server failed to start on port {port}: {e}")
+        else:
+            threading.Thread(target=self.status_server.serve_forever, daemon=True).start()
+            logger.info(f"Serving metrics of all workers at :{port}/metrics")
+
+        threading.Thread(target=self.discovery.start, daemon=True).start()
+        threading.Thread(target=self.monitor, name='Supervisor', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        for worker in self.workers:
+            with worker.lock:
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(5)
+            if worker.process.is_alive():
+                logger.warning(f"{worker.name} did not stop, killing it")
+                worker.process.kill()
+                worker.process.join()
+        # Let NVRs know the cameras are gone
+        self.discovery.stop()
+        if self.status_server is not None:
+            self.status_server.shutdown()
+            self.status_server.server_close()
+        self.log_listener.stop()
+
+    def apply(self, config):
+        self.config = config
+        self.apply_local(config)
+        for worker in self.workers:
+            with worker.lock:
+                if worker.process is None or not worker.process.is_alive():
+                    # Picks up self.config when it is restarted
+                    continue
+                try:
+                    worker.send('apply', config)
+                except OSError as e:
+                    logger.error(f"Reload of {worker.name} failed: {e}")
+
+    def dump_traces(self):
+        self.signal_workers(signal.SIGUSR1)
+
+    def profile(self):
+        self.signal_workers(signal.SIGUSR2)
+
+    def signal_workers(self, signum):
+        # The SOAP servers and proxies run in the workers, each writes its own file
+        for worker in self.workers:
+            with worker.lock:
+                if worker.process is not None and worker.process.is_alive():
+                    os.kill(worker.process.pid, signum)
+
+    def apply_local(self, config):
+        with self.lock:
+            self._apply_local(config)
+
+    def _apply_local(self, config):
+        metrics_conf = config.get('metrics') or {}
+        metrics.configure(enabled=metrics_conf.get('enabled', True),
+                          scrape_urls=[metrics_conf['mediamtx']] if metrics_conf.get('mediamtx') else [])
+
+        desired = {}
+        for conf in config['onvif']:
+            # Workers log cameras whose IP can't be found, they aren't announced
+            hostname = conf.get('hostname') or netinfo.lookup(conf['mac'])
+            if hostname:
+                desired[conf['uuid']] = {**conf, 'hostname': hostname}
+        for uuid in list(self.devices):
+            if uuid not in desired:
+                self.discovery.remove_device(uuid)
+                del self.devices[uuid]
+        for uuid, conf in desired.items():
+            if self.devices.get(uuid) != _discovery_key(conf):
+                self.discovery.add_device(conf)
+                self.devices[uuid] = _discovery_key(conf)
+
+    def spawn(self, worker):
+        if worker.conn is not None:
+            worker.conn.close()
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, name=worker.name, daemon=True,
+                                       args=(worker.index, self.count, self.config, self.log_queue,
+                                             logging.getLogger().level, child_conn))
+        process.start()
+        child_conn.close()
+        worker.process = process
+        worker.conn = parent_conn
+        worker.request_id = 0
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logger.info(f"Started {worker.name} (pid {process.pid})")
+
+    def monitor(self):
+        while not self.stopped.wait(1):
+            now = time.monotonic()
+            for worker in self.workers:
+                with worker.lock:
+                    if self.stopped.is_set():
+                        return
+                    if worker.process.is_alive():
+                        if now - worker.started_at >= STABLE_AFTER:
+                            worker.restart_delay = RESTART_DELAY
+                        continue
+                    if worker.restart_at is None:
+                        logger.error(f"{worker.name} exited with code {worker.process.exitcode}, "
+                                     f"restarting in {worker.restart_delay}s")
+                        worker.restart_at = now + worker.restart_delay
+                        worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY)
+                    elif now >= worker.restart_at:
+                        WORKER_RESTARTS.inc()
+                        self.spawn(worker)
+
+    def statuses(self):
+        for worker in self.workers:
+            with worker.lock:
+                status = worker.status()
+            if status is not None:
+                yield worker.name, status
+
+    def render_metrics(self):
+        snapshots = [('supervisor', metrics.snapshot())]
+        snapshots += [(name, status['metrics']) for name, status in self.statuses()]
+        return metrics.render_merged(snapshots)
+
+    def target_health(self):
+        for name, status in self.statuses():
+            for target in status['health']:
+                yield {**target, 'process': name}
+
+
+class _StatusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, supervisor):
+        self.supervisor = supervisor
+        super().__init__(server_address, _StatusHandler)
+
+
+class _StatusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(format % args)
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics' and metrics.settings['enabled']:
+            body = self.server.supervisor.render_metrics().encode('utf-8')
+            self.send_body(200, 'text/plain; version=0.0.4; charset=utf-8', body)
+        elif path == '/health':
+            # Same format as /health on the ONVIF server ports, across all workers
+            targets = list(self.server.supervisor.target_health())
+            healthy = all(t['healthy'] for t in targets)
+            body = json.dumps({'status': 'ok' if healthy else 'degraded', 'targets': targets}).encode('utf-8')
+            self.send_body(200 if healthy else 503, 'application/json', body)
+        else:
+            self.send_error(404)
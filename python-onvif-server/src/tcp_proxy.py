@@ -0,0 +1,758 @@
+import asyncio
+import fcntl
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import weakref
+
+from . import metrics
+
+logger = logging.getLogger('TCPProxy')
+
+# Bytes read from a socket in one go
+CHUNK_SIZE = 65536
+# Stop reading from a source once this much is queued for its destination,
+# resume once the queue drains below LOW_WATER
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+# Max connections accepted per listener wakeup
+ACCEPT_BACKLOG = 128
+# Defaults for the `proxy` config section
+CONNECT_TIMEOUT = 10
+IDLE_TIMEOUT = 0
+HEALTH_INTERVAL = 10
+FAILURE_THRESHOLD = 3
+# Rates in bytes per second, 0 = unlimited
+PORT_RATE_LIMIT = 0
+CLIENT_RATE_LIMIT = 0
+# Seconds of traffic a token bucket saves up for bursts
+RATE_BURST = 1
+MAX_TARGET_CONNECTIONS = 0
+
+RELAY_MODES = ('auto', 'splice', 'copy')
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+
+_engines = weakref.WeakSet()
+
+
+def _listener_values(attr):
+    # Read from the scrape thread; the counters are only written on the loop thread
+    for engine in list(_engines):
+        for listener in list(engine.listeners.values()):
+            yield (('port', listener.src_port),), getattr(listener, attr)
+
+
+metrics.callback('proxy_active_connections', 'Relayed connections currently open', 'gauge',
+                 lambda: _listener_values('active'))
+metrics.callback('proxy_relayed_bytes_total', 'Bytes relayed in either direction', 'counter',
+                 lambda: _listener_values('bytes_relayed'))
+metrics.callback('proxy_connect_failures_total', 'Failed connections to the proxy target', 'counter',
+                 lambda: _listener_values('connect_failures'))
+metrics.callback('proxy_rejected_connections_total', 'Client connections refused while the target was down',
+                 'counter', lambda: _listener_values('rejected'))
+metrics.callback('proxy_limited_connections_total', 'Client connections refused at the per-target connection limit',
+                 'counter', lambda: _listener_values('limited'))
+metrics.callback('proxy_throttled_bytes_total', 'Bytes relayed over a rate limit, paid back by pausing the relay',
+                 'counter', lambda: _listener_values('throttled_bytes'))
+metrics.callback('proxy_target_up', 'Whether the proxy target passes its health checks', 'gauge',
+                 lambda: (((('target', t['target']),), int(t['healthy'])) for t in target_health()))
+
+
+def relayed_bytes():
+    # Total over all listeners, read from other threads (e.g. the profile policy)
+    return sum(listener.bytes_relayed for engine in list(_engines) for listener in list(engine.listeners.values()))
+
+
+def target_health():
+    # Health of every proxy target, read from other threads (e.g. the ONVIF server's /health)
+    for engine in list(_engines):
+        for target in list(engine.targets.values()):
+            yield target.status()
+
+
+def listen_socket(engine, src_port):
+    # Bound but not yet listening. With reuse_port several worker processes
+    # bind the same port and the kernel spreads connections across them.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if engine.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('0.0.0.0', src_port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def reset(sock):
+    # Close with RST, refused clients don't wait for a FIN handshake
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    sock.close()
+
+
+class TokenBucket:
+    # Holds up to `burst` seconds of tokens at `rate` bytes per second. Relays
+    # don't wait for tokens before reading: the bucket goes into debt and
+    # the relay pauses until it is paid off, so reads are never split.
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp', 'users')
+
+    def __init__(self, rate, burst):
+        self.rate = 0
+        self.capacity = 0
+        self.tokens = 0
+        self.stamp = time.monotonic()
+        self.users = 0
+        self.configure(rate, burst)
+        # A new client or port gets the whole burst
+        self.tokens = self.capacity
+
+    def configure(self, rate, burst):
+        # An existing bucket keeps its tokens (or debt) up to the new capacity
+        self.rate = rate
+        self.capacity = rate * burst
+        self.tokens = min(self.tokens, self.capacity) if self.rate else self.capacity
+
+    def take(self, n, now):
+        # Returns the debt in bytes, 0 if the bucket had enough tokens
+        tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate) - n
+        self.tokens = tokens
+        self.stamp = now
+        return -tokens if tokens < 0 else 0
+
+
+def charge(buckets, n, listener):
+    # Takes n relayed bytes from every limiting bucket, returns the seconds
+    # the relay must pause for the largest debt to be paid off
+    now = time.monotonic()
+    wait = 0
+    over = 0
+    for bucket in buckets:
+        if not bucket.rate:
+            # Limit turned off by a reload the relay hasn't caught up with
+            continue
+        debt = bucket.take(n, now)
+        if debt:
+            wait = max(wait, debt / bucket.rate)
+            over = max(over, min(n, int(debt)))
+    listener.throttled_bytes += over
+    return wait
+
+
+def splice_supported():
+    # os.splice only exists on Linux with Python >= 3.10, and the kernel may
+    # still refuse sockets (e.g. under some sandboxes), so try it for real
+    if not hasattr(os, 'splice'):
+        return False
+    pipe_r, pipe_w = os.pipe()
+    a, b = socket.socketpair()
+    try:
+        a.send(b'x')
+        return os.splice(b.fileno(), pipe_w, 1, flags=SPLICE_FLAGS) == 1
+    except OSError:
+        return False
+    finally:
+        for fd in (pipe_r, pipe_w):
+            os.close(fd)
+        a.close()
+        b.close()
+
+
+class ScratchProtocol(asyncio.BufferedProtocol):
+    # Base for the asyncio protocols served on the engine loop. Reads land in
+    # the engine's shared scratch buffer and feed(buf, stop) consumes the
+    # complete messages in buf[:stop], returning where the rest starts (None
+    # to drop it). Only an incomplete rest is copied into the connection's
+    # own `partial` buffer, so reads allocate nothing and idle connections
+    # hold no buffer at all.
+    __slots__ = ('engine', 'partial')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.partial = None
+
+    def get_buffer(self, sizehint):
+        return self.engine.scratch_view
+
+    def buffer_updated(self, nbytes):
+        partial = self.partial
+        if partial is None:
+            buf, stop = self.engine.scratch, nbytes
+        else:
+            partial += self.engine.scratch_view[:nbytes]
+            buf, stop = partial, len(partial)
+        pos = self.feed(buf, stop)
+        if pos is None or pos >= stop:
+            self.partial = None
+        elif partial is None:
+            self.partial = buf[pos:stop]
+        else:
+            del partial[:pos]
+
+    def feed(self, buf, stop):
+        raise NotImplementedError
+
+
+class _Pipe:
+    # One direction of a proxied connection (src -> dst)
+    __slots__ = ('conn', 'listener', 'loop', 'src', 'dst', 'buffer', 'reading', 'writing', 'eof', 'done', 'throttle')
+
+    def __init__(self, conn, src, dst):
+        self.conn = conn
+        self.listener = conn.listener
+        self.loop = conn.loop
+        self.src = src
+        self.dst = dst
+        self.buffer = bytearray()
+        self.reading = False
+        self.writing = False
+        self.eof = False
+        self.done = False
+        # Pending resume while paused for a rate limit
+        self.throttle = None
+
+    def start(self):
+        self._resume_reading()
+
+    def close(self):
+        self._pause_reading()
+        self._stop_writing()
+        if self.throttle is not None:
+            self.throttle.cancel()
+            self.throttle = None
+
+    def _charge(self, n):
+        wait = charge(self.conn.buckets, n, self.listener)
+        if wait:
+            self._pause_reading()
+            self.throttle = self.loop.call_later(wait, self._unthrottle)
+
+    def _unthrottle(self):
+        self.throttle = None
+        if not self.eof and len(self.buffer) <= LOW_WATER:
+            self._resume_reading()
+
+    def _resume_reading(self):
+        if not self.reading:
+            self.loop.add_reader(self.src, self._on_readable)
+            self.reading = True
+
+    def _pause_reading(self):
+        if self.reading:
+            self.loop.remove_reader(self.src)
+            self.reading = False
+
+    def _start_writing(self):
+        if not self.writing:
+            self.loop.add_writer(self.dst, self._on_writable)
+            self.writing = True
+
+    def _stop_writing(self):
+        if self.writing:
+            self.loop.remove_writer(self.dst)
+            self.writing = False
+
+    def _on_readable(self):
+        engine = self.conn.engine
+        if engine.splice and not self.buffer:
+            self._splice()
+            return
+
+        try:
+            n = self.src.recv_into(engine.scratch)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.conn.abort(e)
+            return
+
+        if not n:
+            self._on_eof()
+            return
+        if self.conn.buckets:
+            self._charge(n)
+
+        # The scratch buffer is shared by every pipe, anything that can't be
+        # sent right away is copied into this pipe's own queue below
+        data = engine.scratch_view[:n]
+
+        if not self.buffer:
+            # Fast path: nothing queued, try to hand the data straight over
+            try:
+                sent = self.dst.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                self.conn.abort(e)
+                return
+            self.listener.bytes_relayed += sent
+            self.conn.relayed += sent
+            if sent == n:
+                return
+            data = data[sent:]
+
+        self.buffer += data
+        self._start_writing()
+        if len(self.buffer) >= HIGH_WATER:
+            # Backpressure: the destination is slower than the source
+            self._pause_reading()
+
+    def _splice(self):
+        # Zero-copy path: socket -> shared kernel pipe -> socket. The pipe is
+        # shared by every connection, so it must be empty again on return.
+        engine = self.conn.engine
+        try:
+            n = os.splice(self.src.fileno(), engine.pipe_w, engine.pipe_size, flags=SPLICE_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.conn.abort(e)
+            return
+
+        if not n:
+            self._on_eof()
+            return
+        if self.conn.buckets:
+            self._charge(n)
+
+        moved = 0
+        error = None
+        while moved < n:
+            try:
+                moved += os.splice(engine.pipe_r, self.dst.fileno(), n - moved, flags=SPLICE_FLAGS)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                error = e
+                break
+        self.listener.bytes_relayed += moved
+        self.conn.relayed += moved
+
+        if moved < n:
+            # The destination is full: park the rest in this pipe's queue,
+            # it drains through the copy path until the queue is empty
+            while moved < n:
+                chunk = os.read(engine.pipe_r, n - moved)
+                self.buffer += chunk
+                moved += len(chunk)
+            if error is not None:
+                self.conn.abort(error)
+                return
+            self._start_writing()
+
+    def _on_eof(self):
+        self.eof = True
+        self._pause_reading()
+        if not self.buffer:
+            self._finish()
+
+    def _on_writable(self):
+        try:
+            sent = self.dst.send(self.buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.conn.abort(e)
+            return
+
+        del self.buffer[:sent]
+        self.listener.bytes_relayed += sent
+        self.conn.relayed += sent
+        if not self.buffer:
+            self._stop_writing()
+            if self.eof:
+                self._finish()
+                return
+        if not self.eof and self.throttle is None and len(self.buffer) <= LOW_WATER:
+            self._resume_reading()
+
+    def _finish(self):
+        # Propagate the half-close, the other direction keeps flowing
+        self.done = True
+        try:
+            self.dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.conn.pipe_done()
+
+
+class _Target:
+    # Circuit breaker for one upstream host:port. Failed connects and health
+    # probes count towards `failure_threshold`; once reached, clients are
+    # refused right away until a probe or connection succeeds again.
+    def __init__(self, engine, host, port):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        self.last_change = time.time()
+        self.listeners = 0
+        # Connections open to the target, checked against max_target_connections
+        self.connections = 0
+        self.task = engine.loop.create_task(self._probe_loop())
+
+    def status(self):
+        return {'target': self.name, 'healthy': self.healthy, 'failures': self.failures,
+                'lastError': self.last_error, 'since': self.last_change}
+
+    def record_success(self):
+        self.failures = 0
+        if not self.healthy:
+            self.healthy = True
+            self.last_change = time.time()
+            logger.info(f"Proxy target {self.name} is reachable again, accepting clients")
+
+    def record_failure(self, exc):
+        self.failures += 1
+        self.last_error = str(exc) or type(exc).__name__
+        if self.healthy and self.failures >= self.engine.failure_threshold:
+            self.healthy = False
+            self.last_change = time.time()
+            logger.warning(f"Proxy target {self.name} is down after {self.failures} failures ({self.last_error}), "
+                           f"refusing clients until it recovers")
+
+    async def _probe_loop(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.engine.health_interval)
+
+    async def probe(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(self.engine.loop.sock_connect(sock, (self.host, self.port)),
+                                   self.engine.connect_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.record_failure(e if str(e) else TimeoutError('connect timed out'))
+        else:
+            self.record_success()
+        finally:
+            sock.close()
+
+    def at_limit(self):
+        limit = self.engine.max_target_connections
+        return limit and self.connections >= limit
+
+    def close(self):
+        self.task.cancel()
+
+
+class _Connection:
+    __slots__ = ('listener', 'engine', 'loop', 'client_sock', 'client_ip', 'client_bucket', 'buckets', 'target',
+                 'remote_sock', 'pipes', 'task', 'active', 'closed', 'relayed', 'relayed_seen', 'idle')
+
+    def __init__(self, listener, client_sock, client_ip):
+        self.listener = listener
+        self.engine = listener.engine
+        self.loop = listener.engine.loop
+        self.client_sock = client_sock
+        self.client_ip = client_ip
+        self.client_bucket = self.engine.client_bucket(client_ip)
+        self.buckets = self.engine.limiting_buckets(listener, self.client_bucket)
+        self.target = listener.target
+        self.target.connections += 1
+        self.remote_sock = None
+        self.pipes = ()
+        self.task = None
+        self.active = False
+        self.closed = False
+        # Bytes relayed, and how many idle sweeps saw no change
+        self.relayed = 0
+        self.relayed_seen = 0
+        self.idle = 0
+
+    async def open(self):
+        try:
+            await self._open()
+        finally:
+            # Only held while connecting, the loop keeps just a weak reference to running tasks
+            self.task = None
+
+    async def _open(self):
+        self.remote_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.remote_sock.setblocking(False)
+        target = self.listener.target
+        try:
+            await asyncio.wait_for(
+                self.loop.sock_connect(self.remote_sock, (self.listener.dst_host, self.listener.dst_port)),
+                self.engine.connect_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Only log debug to prevent spam if camera is temporarily unreachable,
+            # the target logs when it is considered down
+            logger.debug(f"Connection failed: {e}")
+            self.listener.connect_failures += 1
+            target.record_failure(e if str(e) else TimeoutError('connect timed out'))
+            self.close()
+            return
+        target.record_success()
+
+        if self.closed:
+            return
+        self.active = True
+        self.listener.active += 1
+        for sock in (self.client_sock, self.remote_sock):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pipes = (
+            _Pipe(self, self.client_sock, self.remote_sock),
+            _Pipe(self, self.remote_sock, self.client_sock),
+        )
+        for pipe in self.pipes:
+            pipe.start()
+
+    def pipe_done(self):
+        if all(pipe.done for pipe in self.pipes):
+            self.close()
+
+    def abort(self, exc):
+        logger.debug(f"Connection on port {self.listener.src_port} aborted: {exc}")
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.active:
+            self.listener.active -= 1
+        self.target.connections -= 1
+        self.engine.release_client_bucket(self.client_ip)
+        for pipe in self.pipes:
+            pipe.close()
+        for sock in (self.client_sock, self.remote_sock):
+            if sock is not None:
+                sock.close()
+        self.engine.connections.discard(self)
+
+
+class _Listener:
+    def __init__(self, engine, src_port, dst_host, dst_port):
+        self.engine = engine
+        self.loop = engine.loop
+        self.src_port = src_port
+        self.dst_host = dst_host
+        self.dst_port = dst_port
+        self.server_socket = None
+        self.active = 0
+        self.bytes_relayed = 0
+        self.connect_failures = 0
+        self.rejected = 0
+        self.limited = 0
+        self.throttled_bytes = 0
+        self.bucket = engine.port_bucket(src_port)
+        self.target = engine.get_target(dst_host, dst_port)
+        self.released = False
+
+    def start(self):
+        self.server_socket = listen_socket(self.engine, self.src_port)
+        self.server_socket.listen(ACCEPT_BACKLOG)
+        self.server_socket.setblocking(False)
+        self.loop.add_reader(self.server_socket, self._on_accept)
+        logger.info(f"TCP Proxy started: Local :{self.src_port} -> {self.dst_host}:{self.dst_port}")
+
+    def close(self):
+        if self.server_socket is not None:
+            self.loop.remove_reader(self.server_socket)
+            self.server_socket.close()
+            self.server_socket = None
+        if not self.released:
+            self.released = True
+            self.engine.release_target(self.target)
+
+    def _on_accept(self):
+        for _ in range(ACCEPT_BACKLOG):
+            try:
+                client_sock, addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"Proxy error on port {self.src_port}: {e}")
+                return
+            if not self.target.healthy:
+                # Fast fail: reset the connection instead of waiting on a dead camera
+                reset(client_sock)
+                self.rejected += 1
+                continue
+            if self.target.at_limit():
+                reset(client_sock)
+                self.limited += 1
+                continue
+            client_sock.setblocking(False)
+            conn = _Connection(self, client_sock, addr[0])
+            self.engine.connections.add(conn)
+            conn.task = self.loop.create_task(conn.open())
+
+
+class ProxyEngine(threading.Thread):
+    # Serves every proxy listener and relayed connection from one event loop thread
+    def __init__(self, relay_mode='auto', reuse_port=False):
+        super().__init__(name='ProxyEngine')
+        if relay_mode not in RELAY_MODES:
+            raise ValueError(f"Unknown relay mode {relay_mode!r}, expected one of {', '.join(RELAY_MODES)}")
+        self.loop = asyncio.new_event_loop()
+        self.listeners = {}
+        self.connections = set()
+        self.targets = {}
+        self.connect_timeout = CONNECT_TIMEOUT
+        self.idle_timeout = IDLE_TIMEOUT
+        self.health_interval = HEALTH_INTERVAL
+        self.failure_threshold = FAILURE_THRESHOLD
+        self.port_rate_limit = PORT_RATE_LIMIT
+        self.port_rate_limits = {}
+        self.client_rate_limit = CLIENT_RATE_LIMIT
+        self.rate_burst = RATE_BURST
+        self.max_target_connections = MAX_TARGET_CONNECTIONS
+        # Client IP -> TokenBucket, shared by all of the client's connections
+        self.client_buckets = {}
+        # RTSP mux clients, charged like connections but not in `connections`
+        self.mux_clients = set()
+        self.reuse_port = reuse_port
+        _engines.add(self)
+
+        # Read buffer shared by every pipe, they all run on the loop thread
+        self.scratch = bytearray(CHUNK_SIZE)
+        self.scratch_view = memoryview(self.scratch)
+
+        self.splice = False
+        if relay_mode != 'copy':
+            if splice_supported():
+                self.splice = True
+                self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+                self.pipe_size = fcntl.fcntl(self.pipe_r, fcntl.F_GETPIPE_SZ) if hasattr(fcntl, 'F_GETPIPE_SZ') else 65536
+            elif relay_mode == 'splice':
+                logger.warning("splice() is not available, falling back to copy relay")
+        logger.debug(f"Proxy relay mode: {'splice' if self.splice else 'copy'}")
+
+    def configure(self, connect_timeout=CONNECT_TIMEOUT, idle_timeout=IDLE_TIMEOUT, health_interval=HEALTH_INTERVAL,
+                  failure_threshold=FAILURE_THRESHOLD, port_rate_limit=PORT_RATE_LIMIT, port_rate_limits=None,
+                  client_rate_limit=CLIENT_RATE_LIMIT, rate_burst=RATE_BURST,
+                  max_target_connections=MAX_TARGET_CONNECTIONS):
+        # Plain attribute writes, picked up by the loop thread on next use
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.failure_threshold = failure_threshold
+        self.max_target_connections = max_target_connections
+        # The buckets of open connections are updated on the loop thread
+        self.loop.call_soon_threadsafe(self._configure_limits, port_rate_limit, port_rate_limits or {},
+                                       client_rate_limit, rate_burst)
+
+    def _configure_limits(self, port_rate_limit, port_rate_limits, client_rate_limit, rate_burst):
+        self.port_rate_limit = port_rate_limit
+        self.port_rate_limits = port_rate_limits
+        self.client_rate_limit = client_rate_limit
+        self.rate_burst = rate_burst
+        for bucket in self.client_buckets.values():
+            bucket.configure(client_rate_limit, rate_burst)
+        for listener in self.listeners.values():
+            listener.bucket.configure(port_rate_limits.get(listener.src_port, port_rate_limit), rate_burst)
+        # A limit turned on or off adds or drops a bucket. Every open
+        # connection, also those on ports a reload removed, as they share the
+        # client buckets just reconfigured.
+        for conn in self.connections:
+            conn.buckets = self.limiting_buckets(conn.listener, conn.client_bucket)
+        for client in self.mux_clients:
+            client.buckets = self.limiting_buckets(client.listener, client.client_bucket)
+
+    def port_bucket(self, src_port):
+        return TokenBucket(self.port_rate_limits.get(src_port, self.port_rate_limit), self.rate_burst)
+
+    def client_bucket(self, ip):
+        bucket = self.client_buckets.get(ip)
+        if bucket is None:
+            bucket = self.client_buckets[ip] = TokenBucket(self.client_rate_limit, self.rate_burst)
+        bucket.users += 1
+        return bucket
+
+    def release_client_bucket(self, ip):
+        bucket = self.client_buckets[ip]
+        bucket.users -= 1
+        if not bucket.users:
+            del self.client_buckets[ip]
+
+    def limiting_buckets(self, listener, client_bucket):
+        # Only buckets with a rate are charged, unlimited relays skip the accounting
+        return tuple(bucket for bucket in (listener.bucket, client_bucket) if bucket.rate)
+
+    def get_target(self, host, port):
+        target = self.targets.get((host, port))
+        if target is None:
+            target = self.targets[(host, port)] = _Target(self, host, port)
+        target.listeners += 1
+        return target
+
+    def release_target(self, target):
+        target.listeners -= 1
+        if target.listeners <= 0 and self.targets.get((target.host, target.port)) is target:
+            del self.targets[(target.host, target.port)]
+            target.close()
+
+    def _sweep_idle(self):
+        # Closes relayed connections that moved no data for idle_timeout seconds
+        interval = 1
+        if self.idle_timeout > 0:
+            for conn in list(self.connections):
+                if conn.relayed != conn.relayed_seen:
+                    conn.relayed_seen = conn.relayed
+                    conn.idle = 0
+                    continue
+                conn.idle += interval
+                if conn.active and conn.idle >= self.idle_timeout:
+                    logger.debug(f"Closing idle connection on port {conn.listener.src_port}")
+                    conn.close()
+        self.loop.call_later(interval, self._sweep_idle)
+
+    def add_proxy(self, src_port, dst_host, dst_port, listener_class=None):
+        # listener_class swaps the byte relay for a protocol-aware proxy, e.g. rtsp_proxy.RtspListener
+        self.loop.call_soon_threadsafe(self._add_proxy, src_port, dst_host, dst_port, listener_class or _Listener)
+
+    def _add_proxy(self, src_port, dst_host, dst_port, listener_class):
+        listener = listener_class(self, src_port, dst_host, dst_port)
+        try:
+            listener.start()
+        except Exception as e:
+            logger.error(f"Proxy error on port {src_port}: {e}")
+            listener.close()
+            return
+        self.listeners[src_port] = listener
+
+    def remove_proxy(self, src_port):
+        self.loop.call_soon_threadsafe(self._remove_proxy, src_port)
+
+    def _remove_proxy(self, src_port):
+        # Only stops accepting, connections already relayed run until either side closes
+        listener = self.listeners.pop(src_port, None)
+        if listener is not None:
+            listener.close()
+            logger.info(f"TCP Proxy stopped: Local :{src_port} -> {listener.dst_host}:{listener.dst_port}")
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._sweep_idle)
+        try:
+            self.loop.run_forever()
+        finally:
+            for conn in list(self.connections):
+                conn.close()
+            for listener in self.listeners.values():
+                listener.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            if self.splice:
+                os.close(self.pipe_r)
+                os.close(self.pipe_w)
+            self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
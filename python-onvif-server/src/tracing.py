@@ -0,0 +1,72 @@
+import collections
+import datetime
+import json
+import os
+import tempfile
+import time
+
+# Set from the `debug` config section
+settings = {'enabled': False, 'directory': tempfile.gettempdir()}
+# Newest last, appends from the SOAP threads and the event loop are atomic
+_ring = collections.deque(maxlen=256)
+
+
+def configure(enabled=False, size=256, directory=None):
+    global _ring
+    if size != _ring.maxlen:
+        _ring = collections.deque(_ring, maxlen=size)
+    settings.update(enabled=enabled, directory=directory or tempfile.gettempdir())
+
+
+class Trace:
+    # One SOAP request, mark(phase) closes the span since the previous mark.
+    # handle_soap fills in the action.
+    __slots__ = ('time', 'started', 'last', 'client_ip', 'path', 'action', 'spans')
+
+    def __init__(self, client_ip, path):
+        self.time = time.time()
+        self.started = self.last = time.perf_counter()
+        self.client_ip = client_ip
+        self.path = path
+        self.action = None
+        self.spans = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.spans.append((phase, self.last - self.started, now - self.last))
+        self.last = now
+
+    def finish(self):
+        _ring.append(self)
+
+    def as_dict(self):
+        return {
+            'time': datetime.datetime.fromtimestamp(self.time, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'client': self.client_ip,
+            'path': self.path,
+            'action': self.action,
+            'ms': round((self.last - self.started) * 1000, 3),
+            'spans': [{'phase': phase, 'start_ms': round(start * 1000, 3), 'ms': round(duration * 1000, 3)}
+                      for phase, start, duration in self.spans],
+        }
+
+
+def begin(client_ip, path):
+    # None while tracing is off, so callers only pay for an `is not None`
+    if not settings['enabled']:
+        return None
+    return Trace(client_ip, path)
+
+
+def render():
+    return json.dumps([trace.as_dict() for trace in list(_ring)], indent=1).encode('utf-8')
+
+
+def dump():
+    # Writes the ring to a file in the dump directory, returns its path and the trace count
+    traces = list(_ring)
+    path = os.path.join(settings['directory'],
+                        f"onvif-bridge-traces-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w') as f:
+        json.dump([trace.as_dict() for trace in traces], f, indent=1)
+    return path, len(traces)